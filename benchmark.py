@@ -0,0 +1,588 @@
+"""Benchmarks of every route and CO2 aggregate at several data scales.
+
+    python benchmark.py [--scales 1 10 100] [--repeat 5] [--years 3]
+                        [--output benchmark-report] [--compare OLD.json]
+    python benchmark.py --kernel 1000 100000 1000000
+
+For each scale the benchmark database (BENCHMARK_DB, postgresql:///
+carbon_calc_bench by default, created beforehand with createdb) is emptied
+and filled by synthetic_data.py with USERS_PER_SCALE users per 1x. Every
+route and aggregate is then timed for the first of those users:
+
+    cold - after clearing the CO2 timelines and car factors, like the first
+           request after the user's data changed
+    warm - straight after, with the caches loaded
+
+along with its SQL queries. The report is written as OUTPUT.json, to compare
+a later run against with --compare, and as an OUTPUT.md table. Compared runs
+mark the timings that got more than REGRESSION_THRESHOLD slower and the
+queries that went up.
+
+--kernel only compares the vectorized CO2 kernel of emissions.py with a
+Python loop over that many random trips, without a database.
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+from datetime import datetime, date, timedelta
+from StringIO import StringIO
+from timeit import default_timer
+from model import (db, User, Residence, UserCar, TripLog, ElectricityLog,
+                   NGLog, DailyCO2Rollup, Car, Region,
+                   invalidate_co2_timelines)
+from cache import LRUCache
+from distance import DistanceResolver, FixtureDistanceProvider
+from emissions import LogArrays
+import request_stats
+import server
+import synthetic_data
+
+USERS_PER_SCALE = 5
+
+# slower than the baseline by more than this fraction is a regression
+REGRESSION_THRESHOLD = 0.25
+
+# differences under this many milliseconds are noise
+NOISE_MS = 1.0
+
+# meters between the places of /get-distance, so no time is spent on the
+# Google API
+DISTANCES = {("San Francisco, CA", "Oakland, CA"): 19312}
+
+
+def get_routes(user_id, year):
+    """Get the (label, method, url, data) of every route, for a user's data in
+    a year. Routes that change data come after the ones that only read."""
+
+    usercar = UserCar.query.filter_by(user_id=user_id).first()
+    residence = Residence.query.filter_by(user_id=user_id).first()
+    trip = TripLog.query.filter_by(user_id=user_id).first()
+    elect = ElectricityLog.query.filter_by(
+        residence_id=residence.residence_id).first()
+    ng = NGLog.query.filter_by(residence_id=residence.residence_id).first()
+
+    car = "make=%s&model=%s&carYear=%s&cylinders=%s&transmission=%s" % (
+        usercar.make, usercar.model, usercar.year, usercar.cylinders or "",
+        usercar.transmission or "")
+    candidates = json.dumps(
+        {"tripYear": year,
+         "candidates": [{"make": car.make, "model": car.model,
+                         "year": car.year}
+                        for car in Car.query.order_by(Car.car_id).limit(5)]})
+    trips_csv = "date,usercar_id,miles\n%s-12-01,%s,12\n" % \
+        (year, usercar.usercar_id)
+    usage_csv = "TYPE,DATE,START TIME,END TIME,USAGE,UNITS\n" \
+        "Electric usage,%s-12-01,00:00,23:59,8.5,kWh\n" % year
+    home = residence.name_or_address
+
+    return [
+        ("GET /", "GET", "/", None),
+        ("GET /profile", "GET", "/profile", None),
+        ("GET /cars/makes.json", "GET", "/cars/makes.json", None),
+        ("GET /car-data", "GET", "/car-data?make=%s" % usercar.make, None),
+        ("GET /cars/catalog.json", "GET",
+         "/cars/catalog.json?make=%s" % usercar.make, None),
+        ("GET /kwh-log", "GET", "/kwh-log", None),
+        ("GET /kwh-log.json", "GET", "/kwh-log.json?year=%s" % year, None),
+        ("GET /ng-log", "GET", "/ng-log", None),
+        ("GET /ng-log.json", "GET", "/ng-log.json?year=%s" % year, None),
+        ("GET /trip-log", "GET", "/trip-log", None),
+        ("GET /trip-log.json", "GET", "/trip-log.json?year=%s" % year, None),
+        ("GET /get-distance", "GET",
+         "/get-distance?origin=San Francisco, CA&destination=Oakland, CA",
+         None),
+        ("GET /get-zipcode", "GET",
+         "/get-zipcode?city=San Francisco&state=CA", None),
+        ("GET /zipcodes.json", "GET",
+         "/zipcodes.json?city=San Francisco&state=CA", None),
+        ("GET /year-comparison-json", "GET", "/year-comparison-json", None),
+        ("GET /co2-per-datatype.json", "GET",
+         "/co2-per-datatype.json?year=%s" % year, None),
+        ("GET /co2-trend.json", "GET", "/co2-trend.json?year=%s" % year,
+         None),
+        ("GET /co2-day-of-week.json", "GET",
+         "/co2-day-of-week.json?year=%s" % year, None),
+        ("GET /dashboard.json", "GET", "/dashboard.json?year=%s" % year, None),
+        ("GET /co2-other-location.json", "GET",
+         "/co2-other-location.json?year=%s&zipcode=%s" %
+         (year, residence.zipcode_id), None),
+        ("GET /co2-all-locations.json", "GET",
+         "/co2-all-locations.json?year=%s" % year, None),
+        ("GET /co2-other-car.json", "GET",
+         "/co2-other-car.json?tripYear=%s&userCarId=%s&%s" %
+         (year, usercar.usercar_id, car), None),
+        ("POST /co2-other-cars.json", "POST", "/co2-other-cars.json",
+         candidates),
+        ("GET /cars/recommendations.json", "GET",
+         "/cars/recommendations.json?tripYear=%s" % year, None),
+        ("POST /add-kwh", "POST", "/add-kwh",
+         {"start_date": "%s-12-02" % year, "end_date": "%s-12-02" % year,
+          "kwh": 10, "residence": home}),
+        ("POST /edit-kwh", "POST", "/edit-kwh",
+         {"elect_id": elect.elect_id,
+          "start_date": elect.start_date.isoformat(),
+          "end_date": elect.end_date.isoformat(), "kwh": elect.kwh,
+          "residence": home}),
+        ("POST /add-ng", "POST", "/add-ng",
+         {"start_date": "%s-12-02" % year, "end_date": "%s-12-02" % year,
+          "therms": 1, "residence": home}),
+        ("POST /edit-ng", "POST", "/edit-ng",
+         {"ng_id": ng.ng_id, "start_date": ng.start_date.isoformat(),
+          "end_date": ng.end_date.isoformat(), "therms": ng.therms,
+          "residence": home}),
+        ("POST /add-trip", "POST", "/add-trip",
+         {"date": "%s-12-02" % year, "miles": 5, "car": usercar.usercar_id}),
+        ("POST /edit-trip", "POST", "/edit-trip",
+         {"trip_id": trip.trip_id, "date": trip.date.isoformat(),
+          "miles": trip.miles, "car": trip.usercar_id}),
+        ("POST /upload-usage", "POST", "/upload-usage",
+         lambda: {"usage_type": "kwh", "residence": home,
+                  "usage_file": (StringIO(usage_csv), "usage.csv")}),
+        ("POST /import-trips", "POST", "/import-trips",
+         lambda: {"trip_file": (StringIO(trips_csv), "trips.csv")}),
+        ("POST /add-residence", "POST", "/add-residence",
+         {"residence_name": "Benchmark", "zipcode": residence.zipcode_id,
+          "residents": 1}),
+        ("POST /edit-residence", "POST", "/edit-residence",
+         {"residence_id": residence.residence_id, "residence_name": home,
+          "zipcode": residence.zipcode_id,
+          "residents": residence.number_of_residents,
+          "default": "true" if residence.is_default else ""}),
+        ("POST /add-car", "POST", "/add-car",
+         {"make": usercar.make, "model": usercar.model, "year": usercar.year,
+          "cylinders": usercar.cylinders or "",
+          "transmission": usercar.transmission or ""}),
+        ("GET /logout", "GET", "/logout", None),
+        ("POST /process-signup", "POST", "/process-signup",
+         {"email": "benchmark@example.com", "password": "password",
+          "name": "Benchmark"}),
+        ("POST /process-login", "POST", "/process-login",
+         {"email": User.query.get(user_id).email, "password": "password"}),
+        ]
+
+
+def get_aggregates(user_id, year):
+    """Get the (label, calculation) of every CO2 aggregate, for a user's data
+    in a year."""
+
+    usercar = UserCar.query.filter_by(user_id=user_id).first()
+    start_date = "1/1/%s" % year
+    end_date = "12/31/%s" % year
+
+    return [
+        ("TripLog.sum_trip_co2", lambda: TripLog.sum_trip_co2(user_id)),
+        ("TripLog.sum_trip_co2 per car",
+         lambda: TripLog.sum_trip_co2(user_id, start_date, end_date,
+                                      usercar.usercar_id)),
+        ("TripLog.sum_trip_co2 from logs",
+         lambda: TripLog.sum_trip_co2(user_id, from_timeline=False)),
+        ("TripLog.sum_trip_co2_per_month",
+         lambda: TripLog.sum_trip_co2_per_month(user_id, year)),
+        ("TripLog.get_co2_per_yr", lambda: TripLog.get_co2_per_yr(user_id)),
+        ("TripLog.sum_trip_co2_other_car",
+         lambda: TripLog.sum_trip_co2_other_car(
+             user_id, "Toyota", "Prius", 2004, None, None)),
+        ("TripLog.get_trip_years", lambda: TripLog.get_trip_years(user_id)),
+        ("TripLog.calculate_total_co2_per_day_of_week",
+         lambda: TripLog.calculate_total_co2_per_day_of_week(user_id)),
+        ("TripLog.get_trip_summary",
+         lambda: TripLog.get_trip_summary(user_id)),
+        ("TripLog.get_monthly_miles",
+         lambda: TripLog.get_monthly_miles(user_id)),
+        ("TripLog.get_page",
+         lambda: [trip.usercar.usercar_id
+                  for trip in TripLog.get_page(user_id)[0]]),
+        ("UserCar.get_avg_grams_co2_mile_factors",
+         lambda: UserCar.get_avg_grams_co2_mile_factors(user_id)),
+        ("ElectricityLog.sum_kwh_co2",
+         lambda: ElectricityLog.sum_kwh_co2(user_id)),
+        ("ElectricityLog.sum_kwh_co2 from logs",
+         lambda: ElectricityLog.sum_kwh_co2(user_id, from_timeline=False)),
+        ("ElectricityLog.sum_kwh_co2_per_month",
+         lambda: ElectricityLog.sum_kwh_co2_per_month(user_id, year)),
+        ("ElectricityLog.sum_kwh_per_month",
+         lambda: ElectricityLog.sum_kwh_per_month(user_id, year)),
+        ("ElectricityLog.get_co2_per_yr",
+         lambda: ElectricityLog.get_co2_per_yr(user_id)),
+        ("ElectricityLog.sum_kwh_co2_other_location",
+         lambda: ElectricityLog.sum_kwh_co2_other_location(user_id, "94133")),
+        ("ElectricityLog.get_kwh_years",
+         lambda: ElectricityLog.get_kwh_years(user_id)),
+        ("ElectricityLog.calculate_total_co2_per_day_of_week",
+         lambda: ElectricityLog.calculate_total_co2_per_day_of_week(user_id)),
+        ("ElectricityLog.get_electricity_summary",
+         lambda: ElectricityLog.get_electricity_summary(user_id)),
+        ("ElectricityLog.get_page",
+         lambda: [log.co2_calc()
+                  for log in ElectricityLog.get_page(user_id)[0]]),
+        ("NGLog.sum_ng_co2", lambda: NGLog.sum_ng_co2(user_id)),
+        ("NGLog.sum_ng_co2 from logs",
+         lambda: NGLog.sum_ng_co2(user_id, from_timeline=False)),
+        ("NGLog.sum_ng_co2_per_month",
+         lambda: NGLog.sum_ng_co2_per_month(user_id, year)),
+        ("NGLog.get_co2_per_yr", lambda: NGLog.get_co2_per_yr(user_id)),
+        ("NGLog.get_ng_years", lambda: NGLog.get_ng_years(user_id)),
+        ("NGLog.get_ng_summary", lambda: NGLog.get_ng_summary(user_id)),
+        ("NGLog.get_page",
+         lambda: [log.co2_calc() for log in NGLog.get_page(user_id)[0]]),
+        ("DailyCO2Rollup.sum_co2",
+         lambda: DailyCO2Rollup.sum_co2(user_id, "trip")),
+        ("DailyCO2Rollup.sum_co2_per_yr",
+         lambda: DailyCO2Rollup.sum_co2_per_yr(user_id, "kwh")),
+        ("Region.get_factors", lambda: Region.get_factors()),
+        ]
+
+
+def clear_caches():
+    """Forget the cached CO2 timelines and car factors and the session's
+    objects, as if the user's data had just changed."""
+
+    invalidate_co2_timelines()
+    Car.invalidate_factor_cache()
+    db.session.expunge_all()
+
+
+def get_median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+
+    if len(values) % 2:
+        return values[middle]
+
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def time_runs(run, repeat):
+    """Time repeat cold and warm runs of run(), which returns the number of
+    queries it took and a status. Returns the median times in milliseconds,
+    the queries and the status of the last cold run."""
+
+    cold = []
+    warm = []
+
+    for _ in range(repeat):
+        clear_caches()
+        start = default_timer()
+        queries, status = run()
+        cold.append(default_timer() - start)
+
+        start = default_timer()
+        run()
+        warm.append(default_timer() - start)
+
+    return {"cold_ms": round(get_median(cold) * 1000, 2),
+            "warm_ms": round(get_median(warm) * 1000, 2),
+            "queries": queries,
+            "status": status}
+
+
+def time_routes(client, user_id, routes, repeat):
+    """Time every route as the user with the Flask test client."""
+
+    def request(method, url, data):
+        def run():
+            # log back in, in case the last route logged out
+            with client.session_transaction() as sess:
+                sess["user_id"] = user_id
+
+            body = data() if callable(data) else data
+
+            if method == "GET":
+                resp = client.get(url)
+            elif isinstance(body, basestring):
+                resp = client.post(url, data=body,
+                                   content_type="application/json")
+            else:
+                resp = client.post(url, data=body)
+
+            return int(resp.headers.get("X-Query-Count", 0)), resp.status_code
+
+        return run
+
+    return dict((label, time_runs(request(method, url, data), repeat))
+                for label, method, url, data in routes)
+
+
+def time_aggregates(aggregates, repeat):
+    """Time every aggregate."""
+
+    def calculation(calculate):
+        def run():
+            stats = request_stats.start_request()
+            calculate()
+            request_stats.finish_request("benchmark")
+            return stats.queries, "ok"
+
+        return run
+
+    return dict((label, time_runs(calculation(calculate), repeat))
+                for label, calculate in aggregates)
+
+
+def count_rows():
+    """The number of rows of the user data tables."""
+
+    return dict((model.__tablename__, model.query.count())
+                for model in [User, Residence, UserCar, TripLog,
+                              ElectricityLog, NGLog, DailyCO2Rollup])
+
+
+def run_scale(app, scale, repeat=5, years=3, seed_number=1):
+    """Fill the empty database with a scale of synthetic users and time every
+    route and aggregate for the first of them."""
+
+    start = default_timer()
+    synthetic_data.generate(USERS_PER_SCALE * scale, years, seed_number)
+    generate_seconds = default_timer() - start
+
+    user_id = db.session.query(db.func.min(User.user_id)).scalar()
+    year = synthetic_data.END_DAY.year - 1
+
+    results = {"scale": scale,
+               "rows": count_rows(),
+               "generate_seconds": round(generate_seconds, 1)}
+
+    results["aggregates"] = time_aggregates(get_aggregates(user_id, year),
+                                            repeat)
+
+    client = app.test_client()
+    results["routes"] = time_routes(client, user_id,
+                                    get_routes(user_id, year), repeat)
+
+    return results
+
+
+def get_version():
+    """The git commit that was benchmarked, None outside of a checkout."""
+
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"]).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_change(result, baseline):
+    """Describe a cold time against the baseline's, marking regressions in
+    bold."""
+
+    if not baseline:
+        return "new"
+
+    difference = result["cold_ms"] - baseline["cold_ms"]
+    change = difference / (baseline["cold_ms"] or 1)
+    text = "%+d%%" % round(change * 100)
+
+    if result["queries"] > baseline["queries"]:
+        text += ", %+d queries" % (result["queries"] - baseline["queries"])
+        return "**%s**" % text
+
+    if change > REGRESSION_THRESHOLD and difference > NOISE_MS:
+        return "**%s**" % text
+
+    return text
+
+
+def write_markdown(report, baseline=None):
+    """Write a report as markdown tables of the routes and aggregates, with a
+    column per scale and, if there is a baseline report, the change of each
+    cold time."""
+
+    baseline_scales = dict((results["scale"], results)
+                           for results in (baseline or {}).get("scales", []))
+
+    lines = ["# Benchmark %s" % (report["version"] or ""), "",
+             "%s, median of %s runs, times in ms as cold / warm (queries)." %
+             (report["created"], report["repeat"])]
+
+    if baseline:
+        lines.append("Changes are of the cold times against %s, regressions "
+                     "in bold." % (baseline["version"] or "the baseline"))
+
+    lines.append("")
+    lines.append("| Scale | " + " | ".join(
+        sorted(report["scales"][0]["rows"])) + " |")
+    lines.append("|---|" + "---:|" * len(report["scales"][0]["rows"]))
+    for results in report["scales"]:
+        lines.append("| %sx | " % results["scale"] + " | ".join(
+            str(count) for table, count in sorted(results["rows"].items())) +
+            " |")
+
+    for kind in ["routes", "aggregates"]:
+        header = ["| %s |" % kind.capitalize()]
+        rule = ["|---|"]
+        for results in report["scales"]:
+            header.append(" %sx |" % results["scale"])
+            rule.append("---:|")
+            if results["scale"] in baseline_scales:
+                header.append(" %sx change |" % results["scale"])
+                rule.append("---:|")
+
+        lines.extend(["", "".join(header), "".join(rule)])
+
+        for label in sorted(report["scales"][0][kind]):
+            row = ["| %s |" % label]
+            for results in report["scales"]:
+                result = results[kind][label]
+                row.append(" %s / %s (%s) |" % (result["cold_ms"],
+                                                 result["warm_ms"],
+                                                 result["queries"]))
+                if results["scale"] in baseline_scales:
+                    row.append(" %s |" % get_change(
+                        result,
+                        baseline_scales[results["scale"]][kind].get(label)))
+            lines.append("".join(row))
+
+    return "\n".join(lines) + "\n"
+
+
+def run(app, scales, repeat=5, years=3, seed_number=1):
+    """Benchmark each scale in an emptied database. Returns the report."""
+
+    report = {"version": get_version(),
+              "created": datetime.now().strftime("%Y-%m-%d %H:%M"),
+              "repeat": repeat,
+              "years": years,
+              "scales": []}
+
+    resolver = server.distance_resolver
+    server.distance_resolver = DistanceResolver(
+        FixtureDistanceProvider(DISTANCES),
+        LRUCache("benchmark_distances", 10))
+
+    try:
+        for scale in scales:
+            print "\n Benchmark %sx \n" % scale
+
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+
+            report["scales"].append(run_scale(app, scale, repeat, years,
+                                              seed_number))
+    finally:
+        server.distance_resolver = resolver
+
+    return report
+
+
+def make_rows(count, cars=5):
+    """Make count random trip rows of (date, miles, usercar id)."""
+
+    first_day = date(2010, 1, 1)
+
+    return [(first_day + timedelta(days=random.randint(0, 3000)),
+             round(random.uniform(1, 300), 1),
+             random.randint(1, cars))
+            for i in xrange(count)]
+
+
+def scalar_summary(rows, factors, years):
+    """Yearly totals, monthly totals of the last year and the day of the week
+    split with Python loops over every row, one pass per sum like the scalar
+    model methods."""
+
+    co2_per_year = {}
+    for year in years:
+        total_co2 = 0
+        for day, miles, usercar_id in rows:
+            if day.year == year:
+                total_co2 += miles * factors[usercar_id]
+        co2_per_year[year] = round(total_co2, 2)
+
+    co2_per_month = [0] * 12
+    for day, miles, usercar_id in rows:
+        if day.year == years[-1]:
+            co2_per_month[day.month - 1] += miles * factors[usercar_id]
+
+    co2_by_day_of_week = {0: 0, 1: 0, 2: 0, 3: 0, 4: 0, 5: 0, 6: 0}
+    for day, miles, usercar_id in rows:
+        co2_by_day_of_week[day.weekday()] += round(
+            miles * factors[usercar_id], 0)
+
+    return co2_per_year, [round(co2, 2) for co2 in co2_per_month], \
+        co2_by_day_of_week
+
+
+def vectorized_summary(arrays, years):
+    """The same summary as scalar_summary with the vectorized kernel."""
+
+    return arrays.per_year(), arrays.per_month(years[-1]), \
+        arrays.per_day_of_week()
+
+
+def time_kernel(row_counts):
+    """Time the scalar loops and the vectorized kernel for each row count.
+    Building the arrays from the rows is timed separately from the sums."""
+
+    factors = {usercar_id: random.uniform(150, 600) * 0.00220
+               for usercar_id in range(1, 6)}
+
+    print "%10s %12s %12s %12s %10s" % ("rows", "scalar (s)", "load (s)",
+                                        "vector (s)", "speedup")
+
+    for count in row_counts:
+        rows = make_rows(count)
+        years = sorted(set(row[0].year for row in rows))
+
+        start = default_timer()
+        scalar_per_year = scalar_summary(rows, factors, years)[0]
+        scalar_seconds = default_timer() - start
+
+        start = default_timer()
+        arrays = LogArrays.from_rows(rows, factors.get)
+        load_seconds = default_timer() - start
+
+        start = default_timer()
+        vector_per_year = vectorized_summary(arrays, years)[0]
+        vector_seconds = default_timer() - start
+
+        for year in years:
+            assert abs(scalar_per_year[year] - vector_per_year[year]) < 1
+
+        print "%10d %12.3f %12.3f %12.3f %9.1fx" % (
+            count, scalar_seconds, load_seconds, vector_seconds,
+            scalar_seconds / (load_seconds + vector_seconds))
+
+
+if __name__ == "__main__":
+    from model import connect_to_db
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--years", type=float, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="benchmark-report")
+    parser.add_argument("--compare", help="report.json of an earlier run")
+    parser.add_argument("--kernel", type=int, nargs="+", metavar="ROWS",
+                        help="only time the vectorized kernel on ROWS trips")
+    args = parser.parse_args()
+
+    if args.kernel:
+        time_kernel(args.kernel)
+        raise SystemExit()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    app = server.app
+    connect_to_db(app, os.environ.get("BENCHMARK_DB",
+                                      "postgresql:///carbon_calc_bench"))
+
+    report = run(app, args.scales, args.repeat, args.years, args.seed)
+
+    with open(args.output + ".json", "w") as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+
+    markdown = write_markdown(report, baseline)
+    with open(args.output + ".md", "w") as report_file:
+        report_file.write(markdown)
+
+    print markdown
@@ -0,0 +1,142 @@
+"""Bulk loading of seed data with PostgreSQL COPY."""
+
+from cStringIO import StringIO
+import logging
+import time
+from model import db
+
+log = logging.getLogger("carbon_calc.bulk_load")
+log.addHandler(logging.NullHandler())  # silent unless logging is configured
+
+
+def copy_value(value):
+    """Format a value for the PostgreSQL COPY text format."""
+
+    if value is None:
+        return "\\N"
+
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t") \
+        .replace("\n", "\\n").replace("\r", "\\r")
+
+
+class BulkLoader(object):
+    """Stream rows into a table in fixed size chunks. Chunks are sent with COPY
+    on PostgreSQL and with executemany on any other database, so only one
+    chunk is held in memory at a time. Rows are written with the session's
+    connection and are committed along with the rest of the session.
+
+    before_write(chunk) is called with each chunk of value tuples before it is
+    written, e.g. to delete rows that the chunk replaces."""
+
+    def __init__(self, table, columns, chunk_size=5000, use_copy=True,
+                 max_errors=10, before_write=None):
+        self.table = table
+        self.columns = columns
+        self.chunk_size = chunk_size
+        self.use_copy = use_copy
+        self.max_errors = max_errors
+        self.before_write = before_write
+        self.loaded = 0
+        self.rejected = 0
+        self.errors = []
+        self.seconds = 0
+
+    def __repr__(self):
+        return "<BulkLoader Table=%s, Loaded=%s, Rejected=%s>" % \
+            (self.table.name, self.loaded, self.rejected)
+
+    def load(self, records, convert=None):
+        """Load an iterable of records. convert(record) turns each record into
+        a tuple of values in column order and raises ValueError, KeyError or
+        TypeError for rows that are not valid; those rows are skipped and
+        counted as rejected. Returns the number of rows loaded."""
+
+        start = time.time()
+        chunk = []
+
+        for row_number, record in enumerate(records, 1):
+            try:
+                values = convert(record) if convert else tuple(record)
+                if len(values) != len(self.columns):
+                    raise ValueError("expected %s values, got %s" %
+                                     (len(self.columns), len(values)))
+            except (ValueError, KeyError, TypeError) as e:
+                self.reject(row_number, e)
+                continue
+
+            chunk.append(values)
+
+            if len(chunk) >= self.chunk_size:
+                self.write_chunk(chunk)
+                chunk = []
+
+        if chunk:
+            self.write_chunk(chunk)
+
+        self.seconds = time.time() - start
+        self.report()
+
+        return self.loaded
+
+    def reject(self, row_number, error):
+        """Count a row that failed validation and keep the first few errors."""
+
+        self.rejected += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append("row %s: %s" % (row_number, error))
+
+    def write_chunk(self, chunk):
+        """Insert a chunk of value tuples into the table."""
+
+        if self.before_write:
+            self.before_write(chunk)
+
+        connection = db.session.connection()
+
+        if self.use_copy and connection.dialect.name == "postgresql":
+            buf = StringIO()
+            for values in chunk:
+                buf.write("\t".join(copy_value(value) for value in values))
+                buf.write("\n")
+            buf.seek(0)
+
+            cursor = connection.connection.cursor()
+            cursor.copy_expert("COPY %s (%s) FROM STDIN" %
+                               (self.table.name, ", ".join(self.columns)), buf)
+            cursor.close()
+        else:
+            connection.execute(self.table.insert(),
+                               [dict(zip(self.columns, values))
+                                for values in chunk])
+
+        self.loaded += len(chunk)
+
+    def rows_per_second(self):
+        """Loading rate of the last load."""
+
+        if not self.seconds:
+            return float(self.loaded)
+
+        return self.loaded / self.seconds
+
+    def report(self):
+        """Log how many rows were loaded and rejected and how fast."""
+
+        log.info("Loaded %s rows into %s in %.2fs (%d rows/s), %s rejected",
+                 self.loaded, self.table.name, self.seconds,
+                 self.rows_per_second(), self.rejected)
+
+        for error in self.errors:
+            log.info("  rejected %s", error)
+
+
+def blank_to_none(value, convert=str):
+    """Convert a CSV field, treating an empty field as NULL."""
+
+    if value is None or value.strip() == "":
+        return None
+
+    return convert(value)
@@ -0,0 +1,324 @@
+"""In-process and on-disk caches shared by the models and the server."""
+
+from collections import OrderedDict
+from threading import Lock, Event
+import json
+import os
+import sqlite3
+import time
+
+# every cache created in the process, so their counters can be reported
+caches = []
+_caches_lock = Lock()
+
+
+def register_cache(cache):
+    """Add a cache to the caches reported by get_cache_stats(). A name that
+    another cache already has is numbered, e.g. distances_2, so neither
+    cache's counters hide the other's."""
+
+    with _caches_lock:
+        names = set(registered.name for registered in caches)
+        name = cache.name
+        number = 1
+        while cache.name in names:
+            number += 1
+            cache.name = "%s_%s" % (name, number)
+        caches.append(cache)
+
+
+class LRUCache(object):
+    """A thread-safe, size bounded least recently used cache that keeps count
+    of its hits and misses."""
+
+    def __init__(self, name, maxsize=1024):
+        self.name = name
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # counts the invalidations, so a value loaded while one happened
+        # isn't stored
+        self.generation = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+        register_cache(self)
+
+    def __repr__(self):
+        return "<LRUCache Name=%s, Size=%s/%s, Hits=%s, Misses=%s>" % \
+            (self.name, len(self._data), self.maxsize, self.hits, self.misses)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, loader):
+        """Return the cached value for key. On a miss the value is computed
+        by calling loader() and stored, evicting the least recently used
+        entry if the cache is full. A value is not stored if the cache was
+        invalidated while it was being loaded, as it may be from before the
+        change."""
+
+        with self._lock:
+            if key in self._data:
+                value = self._data.pop(key)
+                self._data[key] = value
+                self.hits += 1
+                return value
+            self.misses += 1
+            generation = self.generation
+
+        # load outside of the lock so a slow query doesn't block other keys
+        value = loader()
+
+        with self._lock:
+            if generation != self.generation:
+                return value
+
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+        return value
+
+    def invalidate(self, key=None):
+        """Drop one key from the cache, or everything if no key is given."""
+
+        with self._lock:
+            self.generation += 1
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def stats(self):
+        """Get the hit/miss counters and size of the cache as a dictionary."""
+
+        return {"name": self.name,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses}
+
+
+class LazyIndex(object):
+    """A read-mostly lookup table that is loaded all at once by loader() the
+    first time it is used, and again after it is invalidated."""
+
+    def __init__(self, name, loader):
+        self.name = name
+        self.loader = loader
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self._data = None
+        self._lock = Lock()
+        register_cache(self)
+
+    def __repr__(self):
+        return "<LazyIndex Name=%s, Loaded=%s, Hits=%s, Misses=%s>" % \
+            (self.name, self._data is not None, self.hits, self.misses)
+
+    @property
+    def data(self):
+        """The loaded lookup table, loading it first if needed."""
+
+        data = self._data
+        if data is None:
+            with self._lock:
+                if self._data is None:
+                    self._data = self.loader()
+                    self.loads += 1
+                data = self._data
+
+        return data
+
+    def get(self, key, default=None):
+        """Look up a key, counting a miss if it is not in the index."""
+
+        value = self.data.get(key, default)
+
+        if value is default:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return value
+
+    def invalidate(self):
+        """Throw away the loaded table so the next lookup reloads it."""
+
+        with self._lock:
+            self._data = None
+
+    def stats(self):
+        """Get the hit/miss counters and size of the index as a dictionary."""
+
+        data = self._data
+        return {"name": self.name,
+                "size": len(data) if data is not None else 0,
+                "loads": self.loads,
+                "hits": self.hits,
+                "misses": self.misses}
+
+
+class DiskCache(object):
+    """A size bounded cache of JSON values in a SQLite file, so entries outlive
+    the server process. Entries expire ttl seconds after they are stored, and
+    the least recently used entries are evicted past maxsize."""
+
+    def __init__(self, name, path, maxsize=10000, ttl=30 * 24 * 60 * 60):
+        self.name = name
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._created = False
+        register_cache(self)
+
+    def __repr__(self):
+        return "<DiskCache Name=%s, Path=%s, Hits=%s, Misses=%s>" % \
+            (self.name, self.path, self.hits, self.misses)
+
+    def __len__(self):
+        with self._lock:
+            connection = self._connect()
+            count = connection.execute("SELECT COUNT(*) FROM cache") \
+                .fetchone()[0]
+            connection.close()
+
+        return count
+
+    def _connect(self):
+        # a connection per call, SQLite connections can't be shared by threads
+        connection = sqlite3.connect(self.path, timeout=5)
+
+        # the file is only created once the cache is used
+        if not self._created:
+            connection.execute("""CREATE TABLE IF NOT EXISTS cache (
+                                  key TEXT PRIMARY KEY,
+                                  value TEXT NOT NULL,
+                                  stored REAL NOT NULL,
+                                  used REAL NOT NULL)""")
+            connection.execute("""CREATE INDEX IF NOT EXISTS ix_cache_used
+                                  ON cache (used)""")
+            connection.commit()
+            self._created = True
+
+        return connection
+
+    def get(self, key, loader):
+        """Return the cached value for key. On a miss or an expired entry the
+        value is computed by calling loader() and stored. Values must be
+        JSON serializable."""
+
+        now = time.time()
+
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute(
+                "SELECT value FROM cache WHERE key = ? AND stored > ?",
+                (key, now - self.ttl)).fetchone()
+
+            if row is not None:
+                connection.execute("UPDATE cache SET used = ? WHERE key = ?",
+                                   (now, key))
+                connection.commit()
+                self.hits += 1
+            else:
+                self.misses += 1
+            connection.close()
+
+        if row is not None:
+            return json.loads(row[0])
+
+        value = loader()
+        self.set(key, value)
+
+        return value
+
+    def set(self, key, value):
+        """Store a value, evicting the least recently used entries if the
+        cache is full."""
+
+        now = time.time()
+
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now))
+            connection.execute(
+                """DELETE FROM cache WHERE key IN (
+                   SELECT key FROM cache ORDER BY used DESC
+                   LIMIT -1 OFFSET ?)""", (self.maxsize,))
+            connection.commit()
+            connection.close()
+
+    def invalidate(self, key=None):
+        """Drop one key from the cache, or everything if no key is given."""
+
+        with self._lock:
+            connection = self._connect()
+            if key is None:
+                connection.execute("DELETE FROM cache")
+            else:
+                connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+            connection.commit()
+            connection.close()
+
+    def stats(self):
+        """Get the hit/miss counters and size of the cache as a dictionary."""
+
+        # don't create the file just to say it is empty
+        size = len(self) if os.path.exists(self.path) else 0
+
+        return {"name": self.name,
+                "size": size,
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses}
+
+
+class SingleFlight(object):
+    """Collapses concurrent calls for the same key into one, so identical
+    lookups that are already in flight wait for its result instead of making
+    their own request."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = Lock()
+
+    def do(self, key, function):
+        """Call function() unless a call for key is already running, in which
+        case wait for it and share its result or exception."""
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": Event()}
+
+        if not leader:
+            call["done"].wait()
+            if "error" in call:
+                raise call["error"]
+            return call["value"]
+
+        try:
+            call["value"] = function()
+            return call["value"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+
+
+def get_cache_stats():
+    """Get the stats of every cache in the process, keyed by cache name."""
+
+    return {cache.name: cache.stats() for cache in caches}
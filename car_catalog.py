@@ -0,0 +1,200 @@
+"""In-memory indexes of the EPA vehicle catalog: the tree behind the car
+dropdowns and the cars ranked by CO2 for the recommendations."""
+
+import hashlib
+import json
+import numpy as np
+
+# levels of the tree, in order
+LEVELS = ["make", "model", "year", "cylinders", "transmission"]
+
+
+class CarCatalog(object):
+    """The distinct cars of the catalog as a make > model > year > cylinders >
+    transmissions tree. Missing cylinders and transmissions are stored as "".
+    The catalog is read only once built, so its JSON and ETag are worked out
+    once and shared by every request."""
+
+    def __init__(self, cars):
+        self.tree = {}
+        self.count = 0
+
+        for make, model, year, cylinders, transmission in cars:
+            transmissions = self.tree.setdefault(make, {}) \
+                .setdefault(model, {}) \
+                .setdefault(year, {}) \
+                .setdefault(cylinders or "", [])
+
+            if (transmission or "") not in transmissions:
+                transmissions.append(transmission or "")
+                self.count += 1
+
+        for models in self.tree.values():
+            for years in models.values():
+                for cylinders in years.values():
+                    for transmissions in cylinders.values():
+                        transmissions.sort()
+
+        self.makes = sorted(self.tree)
+        self.json = json.dumps(self.tree, sort_keys=True)
+        self.version = hashlib.md5(self.json).hexdigest()
+
+    def __repr__(self):
+        return "<CarCatalog Makes=%s, Cars=%s, Version=%s>" % \
+            (len(self.makes), self.count, self.version)
+
+    def __len__(self):
+        return self.count
+
+    def get(self, make, default=None):
+        """Get the model > year > cylinders > transmissions tree of a make."""
+
+        return self.tree.get(make, default)
+
+    def get_slice(self, *path):
+        """Get the part of the tree below a path of level values, e.g.
+        ("Toyota", "Prius") for the years of the Prius. Returns None if the
+        path isn't in the catalog."""
+
+        branch = self.tree
+
+        for level, value in zip(LEVELS, path):
+            if level == "year":
+                try:
+                    value = int(value)
+                except ValueError:
+                    return None
+
+            branch = branch.get(value)
+            if branch is None:
+                return None
+
+        return branch
+
+    def get_slice_etag(self, *path):
+        """ETag of a slice, which changes whenever the catalog does."""
+
+        if not path:
+            return self.version
+
+        return hashlib.md5(json.dumps([self.version] + list(path))) \
+            .hexdigest()
+
+    def find(self, make=None, model=None, year=None, cylinders=None,
+             transmission=None):
+        """Get the distinct cars that match the given values as dictionaries,
+        like a DISTINCT query over the catalog filtered on the values that are
+        given."""
+
+        if year:
+            year = int(year)
+
+        cars = []
+
+        for car_make in ([make] if make else self.makes):
+            for car_model, years in self.tree.get(car_make, {}).items():
+                if model and car_model != model:
+                    continue
+                for car_year, cylinders_list in years.items():
+                    if year and car_year != year:
+                        continue
+                    for car_cylinders, transmissions in cylinders_list.items():
+                        if cylinders and car_cylinders != cylinders:
+                            continue
+                        for car_transmission in transmissions:
+                            if transmission and \
+                                    car_transmission != transmission:
+                                continue
+                            cars.append({"make": car_make,
+                                         "model": car_model,
+                                         "year": car_year,
+                                         "cylinders": car_cylinders,
+                                         "transmission": car_transmission})
+
+        return cars
+
+
+class CarEmissionsIndex(object):
+    """Every car of the catalog with a CO2 rating, sorted once from the lowest
+    to the highest grams of CO2 per mile. Each make, fuel type and drive keeps
+    the sorted positions of its cars, so the top k cars of a filter are the
+    first k positions left after intersecting a few short arrays, instead of a
+    scan and sort of the whole catalog."""
+
+    # fields of each car, in the order they are loaded
+    FIELDS = ["car_id", "make", "model", "year", "cylinders", "transmission",
+              "fuel_type", "drive", "grams_co2_mile", "mpg_combo"]
+
+    def __init__(self, cars):
+        # cars without a tailpipe CO2 rating can't be ranked
+        self.cars = sorted((car for car in cars
+                            if car[8] is not None and car[8] >= 0),
+                           key=lambda car: (car[8], car[0]))
+
+        # cars with no tailpipe CO2, like electric cars, sort first
+        self.zero_rated = sum(1 for car in self.cars if car[8] == 0)
+
+        self.years = np.array([car[3] for car in self.cars], dtype=np.int32)
+        self.positions = {"make": {}, "fuel_type": {}, "drive": {}}
+
+        for position, car in enumerate(self.cars):
+            for level, value in (("make", car[1]), ("fuel_type", car[6]),
+                                 ("drive", car[7])):
+                self.positions[level].setdefault(value, []).append(position)
+
+        for values in self.positions.values():
+            for value, positions in values.items():
+                values[value] = np.array(positions, dtype=np.int32)
+
+    def __repr__(self):
+        return "<CarEmissionsIndex Cars=%s>" % len(self.cars)
+
+    def __len__(self):
+        return len(self.cars)
+
+    def get_values(self, level):
+        """Get the distinct makes, fuel types or drives, sorted."""
+
+        return sorted(value for value in self.positions[level] if value)
+
+    def find_lowest(self, k=10, make=None, fuel_type=None, drive=None,
+                    min_year=None, max_year=None, include_zero=False):
+        """Get the k cars with the lowest grams of CO2 per mile that match the
+        filters that are given, as dictionaries, lowest first. Cars rated at 0
+        grams are left out unless include_zero is True."""
+
+        positions = None
+
+        for level, value in (("make", make), ("fuel_type", fuel_type),
+                             ("drive", drive)):
+            if not value:
+                continue
+
+            level_positions = self.positions[level].get(value)
+            if level_positions is None:
+                return []
+
+            if positions is None:
+                positions = level_positions
+            else:
+                positions = np.intersect1d(positions, level_positions,
+                                           assume_unique=True)
+
+        if positions is None:
+            positions = np.arange(len(self.cars), dtype=np.int32)
+
+        if not include_zero:
+            positions = positions[np.searchsorted(positions,
+                                                  self.zero_rated):]
+
+        if min_year or max_year:
+            years = self.years[positions]
+            in_range = np.ones(len(positions), dtype=bool)
+            if min_year:
+                in_range &= years >= int(min_year)
+            if max_year:
+                in_range &= years <= int(max_year)
+            positions = positions[in_range]
+
+        return [dict(zip(self.FIELDS, self.cars[position]))
+                for position in positions[:k]]
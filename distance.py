@@ -0,0 +1,175 @@
+"""Driving distances for trips.
+
+Distances come from a provider, the Google Distance Matrix API in production
+or a fixture file in tests and benchmarks, and are kept in an on-disk cache
+so commutes that users enter again and again are only looked up once.
+
+    DISTANCE_PROVIDER=fixture DISTANCE_FIXTURES=distances.json
+"""
+
+import json
+import os
+import requests
+from threading import Lock
+from cache import DiskCache, SingleFlight
+
+METERS_TO_MILES = 0.00062137  # 0.00062137 miles in 1 meter
+
+GOOGLE_DISTANCE_URL = "https://maps.googleapis.com/maps/api/distancematrix/json"
+
+# seconds to connect and to wait for the response
+TIMEOUT = (3.05, 10)
+
+
+class DistanceError(Exception):
+    """The distance between two places couldn't be found."""
+
+
+class DistanceConfigError(Exception):
+    """No distance can be looked up, e.g. because GOOGLE_API_KEY isn't set.
+    Unlike a DistanceError it isn't about the places, so it isn't reported as
+    a bad trip."""
+
+
+def normalize_place(place):
+    """Lower case a place and collapse its whitespace, so the same address
+    typed slightly differently shares a cache entry."""
+
+    return " ".join((place or "").lower().replace(",", ", ").split())
+
+
+def get_distance_key(origin, destination, mode="driving"):
+    """Cache key of a distance lookup."""
+
+    return json.dumps([normalize_place(origin), normalize_place(destination),
+                       mode])
+
+
+class GoogleDistanceProvider(object):
+    """Looks distances up with the Google Distance Matrix API, reusing pooled
+    connections between requests."""
+
+    def __init__(self, api_key=None, timeout=TIMEOUT):
+        self.api_key = api_key or os.environ.get("GOOGLE_API_KEY")
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.requests = 0
+        self._lock = Lock()
+
+    def __repr__(self):
+        return "<GoogleDistanceProvider Requests=%s>" % self.requests
+
+    def get_meters(self, origin, destination, mode="driving"):
+        """Get the distance between two places in meters. Raises
+        DistanceConfigError if there is no API key."""
+
+        if not self.api_key:
+            raise DistanceConfigError("GOOGLE_API_KEY is not set")
+
+        payload = {"units": "imperial",
+                   "origins": origin,
+                   "destinations": destination,
+                   "key": self.api_key,
+                   "mode": mode
+                   }
+
+        with self._lock:
+            self.requests += 1
+
+        try:
+            r = self.session.get(GOOGLE_DISTANCE_URL, params=payload,
+                                 timeout=self.timeout)
+            r.raise_for_status()
+            distance_info = r.json()
+            return distance_info["rows"][0]["elements"][0]["distance"]["value"]
+        except (requests.RequestException, ValueError, KeyError,
+                IndexError) as e:
+            raise DistanceError("no distance from %r to %r: %s" %
+                                (origin, destination, e))
+
+
+class FixtureDistanceProvider(object):
+    """Stands in for the Google API with known distances, from a dictionary
+    of {key: meters} or a JSON file of [origin, destination, meters] rows."""
+
+    def __init__(self, distances=None, path=None, mode="driving"):
+        self.distances = {}
+        self.requests = 0
+        self._lock = Lock()
+
+        if path:
+            with open(path) as fixture_file:
+                for origin, destination, meters in json.load(fixture_file):
+                    self.add(origin, destination, meters, mode)
+
+        for (origin, destination), meters in (distances or {}).items():
+            self.add(origin, destination, meters, mode)
+
+    def __repr__(self):
+        return "<FixtureDistanceProvider Distances=%s, Requests=%s>" % \
+            (len(self.distances), self.requests)
+
+    def add(self, origin, destination, meters, mode="driving"):
+        """Add a known distance."""
+
+        self.distances[get_distance_key(origin, destination, mode)] = meters
+
+    def get_meters(self, origin, destination, mode="driving"):
+        """Get the distance between two places in meters."""
+
+        # lookups run on several threads at once
+        with self._lock:
+            self.requests += 1
+
+        meters = self.distances.get(get_distance_key(origin, destination,
+                                                     mode))
+        if meters is None:
+            raise DistanceError("no distance from %r to %r" %
+                                (origin, destination))
+
+        return meters
+
+
+class DistanceResolver(object):
+    """Resolves distances through a provider, caching them on disk and
+    collapsing identical lookups that are in flight at the same time."""
+
+    def __init__(self, provider, cache):
+        self.provider = provider
+        self.cache = cache
+        self.in_flight = SingleFlight()
+
+    def __repr__(self):
+        return "<DistanceResolver Provider=%r, Cache=%r>" % (self.provider,
+                                                            self.cache)
+
+    def get_miles(self, origin, destination, mode="driving"):
+        """Get the distance between two places in miles, rounded to 2
+        decimals. Raises DistanceError if it can't be found, or
+        DistanceConfigError if the provider can't look anything up."""
+
+        key = get_distance_key(origin, destination, mode)
+
+        def lookup():
+            return self.provider.get_meters(origin, destination, mode)
+
+        meters = self.in_flight.do(key, lambda: self.cache.get(key, lookup))
+
+        return round(meters * METERS_TO_MILES, 2)
+
+
+def make_distance_resolver():
+    """Set up the resolver from the environment. DISTANCE_PROVIDER=fixture
+    uses the distances in the DISTANCE_FIXTURES file instead of Google, and
+    DISTANCE_CACHE sets the cache file."""
+
+    if os.environ.get("DISTANCE_PROVIDER") == "fixture":
+        provider = FixtureDistanceProvider(
+            path=os.environ.get("DISTANCE_FIXTURES"))
+    else:
+        provider = GoogleDistanceProvider()
+
+    cache = DiskCache("distances",
+                      os.environ.get("DISTANCE_CACHE", "distance-cache.sqlite"))
+
+    return DistanceResolver(provider, cache)
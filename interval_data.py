@@ -0,0 +1,232 @@
+"""Streaming import of utility interval data.
+
+Reads a PG&E style usage CSV or a Green Button (ESPI) XML export one interval
+at a time, collapses the intervals into daily totals and upserts them into
+electricity_log or ng_log for a residence.
+
+    python interval_data.py RESIDENCE_ID FILE [--type kwh|ng]
+"""
+
+import argparse
+import csv
+from datetime import datetime, date
+from itertools import groupby
+from xml.etree.cElementTree import iterparse
+from sqlalchemy import and_, func
+from bulk_load import BulkLoader
+from model import (db, User, ElectricityLog, NGLog, Residence,
+                   DailyCO2Rollup, expire_co2_timelines)
+
+ESPI = "{http://naesb.org/espi}"
+
+WATT_HOURS_UOM = "72"  # Green Button unit of measure code for Wh
+
+# usage type: (log model, usage column)
+USAGE_LOGS = {"kwh": (ElectricityLog, "kwh"),
+              "ng": (NGLog, "therms")}
+
+DATE_FORMATS = ["%Y-%m-%d", "%m/%d/%Y", "%m/%d/%y"]
+
+
+def parse_day(value):
+    """Convert the date of an interval into a date object."""
+
+    if isinstance(value, date):
+        return value
+
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), date_format).date()
+        except ValueError:
+            pass
+
+    raise ValueError("unknown date %r" % value)
+
+
+def read_usage_csv(csv_file):
+    """Yield (date, usage) for every interval row of a utility usage CSV. The
+    account details that utilities put above the column headers are
+    skipped."""
+
+    reader = csv.reader(csv_file)
+
+    for header in reader:
+        header = [column.strip().upper() for column in header]
+        if "DATE" in header and "USAGE" in header:
+            break
+    else:
+        return
+
+    date_column = header.index("DATE")
+    usage_column = header.index("USAGE")
+
+    for row in reader:
+        if len(row) > max(date_column, usage_column):
+            yield row[date_column], row[usage_column]
+
+
+def read_green_button(xml_file):
+    """Yield (date, usage) for every IntervalReading of a Green Button XML
+    export. Watt hours are converted to kWh and each interval is dated in the
+    feed's local time."""
+
+    power_of_ten = 0
+    uom = None
+    tz_offset = 0
+
+    for event, elem in iterparse(xml_file):
+        if elem.tag == ESPI + "powerOfTenMultiplier":
+            power_of_ten = int(elem.text)
+        elif elem.tag == ESPI + "uom":
+            uom = elem.text
+        elif elem.tag == ESPI + "tzOffset":
+            tz_offset = int(elem.text)
+        elif elem.tag == ESPI + "IntervalReading":
+            start = elem.findtext("%stimePeriod/%sstart" % (ESPI, ESPI))
+            value = elem.findtext(ESPI + "value")
+
+            usage = float(value) * 10 ** power_of_ten
+            if uom == WATT_HOURS_UOM:
+                usage = usage / 1000
+
+            day = datetime.utcfromtimestamp(int(start) + tz_offset).date()
+            yield day, usage
+
+            # readings are only needed once, so keep memory flat
+            elem.clear()
+        elif elem.tag == ESPI + "IntervalBlock":
+            elem.clear()
+
+
+def read_intervals(usage_file, filename=""):
+    """Pick the CSV or Green Button reader for an uploaded file."""
+
+    if filename.lower().endswith(".xml"):
+        return read_green_button(usage_file)
+
+    return read_usage_csv(usage_file)
+
+
+def parse_interval(interval):
+    """Parse the date and usage of an interval. An interval with an unknown
+    date or usage is returned as it is, to be rejected."""
+
+    day, usage = interval
+
+    try:
+        return parse_day(day), float(usage)
+    except (ValueError, TypeError, AttributeError):
+        return day, usage
+
+
+def group_usage_per_day(intervals):
+    """Total the usage of each run of consecutive intervals on the same day,
+    without reading ahead. Utility exports are in date order, so a day is
+    usually a single run; a day that comes back later in the file is yielded
+    again and merged when it is written. Intervals with an unknown date or
+    usage are passed through as they are, to be rejected."""
+
+    for day, day_intervals in groupby(
+            (parse_interval(interval) for interval in intervals),
+            key=lambda interval: interval[0]):
+        if not isinstance(day, date):
+            for interval in day_intervals:
+                yield interval
+            continue
+
+        yield day, sum(usage for day, usage in day_intervals)
+
+
+def load_daily_usage(usage_type, residence_id, intervals, chunk_size=1000):
+    """Collapse intervals into daily logs for a residence and upsert them in
+    chunks as the file is read. Daily logs already stored for the same days
+    are replaced, so loading an overlapping file again doesn't create
+    duplicates. Only the dates written so far are kept in memory, to tell a
+    day that comes back later in the file from a day stored by an earlier
+    upload. The changes are left in the session to be committed. Returns the
+    BulkLoader."""
+
+    log, usage_column = USAGE_LOGS[usage_type]
+    table = log.__table__
+    usage = getattr(table.c, usage_column)
+    days = set()
+    repeated_days = set()
+
+    def daily_values(day_usage):
+        day, usage = day_usage
+        day = parse_day(day)
+        return residence_id, float(usage), day, day
+
+    def replace_days(chunk):
+        chunk_days = set()
+        for values in chunk:
+            if values[2] in days or values[2] in chunk_days:
+                repeated_days.add(values[2])
+            chunk_days.add(values[2])
+
+        # a day already written by this upload keeps its rows, to be merged
+        new_days = chunk_days - days
+        days.update(new_days)
+
+        if new_days:
+            db.session.execute(table.delete().where(and_(
+                table.c.residence_id == residence_id,
+                table.c.start_date == table.c.end_date,
+                table.c.start_date.in_(new_days))))
+
+    def merge_days():
+        # upsert the days that came in more than one run into one log each
+        daily_usage = db.session.query(
+            table.c.start_date, func.sum(usage)).filter(
+                table.c.residence_id == residence_id,
+                table.c.start_date == table.c.end_date,
+                table.c.start_date.in_(repeated_days)) \
+            .group_by(table.c.start_date).all()
+
+        db.session.execute(table.delete().where(and_(
+            table.c.residence_id == residence_id,
+            table.c.start_date == table.c.end_date,
+            table.c.start_date.in_(repeated_days))))
+
+        db.session.execute(table.insert(), [
+            {"residence_id": residence_id, usage_column: day_usage,
+             "start_date": day, "end_date": day}
+            for day, day_usage in daily_usage])
+
+    loader = BulkLoader(table,
+                        ["residence_id", usage_column, "start_date",
+                         "end_date"],
+                        chunk_size=chunk_size, before_write=replace_days)
+    loader.load(group_usage_per_day(intervals), daily_values)
+
+    if repeated_days:
+        merge_days()
+
+    # Recalculate the residence's daily CO2 of the uploaded days in the same
+    # transaction
+    user_id = Residence.query.get(residence_id).user_id
+    if days:
+        DailyCO2Rollup.update_range(user_id, min(days), max(days),
+                                    [usage_type], residence_id)
+    expire_co2_timelines(user_id)
+    User.bump_data_version(user_id)
+
+    return loader
+
+
+if __name__ == "__main__":
+    from model import connect_to_db
+    from server import app
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("residence_id", type=int)
+    parser.add_argument("file")
+    parser.add_argument("--type", choices=sorted(USAGE_LOGS), default="kwh")
+    args = parser.parse_args()
+
+    connect_to_db(app)
+
+    with open(args.file) as usage_file:
+        load_daily_usage(args.type, args.residence_id,
+                         read_intervals(usage_file, args.file))
+    db.session.commit()
@@ -0,0 +1,243 @@
+"""Prometheus metrics of the server.
+
+Each thread counts its own requests and connection checkouts, so recording
+them takes no lock. Scraping /metrics adds up the counts of all the threads,
+takes the latency histograms from the route totals of request_stats, reads
+the connection pool and cache statistics at that moment and writes it all in
+the Prometheus text format:
+
+    carbon_calc_requests_total{route="get_dashboard_data",method="GET",status="200"} 12
+    carbon_calc_request_duration_seconds_bucket{route="get_dashboard_data",le="0.1"} 9
+    carbon_calc_db_pool_checked_out 1
+    carbon_calc_cache_hits_total{cache="co2_timelines"} 48
+"""
+
+import threading
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+
+from request_stats import LATENCY_BUCKETS
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_local = threading.local()
+
+# ThreadMetrics of every thread that has counted something, and the totals of
+# threads that have finished. The lock is only taken when a thread counts for
+# the first time and on scrapes.
+_threads = []
+_threads_lock = threading.Lock()
+
+
+class ThreadMetrics(object):
+    """The requests and connection checkouts counted by one thread."""
+
+    def __init__(self, thread=None):
+        self.thread = thread
+        # {(route, method, status): requests}
+        self.requests = {}
+        self.checkouts = 0
+
+    def __repr__(self):
+        return "<ThreadMetrics Thread=%s, Requests=%s>" % \
+            (self.thread and self.thread.name, sum(self.requests.values()))
+
+    def add(self, other):
+        """Add the counts of another thread."""
+
+        for key, count in other.requests.items():
+            self.requests[key] = self.requests.get(key, 0) + count
+
+        self.checkouts += other.checkouts
+
+
+_finished = ThreadMetrics()
+
+
+def get_thread_metrics():
+    """Get the counts of the current thread, registering them the first time
+    the thread counts something."""
+
+    metrics = getattr(_local, "metrics", None)
+
+    if metrics is None:
+        metrics = _local.metrics = ThreadMetrics(threading.current_thread())
+        with _threads_lock:
+            _threads.append(metrics)
+
+    return metrics
+
+
+def observe_request(route, method, status):
+    """Count a finished request. Its latency is in its route's totals in
+    request_stats."""
+
+    metrics = get_thread_metrics()
+
+    key = (route, method, status)
+    metrics.requests[key] = metrics.requests.get(key, 0) + 1
+
+
+def collect():
+    """Add up the counts of every thread. Threads that have finished are
+    folded into one total so the list only holds live threads."""
+
+    totals = ThreadMetrics()
+
+    with _threads_lock:
+        for metrics in _threads[:]:
+            if not metrics.thread.is_alive():
+                _finished.add(metrics)
+                _threads.remove(metrics)
+
+        totals.add(_finished)
+        for metrics in _threads:
+            totals.add(metrics)
+
+    return totals
+
+
+def reset():
+    """Forget every count."""
+
+    global _finished
+
+    with _threads_lock:
+        for metrics in _threads:
+            metrics.requests.clear()
+            metrics.checkouts = 0
+        _finished = ThreadMetrics()
+
+
+def format_labels(labels):
+    """Format a list of (name, value) labels, escaped for the text format."""
+
+    if not labels:
+        return ""
+
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, unicode(value).replace("\\", "\\\\")
+                     .replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels)
+
+
+def format_value(value):
+    """Format a sample value, without a trailing .0 on whole numbers."""
+
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+
+    return str(int(value))
+
+
+class MetricsWriter(object):
+    """Writes metric families in the Prometheus text format."""
+
+    def __init__(self):
+        self.lines = []
+
+    def family(self, name, metric_type, description):
+        self.lines.append("# HELP %s %s" % (name, description))
+        self.lines.append("# TYPE %s %s" % (name, metric_type))
+
+    def sample(self, name, value, labels=None):
+        self.lines.append("%s%s %s" % (name, format_labels(labels),
+                                       format_value(value)))
+
+    def get_text(self):
+        return "\n".join(self.lines) + "\n"
+
+
+def write_request_metrics(writer, totals, route_latencies):
+    """Request counts, server errors and the latency histograms, from
+    request_stats.get_route_latencies()."""
+
+    writer.family("carbon_calc_requests_total", "counter",
+                  "Requests handled, by route, method and status.")
+    for (route, method, status), count in sorted(totals.requests.items()):
+        writer.sample("carbon_calc_requests_total", count,
+                      [("route", route), ("method", method),
+                       ("status", status)])
+
+    errors = {}
+    for (route, method, status), count in totals.requests.items():
+        if status >= 500:
+            errors[route] = errors.get(route, 0) + count
+
+    writer.family("carbon_calc_request_errors_total", "counter",
+                  "Requests that failed with a server error, by route.")
+    for route, count in sorted(errors.items()):
+        writer.sample("carbon_calc_request_errors_total", count,
+                      [("route", route)])
+
+    writer.family("carbon_calc_request_duration_seconds", "histogram",
+                  "Time taken to handle requests, by route.")
+    for route, (latencies, seconds) in sorted(route_latencies.items()):
+        requests = 0
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), latencies):
+            requests += count
+            writer.sample("carbon_calc_request_duration_seconds_bucket",
+                          requests, [("route", route), ("le", bound)])
+        writer.sample("carbon_calc_request_duration_seconds_sum",
+                      seconds, [("route", route)])
+        writer.sample("carbon_calc_request_duration_seconds_count", requests,
+                      [("route", route)])
+
+
+def write_pool_metrics(writer, pool, totals):
+    """The database connection pool's connections and checkouts."""
+
+    writer.family("carbon_calc_db_pool_checkouts_total", "counter",
+                  "Connections checked out of the pool.")
+    writer.sample("carbon_calc_db_pool_checkouts_total", totals.checkouts)
+
+    # only a QueuePool has a size and an overflow
+    for name, description in [
+            ("size", "Connections the pool keeps open."),
+            ("checkedin", "Idle connections in the pool."),
+            ("checkedout", "Connections in use."),
+            ("overflow", "Connections open beyond the pool size.")]:
+        method = getattr(pool, name, None)
+        if method is None:
+            continue
+
+        # the pool's overflow counts up from -size until it is full
+        value = max(method(), 0) if name == "overflow" else method()
+
+        metric = "carbon_calc_db_pool_%s" % name.replace("checked",
+                                                         "checked_")
+        writer.family(metric, "gauge", description)
+        writer.sample(metric, value)
+
+
+def write_cache_metrics(writer, cache_stats):
+    """The hit/miss counters and sizes of the caches, from
+    cache.get_cache_stats()."""
+
+    for field, metric_type, description in [
+            ("hits", "counter", "Cache lookups that were found."),
+            ("misses", "counter", "Cache lookups that had to be loaded."),
+            ("size", "gauge", "Entries held by the cache.")]:
+        metric = "carbon_calc_cache_%s%s" % (
+            field, "_total" if metric_type == "counter" else "")
+        writer.family(metric, metric_type, description)
+        for name, stats in sorted(cache_stats.items()):
+            writer.sample(metric, stats[field], [("cache", name)])
+
+
+def render(pool, cache_stats, route_latencies):
+    """Write all of the metrics in the Prometheus text format."""
+
+    totals = collect()
+    writer = MetricsWriter()
+
+    write_request_metrics(writer, totals, route_latencies)
+    write_pool_metrics(writer, pool, totals)
+    write_cache_metrics(writer, cache_stats)
+
+    return writer.get_text()
+
+
+@event.listens_for(Pool, "checkout")
+def count_checkout(dbapi_connection, connection_record, connection_proxy):
+    get_thread_metrics().checkouts += 1
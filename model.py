@@ -1,11 +1,79 @@
 from datetime import datetime, date, timedelta
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy import func
+from sqlalchemy import func, event, select, tuple_
+from sqlalchemy.orm import Session, joinedload, contains_eager
 from collections import OrderedDict
+from cache import LRUCache, LazyIndex
+from emissions import LogArrays, CO2Timeline
+from car_catalog import CarCatalog, CarEmissionsIndex
 
 db = SQLAlchemy()
 
+GRAMS_TO_LBS = 0.00220  # 0.00220 pounds in a gram
+KWH_TO_MEGA_WH = 0.001  # 1 Kwh = 0.001 Megawatt Hours
+TONNES_CO2_PER_THERM = 0.005302  # 0.005302 metric tons CO2/therm
+POUNDS_PER_TONNE = 2204.620  # 2,204.620 pounds per tonne
+NO_CAR_GRAMS_CO2_MILE = 0  # trips logged without a car count no car CO2
+
+# average grams of CO2 per mile keyed on
+# (make, model, year, cylinders, transmission)
+car_factor_cache = LRUCache("car_factors", maxsize=1024)
+
+# running CO2 totals keyed on (user_id, source), and monthly trip miles keyed
+# on (user_id, "trip_miles"), each stored with the data and reference versions
+# it was loaded at
+co2_timeline_cache = LRUCache("co2_timelines", maxsize=256)
+
+# logs per page of the log listings
+LOG_PAGE_SIZE = 50
+MAX_LOG_PAGE_SIZE = 500
+
+
+def get_log_cursor(log_date, log_id):
+    """Page cursor of a log, its date and id, e.g. "2017-03-01.42"."""
+
+    return "%s.%s" % (log_date.isoformat(), log_id)
+
+
+def parse_log_cursor(cursor):
+    """Split a page cursor into its date and id. Raises ValueError if it
+    isn't a cursor."""
+
+    log_date, log_id = cursor.split(".")
+
+    return datetime.strptime(log_date, "%Y-%m-%d").date(), int(log_id)
+
+
+def get_year_range(year):
+    """First day of a year and first day of the next, for filters that can
+    use the date indexes."""
+
+    return date(int(year), 1, 1), date(int(year) + 1, 1, 1)
+
+
+def get_log_page(query, date_column, id_column, after=None,
+                 page_size=LOG_PAGE_SIZE):
+    """Get a page of a log query, newest first, and the cursor of the next
+    page (None on the last page). Pages are keyed on (date, id) rather than an
+    offset, so every page is an index range scan however far back it is."""
+
+    if after:
+        query = query.filter(tuple_(date_column, id_column) <
+                             tuple_(*parse_log_cursor(after)))
+
+    logs = query.order_by(date_column.desc(), id_column.desc()) \
+        .limit(page_size + 1).all()
+
+    if len(logs) <= page_size:
+        return logs, None
+
+    logs = logs[:page_size]
+    last_log = logs[-1]
+
+    return logs, get_log_cursor(getattr(last_log, date_column.key),
+                                getattr(last_log, id_column.key))
+
 ##############################################################################
 # Database Model Classes
 
@@ -25,6 +93,15 @@ class Region(db.Model):
 
     zipcodes = db.relationship('Zipcode')
 
+    @classmethod
+    def get_factors(cls):
+        """Get the (region_id, name, lb_co2e_mega_wh) of every region, in
+        region_id order."""
+
+        return db.session.query(cls.region_id, cls.name,
+                                cls.lb_co2e_mega_wh) \
+            .order_by(cls.region_id).all()
+
 
 class Zipcode(db.Model):
     """The grid region for every zipcode in the United States."""
@@ -41,6 +118,45 @@ class Zipcode(db.Model):
 
     region = db.relationship('Region')
 
+    @classmethod
+    def load_factor_index(cls):
+        """Build a dictionary of every zipcode and the lb CO2e/MWh factor of its
+        grid region from one joined query."""
+
+        rows = db.session.query(cls.zipcode_id, Region.region_id,
+                                Region.lb_co2e_mega_wh).join(cls.region).all()
+
+        # zipcodes in the same region share a single factor object
+        region_factors = {}
+        zipcode_factors = {}
+        for zipcode_id, region_id, lb_co2e_mega_wh in rows:
+            zipcode_factors[zipcode_id] = region_factors.setdefault(
+                region_id, lb_co2e_mega_wh)
+
+        return zipcode_factors
+
+    @classmethod
+    def get_lb_co2e_mega_wh(cls, zipcode_id):
+        """Get the lb CO2e/MWh factor of the grid region for a zipcode."""
+
+        lb_co2e_mega_wh = zipcode_factor_index.get(str(zipcode_id))
+
+        if lb_co2e_mega_wh is None:
+            raise NoResultFound("No grid region for zipcode %s" % zipcode_id)
+
+        return lb_co2e_mega_wh
+
+    @classmethod
+    def invalidate_factor_index(cls):
+        """Reload the zipcode factors on next use, e.g. after reseeding."""
+
+        zipcode_factor_index.invalidate()
+        invalidate_co2_timelines()
+
+
+# lb CO2e/MWh keyed on zipcode_id, loaded from the zipcodes and regions tables
+zipcode_factor_index = LazyIndex("zipcode_factors", Zipcode.load_factor_index)
+
 
 class Car(db.Model):
     """Every car by make, model and year in the EPA fuel economy registry.
@@ -73,10 +189,85 @@ class Car(db.Model):
     def get_unique_makes(cls):
         """Get list of unique car makes (brands)."""
 
-        query = db.session.query(cls.make).distinct()
-        makes = sorted([row.make for row in query.all()])
+        return cls.get_catalog().makes
+
+    @classmethod
+    def load_catalog(cls):
+        """Build the make > model > year > cylinders > transmissions tree of
+        the catalog with one DISTINCT query."""
+
+        cars = db.session.query(cls.make, cls.model, cls.year, cls.cylinders,
+                                cls.transmission).distinct().all()
 
-        return makes
+        return CarCatalog(cars)
+
+    @classmethod
+    def get_catalog(cls):
+        """Get the catalog tree, building it on first use."""
+
+        return car_catalog_index.data
+
+    @classmethod
+    def invalidate_catalog(cls):
+        """Rebuild the catalog tree and CO2 ranking on next use, e.g. after
+        the catalog is reloaded."""
+
+        car_catalog_index.invalidate()
+        car_emissions_index.invalidate()
+
+    @classmethod
+    def load_emissions_index(cls):
+        """Rank every car of the catalog by its CO2 per mile, from one
+        query."""
+
+        cars = db.session.query(cls.car_id, cls.make, cls.model, cls.year,
+                                cls.cylinders, cls.transmission, cls.fuel_type,
+                                cls.drive, cls.grams_co2_mile,
+                                cls.mpg_combo).all()
+
+        return CarEmissionsIndex(cars)
+
+    @classmethod
+    def get_emissions_index(cls):
+        """Get the catalog ranked by CO2 per mile, building it on first
+        use."""
+
+        return car_emissions_index.data
+
+    @classmethod
+    def get_avg_grams_co2_mile(cls, make, model, year, cylinders=None,
+                               transmission=None):
+        """Get the average grams of co2 per mile for all of the cars that match
+        the search criteria. Results are cached until the catalog changes."""
+
+        cylinders = str(cylinders) if cylinders else None
+        transmission = transmission or None
+        key = (make, model, int(year), cylinders, transmission)
+
+        def load_avg_grams_co2_mile():
+            # get all CO2 factors that meet the car search criteria
+            grams_co2_mile = db.session.query(cls.grams_co2_mile).filter_by(
+                make=make, model=model, year=year)
+
+            if cylinders:
+                grams_co2_mile = grams_co2_mile.filter_by(cylinders=cylinders)
+            if transmission:
+                grams_co2_mile = grams_co2_mile.filter_by(
+                    transmission=transmission)
+
+            # convert list of tuples just a list of values
+            grams_co2_mile = [factor[0] for factor in grams_co2_mile.all()]
+
+            return sum(grams_co2_mile) / len(grams_co2_mile)
+
+        return car_factor_cache.get(key, load_avg_grams_co2_mile)
+
+    @classmethod
+    def invalidate_factor_cache(cls):
+        """Clear the cached CO2 factors, e.g. after the catalog is reloaded."""
+
+        car_factor_cache.invalidate()
+        invalidate_co2_timelines()
 
     def as_dict(self):
         """This method changes the results of a query into a dictionary. The
@@ -84,6 +275,41 @@ class Car(db.Model):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
 
 
+# distinct cars of the catalog as a tree, loaded from the cars table
+car_catalog_index = LazyIndex("car_catalog", Car.load_catalog)
+
+# cars sorted by grams of CO2 per mile, with the positions of each make, fuel
+# type and drive
+car_emissions_index = LazyIndex("car_emissions", Car.load_emissions_index)
+
+
+class ReferenceVersion(db.Model):
+    """Counts reloads of the emission factors (regions, zipcodes and cars)
+    shared by every user, for versioning cached chart responses. It has a
+    single row, added by the first reload."""
+
+    __tablename__ = "reference_version"
+
+    version_id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<ReferenceVersion Version=%s>" % self.version
+
+    @classmethod
+    def bump(cls):
+        """Count a reload of the emission factors. The change is left in the
+        session to be committed with the new factors."""
+
+        bumped = cls.query.filter_by(version_id=1).update(
+            {cls.version: cls.version + 1}, synchronize_session=False)
+
+        if not bumped:
+            db.session.add(cls(version_id=1, version=1))
+
+        db.session.info.pop("data_versions", None)
+
+
 class User(db.Model):
     """User of carbon footprint calculator."""
 
@@ -93,12 +319,45 @@ class User(db.Model):
     email = db.Column(db.Unicode(256), nullable=False)
     password = db.Column(db.String(100), nullable=False)
     name = db.Column(db.Unicode(256), nullable=False)
+    # counts changes to the user's data, for versioning cached chart responses
+    data_version = db.Column(db.Integer, nullable=False, default=0,
+                             server_default="0")
 
     def __repr__(self):
         return "<User Id=%s, Name=%s>" % (self.user_id, self.name)
 
     residences = db.relationship('Residence')
 
+    @classmethod
+    def get_data_versions(cls, user_id):
+        """Get the version of the user's data and the version of the emission
+        factors it is priced with, with a single query. The versions are kept
+        in the session until its transaction ends or they are bumped."""
+
+        data_versions = db.session.info.setdefault("data_versions", {})
+
+        if user_id not in data_versions:
+            reference_version = db.session.query(
+                func.coalesce(func.max(ReferenceVersion.version), 0)) \
+                .as_scalar()
+
+            data_versions[user_id] = tuple(
+                db.session.query(cls.data_version, reference_version)
+                .filter(cls.user_id == user_id).first() or (None, None))
+
+        return data_versions[user_id]
+
+    @classmethod
+    def bump_data_version(cls, user_id):
+        """Count a change to the user's logs, residences or cars, so charts
+        made from the old data are no longer served from cache. The change is
+        left in the session to be committed with the data."""
+
+        cls.query.filter_by(user_id=user_id).update(
+            {cls.data_version: cls.data_version + 1},
+            synchronize_session=False)
+        db.session.info.pop("data_versions", None)
+
 
 class UserCar(db.Model):
     """Car profiles for users. Users may have multiple cars."""
@@ -139,27 +398,23 @@ class UserCar(db.Model):
     def calculate_avg_grams_co2_mile(self):
         """calculate the average grams of co2 per mile for a given usercar."""
 
-        make = self.make
-        model = self.model
-        year = self.year
-        cylinders = self.cylinders
-        transmission = self.transmission
-
-        # get all CO2 factors that meet the car search criteria
-        grams_co2_mile = db.session.query(Car.grams_co2_mile).filter_by(
-            make=make, model=model, year=year)
+        return Car.get_avg_grams_co2_mile(self.make, self.model, self.year,
+                                          self.cylinders, self.transmission)
 
-        if cylinders:
-            grams_co2_mile = grams_co2_mile.filter_by(cylinders=cylinders)
-        if transmission:
-            grams_co2_mile = grams_co2_mile.filter_by(transmission=transmission)
+    @classmethod
+    def get_avg_grams_co2_mile_factors(cls, user_id):
+        """Get the average grams of co2 per mile for each of the user's cars as
+        a dictionary keyed by usercar_id. Trips logged without a car are
+        priced with the None entry."""
 
-        # convert list of tuples just a list of values
-        grams_co2_mile = [factor[0] for factor in grams_co2_mile.all()]
+        usercars = cls.query.filter_by(user_id=user_id).all()
 
-        avg_grams_co2_mile = sum(grams_co2_mile) / len(grams_co2_mile)
+        avg_grams_co2_mile_factors = {None: NO_CAR_GRAMS_CO2_MILE}
+        for usercar in usercars:
+            avg_grams_co2_mile_factors[usercar.usercar_id] = \
+                usercar.calculate_avg_grams_co2_mile()
 
-        return avg_grams_co2_mile
+        return avg_grams_co2_mile_factors
 
 
 class TransitType(db.Model):
@@ -194,6 +449,9 @@ class TripLog(db.Model):
     miles = db.Column(db.Float, nullable=False)
     number_of_passengers = db.Column(db.Integer, nullable=True)
 
+    __table_args__ = (db.Index('ix_trip_log_user_date',
+                               'user_id', 'date', 'trip_id'),)
+
     def __repr__(self):
         return "<ID=%s, User=%s, Car=%s, Type=%s, Miles=%s, Date=%s>" % \
             (self.trip_id, self.user_id, self.usercar_id,
@@ -210,49 +468,84 @@ class TripLog(db.Model):
                        miles=miles, number_of_passengers=number_of_passengers)
 
         db.session.add(new_trip)
+        DailyCO2Rollup.update_for(new_trip)
         db.session.commit()
 
-    def calculate_avg_grams_co2_mile_factor(self):
-        """calculate the average grams of co2 per mile for a given car."""
+    @classmethod
+    def get_page(cls, user_id, after=None, page_size=LOG_PAGE_SIZE, year=None,
+                 usercar_id=None):
+        """Get a page of the user's trips, newest first, with their cars, and
+        the cursor of the next page. Optionally only the trips of a year or a
+        car."""
+
+        query = cls.query.filter_by(user_id=user_id) \
+            .options(joinedload(cls.usercar))
 
-        make = self.usercar.make
-        model = self.usercar.model
-        year = self.usercar.year
-        cylinders = self.usercar.cylinders
-        transmission = self.usercar.transmission
+        if year:
+            first_day, next_year = get_year_range(year)
+            query = query.filter(cls.date >= first_day, cls.date < next_year)
 
-        # get all CO2 factors that meet the car search criteria
-        grams_co2_mile = db.session.query(Car.grams_co2_mile).filter_by(
-            make=make, model=model, year=year)
+        if usercar_id:
+            query = query.filter_by(usercar_id=usercar_id)
 
-        if cylinders:
-            grams_co2_mile = grams_co2_mile.filter_by(cylinders=cylinders)
-        if transmission:
-            grams_co2_mile = grams_co2_mile.filter_by(transmission=transmission)
+        return get_log_page(query, cls.date, cls.trip_id, after, page_size)
 
-        # convert list of tuples just a list of values
-        grams_co2_mile = [factor[0] for factor in grams_co2_mile.all()]
+    def calculate_avg_grams_co2_mile_factor(self):
+        """calculate the average grams of co2 per mile for a given car."""
 
-        avg_grams_co2_mile = sum(grams_co2_mile) / len(grams_co2_mile)
+        if self.usercar_id is None:
+            return NO_CAR_GRAMS_CO2_MILE
 
-        return avg_grams_co2_mile
+        return self.usercar.calculate_avg_grams_co2_mile()
 
     def co2_calc(self, avg_grams_co2_mile=None):
         """Calculate the CO2 emissions for a car trip."""
 
-        grams_to_lbs = 0.00220  # 0.00220 pounds in a gram
-
-        if not avg_grams_co2_mile:
+        if avg_grams_co2_mile is None:
             avg_grams_co2_mile = self.calculate_avg_grams_co2_mile_factor()
 
-        co2 = self.miles * avg_grams_co2_mile * grams_to_lbs
+        co2 = self.miles * avg_grams_co2_mile * GRAMS_TO_LBS
         return co2
 
+    @classmethod
+    def get_log_arrays(cls, user_id, start_date="1/1/1900",
+                       end_date="1/1/2036", usercar_id=None):
+        """Load the date, miles and pounds of CO2 per mile of the trips within
+        a given date range as arrays, with a single query."""
+
+        query = db.session.query(cls.date, cls.miles, cls.usercar_id) \
+            .filter(cls.user_id == user_id,
+                    cls.date >= start_date,
+                    cls.date <= end_date)
+
+        if usercar_id:
+            query = query.filter(cls.usercar_id == usercar_id)
+
+        avg_grams_co2_mile_factors = \
+            UserCar.get_avg_grams_co2_mile_factors(user_id)
+
+        def get_lbs_co2_mile(trip_usercar_id):
+            return avg_grams_co2_mile_factors[trip_usercar_id] * GRAMS_TO_LBS
+
+        return LogArrays.from_rows(query.all(), get_lbs_co2_mile)
+
+    @classmethod
+    def get_co2_timeline(cls, user_id):
+        """Get the cached running total of the user's trip CO2, building it
+        if the trips changed since it was last used."""
+
+        return get_cached_co2_timeline(
+            user_id, "trip", lambda: CO2Timeline(cls.get_log_arrays(user_id)))
+
     @classmethod
     def sum_trip_co2(cls, user_id, start_date="1/1/1900", end_date="1/1/2036",
-                     usercar_id=None):
+                     usercar_id=None, from_timeline=True):
         """Sum the CO2 emissions from all of the trips within a given date
-        range"""
+        range. Totals over all of the user's cars come from the cached
+        timeline unless from_timeline is False."""
+
+        if from_timeline and not usercar_id:
+            return cls.get_co2_timeline(user_id).total(start_date, end_date)
 
         query = cls.query.filter(cls.user_id == user_id,
                                  cls.date >= start_date,
@@ -261,15 +554,9 @@ class TripLog(db.Model):
         if usercar_id:
             query = query.filter(cls.usercar_id == usercar_id)
 
-        usercars = UserCar.query.filter_by(user_id=user_id).order_by(
-            UserCar.is_default.desc(), UserCar.usercar_id.desc()).all()
-
         # pre-load all of the avgerage co2 factors for the usercars
-        avg_grams_co2_mile_factors = {}
-        for usercar in usercars:
-            if not avg_grams_co2_mile_factors.get(usercar.usercar_id):
-                avg_grams_co2_mile_factors[usercar.usercar_id] = \
-                    usercar.calculate_avg_grams_co2_mile()
+        avg_grams_co2_mile_factors = \
+            UserCar.get_avg_grams_co2_mile_factors(user_id)
 
         trips = query.all()
 
@@ -280,21 +567,53 @@ class TripLog(db.Model):
 
         return round(total_co2, 2)
 
+    @classmethod
+    def sum_trip_co2_per_month(cls, user_id, year, usercar_id=None):
+        """Sum the CO2 emissions from the trips in each month of a given year.
+        Returns a list of the 12 monthly totals, January first."""
+
+        # SELECT usercar_id, EXTRACT(MONTH FROM date), SUM(miles)
+        # FROM trip_log
+        # WHERE user_id = user_id AND date BETWEEN Jan 1 AND Dec 31
+        # GROUP BY usercar_id, EXTRACT(MONTH FROM date)
+
+        start_date, end_date = get_year_bounds(year)
+        month = func.extract('month', cls.date)
+
+        query = db.session.query(cls.usercar_id, month, func.sum(cls.miles)) \
+            .filter(cls.user_id == user_id,
+                    cls.date >= start_date,
+                    cls.date <= end_date)
+
+        if usercar_id:
+            query = query.filter(cls.usercar_id == usercar_id)
+
+        miles_per_car_month = query.group_by(cls.usercar_id, month).all()
+
+        avg_grams_co2_mile_factors = \
+            UserCar.get_avg_grams_co2_mile_factors(user_id)
+
+        co2_per_month = [0] * 12
+        for trip_usercar_id, trip_month, miles in miles_per_car_month:
+            avg_grams_co2_mile_factor = avg_grams_co2_mile_factors[trip_usercar_id]
+            co2_per_month[int(trip_month) - 1] += \
+                miles * avg_grams_co2_mile_factor * GRAMS_TO_LBS
+
+        return [round(co2, 2) for co2 in co2_per_month]
+
     @classmethod
     def get_co2_per_yr(cls, user_id):
         """Sum the CO2 emissions from all of the trips for every year that data
         has been entered."""
 
-        years = cls.get_trip_years(user_id)
+        # one grouped query of the daily rollup instead of one per year
+        co2_per_year = DailyCO2Rollup.sum_co2_per_yr(user_id, "trip")
+
         this_year = date.today().year
         days_this_year = days_btw_today_and_jan1()
         co2_per_yr = {}
 
-        for year in years:
-            start_date = "1/1/%s" % (year)
-            end_date = "12/31/%s" % (year)
-            co2 = cls.sum_trip_co2(user_id, start_date, end_date)
-
+        for year, co2 in co2_per_year.items():
             if year != this_year:
                 co2_per_yr[year] = {"total": co2,
                                     "daily_avg": co2 / 365}
@@ -307,67 +626,88 @@ class TripLog(db.Model):
     def co2_calc_other_car(self, make, model, year, cylinders, transmission):
         """Calculate the CO2 emissions for kwh entry at a different location."""
 
-        grams_to_lbs = 0.00220  # 0.00220 pounds in a gram
-
         # find co2 factor for other car
-        grams_co2_mile = db.session.query(Car.grams_co2_mile).filter_by(
-            make=make, model=model, year=year)
+        avg_grams_co2_mile = Car.get_avg_grams_co2_mile(make, model, year,
+                                                        cylinders, transmission)
 
-        if cylinders:
-            grams_co2_mile = grams_co2_mile.filter_by(cylinders=cylinders)
-        if transmission:
-            grams_co2_mile = grams_co2_mile.filter_by(transmission=transmission)
+        co2 = self.miles * avg_grams_co2_mile * GRAMS_TO_LBS
+        return co2
 
-        # convert list of tuples just a list of values
-        grams_co2_mile = [factor[0] for factor in grams_co2_mile.all()]
+    @classmethod
+    def load_monthly_miles(cls, user_id):
+        """Sum the miles of the user's trips per car and month with a single
+        grouped query. Returns a dictionary of 12 monthly totals, January
+        first, keyed by (year, usercar_id)."""
 
-        avg_grams_co2_mile = sum(grams_co2_mile) / len(grams_co2_mile)
+        year = func.extract('year', cls.date)
+        month = func.extract('month', cls.date)
 
-        co2 = self.miles * avg_grams_co2_mile * grams_to_lbs
-        return co2
+        miles_per_month = db.session.query(
+            year, month, cls.usercar_id, func.sum(cls.miles)) \
+            .filter(cls.user_id == user_id) \
+            .group_by(year, month, cls.usercar_id).all()
+
+        monthly_miles = {}
+        for trip_year, trip_month, usercar_id, miles in miles_per_month:
+            monthly_miles.setdefault((int(trip_year), usercar_id),
+                                     [0] * 12)[int(trip_month) - 1] = miles
+
+        return monthly_miles
+
+    @classmethod
+    def get_monthly_miles(cls, user_id):
+        """Get the cached miles per car and month of the user's trips, loading
+        them if the trips changed since they were last used."""
+
+        return get_cached_co2_timeline(
+            user_id, "trip_miles", lambda: cls.load_monthly_miles(user_id))
 
     @classmethod
     def sum_trip_co2_other_car(cls, user_id, make, model, year, cylinders,
                                transmission, start_date="1/1/1900",
                                end_date="1/1/2036", usercar_id=None):
-        """Sum the CO2 emissions from all of the kwhs within a given date
-        range"""
+        """Sum the CO2 emissions of the user's trips within a given date range
+        if they had been driven in a different car."""
 
-        query = cls.query.filter(cls.user_id == user_id,
-                                 cls.date >= start_date,
-                                 cls.date <= end_date)
+        # SELECT SUM(miles)
+        # FROM trip_log
+        # WHERE user_id = user_id AND date BETWEEN start_date AND end_date
+        # AND usercar_id IS NOT NULL
+
+        # trips logged without a car weren't driven in one
+        query = db.session.query(func.sum(cls.miles)).filter(
+            cls.user_id == user_id,
+            cls.date >= start_date,
+            cls.date <= end_date,
+            cls.usercar_id.isnot(None))
 
         if usercar_id:
             query = query.filter(cls.usercar_id == usercar_id)
 
-        trips = query.all()
+        miles = query.scalar()
 
-        total_co2 = 0
-        for trip in trips:
-            total_co2 += cls.co2_calc_other_car(trip, make, model, year,
-                                                cylinders, transmission)
+        if not miles:
+            return 0
 
-        return round(total_co2, 2)
+        avg_grams_co2_mile = Car.get_avg_grams_co2_mile(make, model, year,
+                                                        cylinders, transmission)
+
+        return round(miles * avg_grams_co2_mile * GRAMS_TO_LBS, 2)
 
     @classmethod
     def get_trip_years(cls, user_id):
-        """Sum the CO2 emissions from all of the trips within a given date
-        range"""
+        """Get the years that the user has logged trips in, in order."""
 
-        # SELECT EXTRACT(YEAR FROM date)
+        # SELECT DISTINCT EXTRACT(YEAR FROM date)
         # FROM trip_log
         # WHERE user_id = user_id
 
-        # Extract the year from the date object
-        def date_to_year(data_date):
-            return data_date.date.year
-
-        trips = db.session.query(cls.date).filter(cls.user_id == user_id).all()
+        year = func.extract('year', cls.date)
 
-        # get the year for each date object and then set() to remove duplicates
-        trip_years = sorted(set(map(date_to_year, trips)))
+        trip_years = db.session.query(year).filter(cls.user_id == user_id) \
+            .distinct().all()
 
-        return trip_years
+        return sorted(int(trip_year) for trip_year, in trip_years)
 
     @classmethod
     def calculate_total_co2_per_day_of_week(cls, user_id, start_date="1/1/1900",
@@ -383,15 +723,8 @@ class TripLog(db.Model):
         co2_by_day_of_week = {0: 0, 1: 0, 2: 0, 3: 0, 4: 0, 5: 0, 6: 0}
 
         # pre-load all of the avgerage co2 factors for the usercars
-        avg_grams_co2_mile_factors = {}
-
-        usercars = UserCar.query.filter_by(user_id=user_id).order_by(
-            UserCar.is_default.desc(), UserCar.usercar_id.desc()).all()
-
-        for usercar in usercars:
-            if not avg_grams_co2_mile_factors.get(usercar.usercar_id):
-                avg_grams_co2_mile_factors[usercar.usercar_id] = \
-                    usercar.calculate_avg_grams_co2_mile()
+        avg_grams_co2_mile_factors = \
+            UserCar.get_avg_grams_co2_mile_factors(user_id)
 
         for trip in trips:
             avg_grams_co2_mile_factor = avg_grams_co2_mile_factors[trip.usercar_id]
@@ -420,24 +753,21 @@ class TripLog(db.Model):
         # summary for all data entered
         total_data = {}
         total_data["row_label"] = "Total"
-        total_data["total"] = round(cls.sum_trip_co2(user_id), 2)
+        total_data["total"] = DailyCO2Rollup.sum_co2(user_id, "trip")
         total_data["daily_avg"] = round(total_data["total"] / days, 2)
         total_data["monthly_avg"] = round(total_data["total"] / months, 2)
 
-        # summary per year
-        years = cls.get_trip_years(user_id)
-        years = years[::-1]
+        # summary per year, newest first
+        co2_per_year = DailyCO2Rollup.sum_co2_per_yr(user_id, "trip")
+        years = sorted(co2_per_year, reverse=True)
 
         data = OrderedDict()
 
         for year in years:
             year_data = {}
-            Jan_1 = "1/1/%s" % (year)
-            Dec_31 = "12/31/%s" % (year)
 
             year_data["row_label"] = year
-            year_data["total"] = round(cls.sum_trip_co2(
-                user_id, Jan_1, Dec_31), 2)
+            year_data["total"] = co2_per_year[year]
 
             if year != datetime.now().year:
                 year_data["daily_avg"] = round(year_data["total"] / 365, 2)
@@ -513,6 +843,9 @@ class ElectricityLog(db.Model):
     start_date = db.Column(db.Date, nullable=False)
     end_date = db.Column(db.Date, nullable=False)
 
+    __table_args__ = (db.Index('ix_electricity_log_residence_date',
+                               'residence_id', 'start_date', 'elect_id'),)
+
     def __repr__(self):
         return "<Id= %s, Residence= %s, kwh= %s, date= %s to %s>" % \
             (self.elect_id, self.residence_id, self.kwh, self.start_date,
@@ -521,17 +854,38 @@ class ElectricityLog(db.Model):
     # Define relationship to residence
     residence = db.relationship('Residence')
 
+    @classmethod
+    def get_page(cls, user_id, after=None, page_size=LOG_PAGE_SIZE, year=None,
+                 residence_id=None):
+        """Get a page of the user's electricity logs, newest first, with their
+        residences, and the cursor of the next page. Optionally only the logs
+        starting in a year or of a residence."""
+
+        query = cls.query.join(Residence) \
+            .filter(Residence.user_id == user_id) \
+            .options(contains_eager(cls.residence))
+
+        if year:
+            first_day, next_year = get_year_range(year)
+            query = query.filter(cls.start_date >= first_day,
+                                 cls.start_date < next_year)
+
+        if residence_id:
+            query = query.filter(cls.residence_id == residence_id)
+
+        return get_log_page(query, cls.start_date, cls.elect_id, after, page_size)
+
     def kwh_to_mega_wh(self):
         """Convert kWh entered by users into MWh to match the EPA factor"""
 
-        # 1 Kwh = 0.001 Megawatt Hours
-        mega_wh = self.kwh * 0.001
+        mega_wh = self.kwh * KWH_TO_MEGA_WH
         return mega_wh
 
     def co2_calc(self):
         """Calculate the CO2 emissions for kwh entry."""
 
-        lb_co2e_mega_wh = self.residence.region.lb_co2e_mega_wh
+        lb_co2e_mega_wh = Zipcode.get_lb_co2e_mega_wh(
+            self.residence.zipcode_id)
 
         # convert kwh to megawatt hours for the instance
         mega_wh = self.kwh_to_mega_wh()
@@ -539,51 +893,145 @@ class ElectricityLog(db.Model):
         co2e = mega_wh * lb_co2e_mega_wh
         return co2e
 
+    @classmethod
+    def query_with_factor(cls, user_id, *columns):
+        """Query columns of the user's electricity logs joined through their
+        residence and zipcode to the grid region, so Region.lb_co2e_mega_wh of
+        every log comes from the same query instead of a lazy load per
+        residence."""
+
+        return db.session.query(*columns) \
+            .select_from(cls) \
+            .join(Residence, cls.residence_id == Residence.residence_id) \
+            .join(Zipcode, Residence.zipcode_id == Zipcode.zipcode_id) \
+            .join(Region, Zipcode.region_id == Region.region_id) \
+            .filter(Residence.user_id == user_id)
+
+    @classmethod
+    def get_log_arrays(cls, user_id, start_date="1/1/1900",
+                       end_date="1/1/2036", residence_id=None):
+        """Load the start date, kWh and pounds of CO2 per kWh of the
+        electricity logs within a given date range as arrays, with a single
+        query."""
+
+        query = db.session.query(cls.start_date, cls.kwh,
+                                 Residence.zipcode_id) \
+            .select_from(cls) \
+            .join(Residence, cls.residence_id == Residence.residence_id) \
+            .filter(Residence.user_id == user_id,
+                    cls.start_date >= start_date,
+                    cls.start_date <= end_date)
+
+        if residence_id:
+            query = query.filter(cls.residence_id == residence_id)
+
+        def get_lbs_co2_kwh(zipcode_id):
+            return Zipcode.get_lb_co2e_mega_wh(zipcode_id) * KWH_TO_MEGA_WH
+
+        return LogArrays.from_rows(query.all(), get_lbs_co2_kwh)
+
+    @classmethod
+    def get_co2_timeline(cls, user_id):
+        """Get the cached running total of the user's electricity CO2,
+        building it if the logs changed since it was last used."""
+
+        return get_cached_co2_timeline(
+            user_id, "kwh", lambda: CO2Timeline(cls.get_log_arrays(user_id)))
+
     @classmethod
     def sum_kwh_co2(cls, user_id, start_date="1/1/1900", end_date="1/1/2036",
-                    residence_id=None):
+                    residence_id=None, from_timeline=True):
         """Sum the CO2 emissions from all of the kwhs within a given date
-        range"""
+        range. Totals over all of the user's residences come from the cached
+        timeline unless from_timeline is False."""
 
-    #     kwhs = SELECT *
-    #            FROM electricity_log AS e
-    #            JOIN residences AS r ON (e.residence_id=r.residence_id)
-    #            WHERE r.user_id = user_id AND
-    #                  (start_date BETWEEN cls.start_date AND cls.end_date OR
-    #                   end_date BETWEEN cls.start_date AND cls.end_date OR
-    #                   cls.start_date BETWEEN start_date AND end_date OR
-    #                   cls.end_date BETWEEN start_date AND end_date)
+        if from_timeline and not residence_id:
+            return cls.get_co2_timeline(user_id).total(start_date, end_date)
 
-        query = cls.query.filter(cls.residence.has(Residence.user_id == user_id),
-                                 cls.start_date >= start_date,
-                                 cls.start_date <= end_date)
+        # SELECT SUM(e.kwh * g.lb_co2e_mega_wh)
+        # FROM electricity_log AS e
+        # JOIN residences AS r ON (e.residence_id=r.residence_id)
+        # JOIN zipcodes AS z ON (r.zipcode_id=z.zipcode_id)
+        # JOIN regions AS g ON (z.region_id=g.region_id)
+        # WHERE r.user_id = user_id AND e.start_date BETWEEN start_date AND end_date
 
-        if residence_id:
-            query.filter(cls.residence_id)
+        query = cls.query_with_factor(
+            user_id, func.sum(cls.kwh * Region.lb_co2e_mega_wh)) \
+            .filter(cls.start_date >= start_date,
+                    cls.start_date <= end_date)
 
-        kwhs = query.all()
+        if residence_id:
+            query = query.filter(cls.residence_id == residence_id)
 
-        total_co2 = 0
-        for kwh in kwhs:
-            total_co2 += cls.co2_calc(kwh)
+        total_co2 = (query.scalar() or 0) * KWH_TO_MEGA_WH
 
         return round(total_co2, 2)
 
+    @classmethod
+    def sum_kwh_co2_per_month(cls, user_id, year):
+        """Sum the CO2 emissions from the kwhs in each month of a given year.
+        Returns a list of the 12 monthly totals, January first."""
+
+        # SELECT EXTRACT(MONTH FROM e.start_date),
+        #        SUM(e.kwh * g.lb_co2e_mega_wh)
+        # FROM electricity_log AS e
+        # JOIN residences AS r ON (e.residence_id=r.residence_id)
+        # JOIN zipcodes AS z ON (r.zipcode_id=z.zipcode_id)
+        # JOIN regions AS g ON (z.region_id=g.region_id)
+        # WHERE r.user_id = user_id AND e.start_date BETWEEN Jan 1 AND Dec 31
+        # GROUP BY EXTRACT(MONTH FROM e.start_date)
+
+        start_date, end_date = get_year_bounds(year)
+        month = func.extract('month', cls.start_date)
+
+        kwh_co2_per_month = cls.query_with_factor(
+            user_id, month, func.sum(cls.kwh * Region.lb_co2e_mega_wh)) \
+            .filter(cls.start_date >= start_date,
+                    cls.start_date <= end_date) \
+            .group_by(month).all()
+
+        co2_per_month = [0] * 12
+        for log_month, kwh_co2 in kwh_co2_per_month:
+            co2_per_month[int(log_month) - 1] = round(
+                kwh_co2 * KWH_TO_MEGA_WH, 2)
+
+        return co2_per_month
+
+    @classmethod
+    def sum_kwh_per_month(cls, user_id, year):
+        """Sum the kWh of the logs in each month of a given year. Returns a
+        list of the 12 monthly totals, January first."""
+
+        start_date, end_date = get_year_bounds(year)
+        month = func.extract('month', cls.start_date)
+
+        kwh_per_month = db.session.query(month, func.sum(cls.kwh)) \
+            .select_from(cls) \
+            .join(Residence, cls.residence_id == Residence.residence_id) \
+            .filter(Residence.user_id == user_id,
+                    cls.start_date >= start_date,
+                    cls.start_date <= end_date) \
+            .group_by(month).all()
+
+        monthly_kwh = [0] * 12
+        for log_month, kwh in kwh_per_month:
+            monthly_kwh[int(log_month) - 1] = kwh
+
+        return monthly_kwh
+
     @classmethod
     def get_co2_per_yr(cls, user_id):
         """Sum the CO2 emissions from all of the trips for every year that data
         has been entered."""
 
-        years = cls.get_kwh_years(user_id)
+        # one grouped query of the daily rollup instead of one per year
+        co2_per_year = DailyCO2Rollup.sum_co2_per_yr(user_id, "kwh")
+
         this_year = date.today().year
         days_this_year = days_btw_today_and_jan1()
         co2_per_yr = {}
 
-        for year in years:
-            start_date = "1/1/%s" % (year)
-            end_date = "12/31/%s" % (year)
-            co2 = cls.sum_kwh_co2(user_id, start_date, end_date)
-
+        for year, co2 in co2_per_year.items():
             if year != this_year:
                 co2_per_yr[year] = {"total": co2,
                                     "daily_avg": co2 / 365}
@@ -597,8 +1045,7 @@ class ElectricityLog(db.Model):
         """Calculate the CO2 emissions for kwh entry at a different location."""
 
         # find co2 factor for other location
-        lb_co2e_mega_wh = db.session.query(Region.lb_co2e_mega_wh).filter(
-            Region.zipcodes.any(Zipcode.zipcode_id == zipcode)).one()[0]
+        lb_co2e_mega_wh = Zipcode.get_lb_co2e_mega_wh(zipcode)
 
         # convert kwh to megawatt hours for the instance
         mega_wh = self.kwh_to_mega_wh()
@@ -612,34 +1059,28 @@ class ElectricityLog(db.Model):
         """Sum the CO2 emissions from all of the kwhs within a given date
         range"""
 
-        query = cls.query.filter(cls.residence.has(Residence.user_id == user_id),
-                                 cls.start_date >= start_date,
-                                 cls.start_date <= end_date)
+        # every log is priced at the same factor, so only the kwh are summed
+        lb_co2e_mega_wh = Zipcode.get_lb_co2e_mega_wh(zipcode)
 
-        kwhs = query.all()
+        total_kwh = db.session.query(func.sum(cls.kwh)).filter(
+            cls.residence.has(Residence.user_id == user_id),
+            cls.start_date >= start_date,
+            cls.start_date <= end_date).scalar() or 0
 
-        total_co2 = 0
-        for kwh in kwhs:
-            total_co2 += cls.co2_calc_other_location(kwh, zipcode)
+        total_co2 = total_kwh * KWH_TO_MEGA_WH * lb_co2e_mega_wh
 
         return round(total_co2, 2)
 
     @classmethod
     def get_kwh_years(cls, user_id):
-        """Sum the CO2 emissions from all of the electricity_logs within a
-        given date range"""
-
-        # Extract the year from the date object
-        def date_to_year(data_date):
-            return data_date.start_date.year
+        """Get the years that the user has logged electricity in, in order."""
 
-        kwhs = db.session.query(cls.start_date).filter(
-            cls.residence.has(Residence.user_id == user_id)).all()
+        year = func.extract('year', cls.start_date)
 
-        # get the year for each date object and then set() to remove duplicates
-        kwh_years = sorted(set(map(date_to_year, kwhs)))
+        kwh_years = db.session.query(year).filter(
+            cls.residence.has(Residence.user_id == user_id)).distinct().all()
 
-        return kwh_years
+        return sorted(int(kwh_year) for kwh_year, in kwh_years)
 
     @classmethod
     def calculate_total_co2_per_day_of_week(cls, user_id, start_date="1/1/1900",
@@ -647,17 +1088,18 @@ class ElectricityLog(db.Model):
         """Calculate the CO2 from trips separated per day of the week to
         determine what days tend to have the highest footprint"""
 
-        electricity_logs = cls.query.filter(cls.residence.has(
-            Residence.user_id == user_id),
-            cls.start_date >= start_date,
-            cls.start_date <= end_date).all()
+        # the CO2 of each log, priced with its region factor in the same query
+        log_co2s = cls.query_with_factor(
+            user_id, cls.start_date,
+            cls.kwh * Region.lb_co2e_mega_wh * KWH_TO_MEGA_WH) \
+            .filter(cls.start_date >= start_date,
+                    cls.start_date <= end_date).all()
 
         # 0 = Mon, 1 = Tue, 2 = Wed, 3 = Thur, 4 = Fri, 5 = Sat, 6 = Sun
         co2_by_day_of_week = {0: 0, 1: 0, 2: 0, 3: 0, 4: 0, 5: 0, 6: 0}
 
-        for log in electricity_logs:
-            co2_by_day_of_week[log.start_date.weekday()] = co2_by_day_of_week.get(
-                log.start_date.weekday()) + round(log.co2_calc(), 0)
+        for log_date, co2 in log_co2s:
+            co2_by_day_of_week[log_date.weekday()] += round(co2, 0)
 
         return co2_by_day_of_week
 
@@ -683,24 +1125,21 @@ class ElectricityLog(db.Model):
         # summary for all data entered
         total_data = {}
         total_data["row_label"] = "Total"
-        total_data["total"] = round(cls.sum_kwh_co2(user_id), 2)
+        total_data["total"] = DailyCO2Rollup.sum_co2(user_id, "kwh")
         total_data["daily_avg"] = round(total_data["total"] / days, 2)
         total_data["monthly_avg"] = round(total_data["total"] / months, 2)
 
-        # summary per year
-        years = cls.get_kwh_years(user_id)
-        years = years[::-1]
+        # summary per year, newest first
+        co2_per_year = DailyCO2Rollup.sum_co2_per_yr(user_id, "kwh")
+        years = sorted(co2_per_year, reverse=True)
 
         data = OrderedDict()
 
         for year in years:
             year_data = {}
-            Jan_1 = "1/1/%s" % (year)
-            Dec_31 = "12/31/%s" % (year)
 
             year_data["row_label"] = year
-            year_data["total"] = round(cls.sum_kwh_co2(
-                user_id, Jan_1, Dec_31), 2)
+            year_data["total"] = co2_per_year[year]
 
             if year != datetime.now().year:
                 year_data["daily_avg"] = round(year_data["total"] / 365, 2)
@@ -730,6 +1169,9 @@ class NGLog(db.Model):
     start_date = db.Column(db.Date, nullable=False)
     end_date = db.Column(db.Date, nullable=False)
 
+    __table_args__ = (db.Index('ix_ng_log_residence_date',
+                               'residence_id', 'start_date', 'ng_id'),)
+
     def __repr__(self):
         return "<Id= %s, Residence= %s, therms= %s, date= %s to %s>" % \
             (self.ng_id, self.residence_id, self.therms, self.start_date,
@@ -738,19 +1180,70 @@ class NGLog(db.Model):
     # Define relationship to residence
     residence = db.relationship('Residence')
 
+    @classmethod
+    def get_page(cls, user_id, after=None, page_size=LOG_PAGE_SIZE, year=None,
+                 residence_id=None):
+        """Get a page of the user's natural gas logs, newest first, with their
+        residences, and the cursor of the next page. Optionally only the logs
+        starting in a year or of a residence."""
+
+        query = cls.query.join(Residence) \
+            .filter(Residence.user_id == user_id) \
+            .options(contains_eager(cls.residence))
+
+        if year:
+            first_day, next_year = get_year_range(year)
+            query = query.filter(cls.start_date >= first_day,
+                                 cls.start_date < next_year)
+
+        if residence_id:
+            query = query.filter(cls.residence_id == residence_id)
+
+        return get_log_page(query, cls.start_date, cls.ng_id, after, page_size)
+
     def co2_calc(self):
         """Calculate the CO2 emissions for kwh entry."""
 
-        tonnes_co2_per_therm = 0.005302  # 0.005302 metric tons CO2/therm
-        pounds_per_tonne = 2204.620  # 2,204.620 pounds per tonne
-
-        co2e = self.therms * tonnes_co2_per_therm * pounds_per_tonne
+        co2e = self.therms * TONNES_CO2_PER_THERM * POUNDS_PER_TONNE
         return co2e
 
     @classmethod
-    def sum_ng_co2(cls, user_id, start_date="1/1/1900", end_date="1/1/2036"):
+    def get_log_arrays(cls, user_id, start_date="1/1/1900",
+                       end_date="1/1/2036"):
+        """Load the start date, therms and pounds of CO2 per therm of the
+        natural gas logs within a given date range as arrays, with a single
+        query."""
+
+        query = db.session.query(cls.start_date, cls.therms, cls.residence_id) \
+            .select_from(cls) \
+            .join(Residence, cls.residence_id == Residence.residence_id) \
+            .filter(Residence.user_id == user_id,
+                    cls.start_date >= start_date,
+                    cls.start_date <= end_date)
+
+        # every therm has the same factor
+        def get_lbs_co2_therm(residence_id):
+            return TONNES_CO2_PER_THERM * POUNDS_PER_TONNE
+
+        return LogArrays.from_rows(query.all(), get_lbs_co2_therm)
+
+    @classmethod
+    def get_co2_timeline(cls, user_id):
+        """Get the cached running total of the user's natural gas CO2,
+        building it if the logs changed since it was last used."""
+
+        return get_cached_co2_timeline(
+            user_id, "ng", lambda: CO2Timeline(cls.get_log_arrays(user_id)))
+
+    @classmethod
+    def sum_ng_co2(cls, user_id, start_date="1/1/1900", end_date="1/1/2036",
+                   from_timeline=True):
         """Sum the CO2 emissions from all of the kwhs within a given date
-        range"""
+        range. Totals come from the cached timeline unless from_timeline is
+        False."""
+
+        if from_timeline:
+            return cls.get_co2_timeline(user_id).total(start_date, end_date)
 
         ngs = cls.query.filter(cls.residence.has(Residence.user_id == user_id),
                                cls.start_date >= start_date,
@@ -762,21 +1255,42 @@ class NGLog(db.Model):
 
         return round(total_co2, 2)
 
+    @classmethod
+    def sum_ng_co2_per_month(cls, user_id, year):
+        """Sum the CO2 emissions from the natural gas logs in each month of a
+        given year. Returns a list of the 12 monthly totals, January first."""
+
+        start_date, end_date = get_year_bounds(year)
+        month = func.extract('month', cls.start_date)
+
+        therms_per_month = db.session.query(month, func.sum(cls.therms)) \
+            .select_from(cls) \
+            .join(Residence, cls.residence_id == Residence.residence_id) \
+            .filter(Residence.user_id == user_id,
+                    cls.start_date >= start_date,
+                    cls.start_date <= end_date) \
+            .group_by(month).all()
+
+        co2_per_month = [0] * 12
+        for log_month, therms in therms_per_month:
+            co2_per_month[int(log_month) - 1] = round(
+                therms * TONNES_CO2_PER_THERM * POUNDS_PER_TONNE, 2)
+
+        return co2_per_month
+
     @classmethod
     def get_co2_per_yr(cls, user_id):
         """Sum the CO2 emissions from all of the ng for every year that data
         has been entered."""
 
-        years = cls.get_ng_years(user_id)
+        # one grouped query of the daily rollup instead of one per year
+        co2_per_year = DailyCO2Rollup.sum_co2_per_yr(user_id, "ng")
+
         this_year = date.today().year
         days_this_year = days_btw_today_and_jan1()
         co2_per_yr = {}
 
-        for year in years:
-            start_date = "1/1/%s" % (year)
-            end_date = "12/31/%s" % (year)
-            co2 = cls.sum_ng_co2(user_id, start_date, end_date)
-
+        for year, co2 in co2_per_year.items():
             if year != this_year:
                 co2_per_yr[year] = {"total": co2,
                                     "daily_avg": co2 / 365}
@@ -788,20 +1302,14 @@ class NGLog(db.Model):
 
     @classmethod
     def get_ng_years(cls, user_id):
-        """Sum the CO2 emissions from all of the electricity_logs within a
-        given date range"""
-
-        # Extract the year from the date object
-        def date_to_year(data_date):
-            return data_date.start_date.year
+        """Get the years that the user has logged natural gas in, in order."""
 
-        ngs = db.session.query(cls.start_date).filter(cls.residence.has(
-            Residence.user_id == user_id)).all()
+        year = func.extract('year', cls.start_date)
 
-        # get the year for each date object and then set() to remove duplicates
-        ng_years = sorted(set(map(date_to_year, ngs)))
+        ng_years = db.session.query(year).filter(
+            cls.residence.has(Residence.user_id == user_id)).distinct().all()
 
-        return ng_years
+        return sorted(int(ng_year) for ng_year, in ng_years)
 
     @classmethod
     def get_ng_summary(cls, user_id):
@@ -824,24 +1332,21 @@ class NGLog(db.Model):
         # summary for all data entered
         total_data = {}
         total_data["row_label"] = "Total"
-        total_data["total"] = round(cls.sum_ng_co2(user_id), 2)
+        total_data["total"] = DailyCO2Rollup.sum_co2(user_id, "ng")
         total_data["daily_avg"] = round(total_data["total"] / days, 2)
         total_data["monthly_avg"] = round(total_data["total"] / months, 2)
 
-        # summary per year
-        years = cls.get_ng_years(user_id)
-        years = years[::-1]
+        # summary per year, newest first
+        co2_per_year = DailyCO2Rollup.sum_co2_per_yr(user_id, "ng")
+        years = sorted(co2_per_year, reverse=True)
 
         data = OrderedDict()
 
         for year in years:
             year_data = {}
-            Jan_1 = "1/1/%s" % (year)
-            Dec_31 = "12/31/%s" % (year)
 
             year_data["row_label"] = year
-            year_data["total"] = round(cls.sum_ng_co2(
-                user_id, Jan_1, Dec_31), 2)
+            year_data["total"] = co2_per_year[year]
 
             if year != datetime.now().year:
                 year_data["daily_avg"] = round(year_data["total"] / 365, 2)
@@ -858,6 +1363,434 @@ class NGLog(db.Model):
 
         return data
 
+
+class DailyCO2Rollup(db.Model):
+    """Total CO2 per day for each of a user's residences and cars, kept up to
+    date as logs are added and edited so that sums don't have to rescan the raw
+    logs. Reloads of the emission factors recalculate it with
+    emission_factors_changed()."""
+
+    __tablename__ = 'daily_co2_rollup'
+
+    rollup_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'),
+                        nullable=False)
+    source = db.Column(db.String(8), nullable=False)  # trip, kwh or ng
+    residence_id = db.Column(db.Integer, db.ForeignKey('residences.residence_id'),
+                             nullable=True)
+    usercar_id = db.Column(db.Integer, db.ForeignKey('usercars.usercar_id'),
+                           nullable=True)
+    day = db.Column(db.Date, nullable=False)
+    co2 = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (db.Index('ix_daily_co2_rollup_user_source_day',
+                               'user_id', 'source', 'day'),)
+
+    def __repr__(self):
+        return "<Rollup User=%s, Source=%s, Residence=%s, Car=%s, Day=%s, CO2=%s>" % \
+            (self.user_id, self.source, self.residence_id, self.usercar_id,
+             self.day, self.co2)
+
+    @classmethod
+    def get_key(cls, log):
+        """Get the (source, user_id, residence_id, usercar_id, day) of the
+        rollup row that a trip, electricity or natural gas log is counted in."""
+
+        if isinstance(log, TripLog):
+            return ("trip", log.user_id, None, log.usercar_id, log.date)
+
+        user_id = db.session.query(Residence.user_id).filter(
+            Residence.residence_id == log.residence_id).scalar()
+
+        if isinstance(log, ElectricityLog):
+            return ("kwh", user_id, log.residence_id, None, log.start_date)
+        else:
+            return ("ng", user_id, log.residence_id, None, log.start_date)
+
+    @classmethod
+    def calculate_rows(cls, source, user_id=None, residence_id=None,
+                       usercar_id=None, day=None, start_day=None,
+                       end_day=None):
+        """Recalculate the daily CO2 from the raw logs of one source. Returns a
+        dictionary of CO2 keyed by (source, user_id, residence_id, usercar_id,
+        day), optionally limited to one user, residence or car and to one day
+        or the days from start_day to end_day."""
+
+        if source == "trip":
+            # SELECT user_id, usercar_id, date, SUM(miles)
+            # FROM trip_log
+            # GROUP BY user_id, usercar_id, date
+            query = db.session.query(TripLog.user_id, TripLog.usercar_id,
+                                     TripLog.date, func.sum(TripLog.miles)) \
+                .group_by(TripLog.user_id, TripLog.usercar_id, TripLog.date)
+
+            if user_id:
+                query = query.filter(TripLog.user_id == user_id)
+            if usercar_id:
+                query = query.filter(TripLog.usercar_id == usercar_id)
+            if day:
+                query = query.filter(TripLog.date == day)
+            if start_day:
+                query = query.filter(TripLog.date >= start_day)
+            if end_day:
+                query = query.filter(TripLog.date <= end_day)
+
+            # look each car's factor up once, not once per day it was driven,
+            # and price trips logged without a car like the other sums do
+            avg_grams_co2_mile_factors = {None: NO_CAR_GRAMS_CO2_MILE}
+
+            rows = {}
+            for trip_user_id, trip_usercar_id, trip_date, miles in query.all():
+                if trip_usercar_id not in avg_grams_co2_mile_factors:
+                    avg_grams_co2_mile_factors[trip_usercar_id] = \
+                        UserCar.query.get(
+                            trip_usercar_id).calculate_avg_grams_co2_mile()
+                avg_grams_co2_mile = avg_grams_co2_mile_factors[trip_usercar_id]
+                key = ("trip", trip_user_id, None, trip_usercar_id, trip_date)
+                rows[key] = miles * avg_grams_co2_mile * GRAMS_TO_LBS
+
+            return rows
+
+        if source == "kwh":
+            log = ElectricityLog
+            quantity = ElectricityLog.kwh
+        else:
+            log = NGLog
+            quantity = NGLog.therms
+
+        # SELECT r.user_id, l.residence_id, r.zipcode_id, l.start_date,
+        #        SUM(l.kwh)
+        # FROM electricity_log AS l
+        # JOIN residences AS r ON (l.residence_id=r.residence_id)
+        # GROUP BY r.user_id, l.residence_id, r.zipcode_id, l.start_date
+        query = db.session.query(Residence.user_id, log.residence_id,
+                                 Residence.zipcode_id, log.start_date,
+                                 func.sum(quantity)) \
+            .select_from(log) \
+            .join(Residence, log.residence_id == Residence.residence_id) \
+            .group_by(Residence.user_id, log.residence_id,
+                      Residence.zipcode_id, log.start_date)
+
+        if user_id:
+            query = query.filter(Residence.user_id == user_id)
+        if residence_id:
+            query = query.filter(log.residence_id == residence_id)
+        if day:
+            query = query.filter(log.start_date == day)
+        if start_day:
+            query = query.filter(log.start_date >= start_day)
+        if end_day:
+            query = query.filter(log.start_date <= end_day)
+
+        rows = {}
+        for (log_user_id, log_residence_id, zipcode_id, start_date,
+             total) in query.all():
+            if source == "kwh":
+                co2 = total * KWH_TO_MEGA_WH * \
+                    Zipcode.get_lb_co2e_mega_wh(zipcode_id)
+            else:
+                co2 = total * TONNES_CO2_PER_THERM * POUNDS_PER_TONNE
+
+            key = (source, log_user_id, log_residence_id, None, start_date)
+            rows[key] = co2
+
+        return rows
+
+    @classmethod
+    def refresh(cls, source, user_id, residence_id, usercar_id, day):
+        """Recalculate a single rollup row from the raw logs. The change is
+        left in the session to be committed with the logs."""
+
+        cls.query.filter_by(source=source, user_id=user_id,
+                            residence_id=residence_id, usercar_id=usercar_id,
+                            day=day).delete(synchronize_session=False)
+
+        # a trip without a car doesn't narrow the recalculation to one car,
+        # so keep only the row being refreshed
+        key = (source, user_id, residence_id, usercar_id, day)
+        rows = cls.calculate_rows(source, user_id, residence_id, usercar_id,
+                                  day)
+        cls.add_rows({key: rows[key]} if key in rows else {})
+
+    @classmethod
+    def update_for(cls, log, old_key=None):
+        """Update the rollup after a log has been added or edited. old_key is
+        the log's rollup key from before an edit, so the day it moved away from
+        is also recalculated. Call before committing the log."""
+
+        # write the log and reload its columns as dates and ids, not form text
+        db.session.flush()
+        db.session.expire(log)
+
+        keys = set([cls.get_key(log)])
+        if old_key:
+            keys.add(old_key)
+
+        for key in keys:
+            cls.refresh(*key)
+
+    @classmethod
+    def add_rows(cls, rows):
+        """Insert rollup rows from a dictionary of CO2 keyed by (source,
+        user_id, residence_id, usercar_id, day), as a single multi-row insert
+        in the session's transaction."""
+
+        if not rows:
+            return
+
+        db.session.execute(cls.__table__.insert(), [
+            {"source": source, "user_id": user_id,
+             "residence_id": residence_id, "usercar_id": usercar_id,
+             "day": day, "co2": co2}
+            for (source, user_id, residence_id, usercar_id, day), co2
+            in rows.items()])
+
+    @classmethod
+    def update_range(cls, user_id, start_day, end_day,
+                     sources=("trip", "kwh", "ng"), residence_id=None):
+        """Recalculate a user's rollup rows from start_day to end_day, after
+        logs in that range were loaded or replaced in bulk. Optionally limited
+        to some sources and one residence. The change is left in the session
+        to be committed with the logs."""
+
+        for source in sources:
+            query = cls.query.filter(cls.user_id == user_id,
+                                     cls.source == source,
+                                     cls.day >= start_day,
+                                     cls.day <= end_day)
+            if residence_id:
+                query = query.filter(cls.residence_id == residence_id)
+            query.delete(synchronize_session=False)
+
+            cls.add_rows(cls.calculate_rows(source, user_id, residence_id,
+                                            start_day=start_day,
+                                            end_day=end_day))
+
+    @classmethod
+    def rebuild(cls, user_id=None, sources=("trip", "kwh", "ng")):
+        """Throw away and recalculate the rollup for one user, or for everyone
+        if no user is given, optionally only for some sources. The change is
+        left in the session to be committed."""
+
+        query = cls.query.filter(cls.source.in_(sources))
+        if user_id:
+            query = query.filter_by(user_id=user_id)
+        query.delete(synchronize_session=False)
+
+        for source in sources:
+            cls.add_rows(cls.calculate_rows(source, user_id))
+
+    @classmethod
+    def check_consistency(cls, user_id=None, tolerance=0.01):
+        """Compare the rollup against a recalculation from the raw logs.
+        Returns a list of the rows that are missing, extra or differ by more
+        than the tolerance, as dictionaries."""
+
+        query = cls.query
+        if user_id:
+            query = query.filter_by(user_id=user_id)
+
+        rollup = {}
+        for row in query.all():
+            key = (row.source, row.user_id, row.residence_id, row.usercar_id,
+                   row.day)
+            rollup[key] = rollup.get(key, 0) + row.co2
+
+        raw = {}
+        for source in ("trip", "kwh", "ng"):
+            raw.update(cls.calculate_rows(source, user_id))
+
+        mismatches = []
+        for key in sorted(set(rollup) | set(raw)):
+            rollup_co2 = rollup.get(key)
+            raw_co2 = raw.get(key)
+
+            if (rollup_co2 is None or raw_co2 is None or
+                    abs(rollup_co2 - raw_co2) > tolerance):
+                source, row_user_id, residence_id, usercar_id, day = key
+                mismatches.append({"source": source,
+                                   "user_id": row_user_id,
+                                   "residence_id": residence_id,
+                                   "usercar_id": usercar_id,
+                                   "day": day,
+                                   "rollup_co2": rollup_co2,
+                                   "raw_co2": raw_co2})
+
+        return mismatches
+
+    @classmethod
+    def sum_co2(cls, user_id, source, start_date="1/1/1900",
+                end_date="1/1/2036", residence_id=None, usercar_id=None):
+        """Sum the CO2 emissions of one source within a given date range from
+        the rollup."""
+
+        query = db.session.query(func.sum(cls.co2)).filter(
+            cls.user_id == user_id,
+            cls.source == source,
+            cls.day >= start_date,
+            cls.day <= end_date)
+
+        if residence_id:
+            query = query.filter(cls.residence_id == residence_id)
+        if usercar_id:
+            query = query.filter(cls.usercar_id == usercar_id)
+
+        total_co2 = query.scalar() or 0
+
+        return round(total_co2, 2)
+
+    @classmethod
+    def sum_co2_per_yr(cls, user_id, source):
+        """Sum the CO2 emissions of one source in each year from the rollup.
+        Returns a dictionary of the totals keyed by year."""
+
+        year = func.extract('year', cls.day)
+
+        co2_per_year = db.session.query(year, func.sum(cls.co2)).filter(
+            cls.user_id == user_id,
+            cls.source == source).group_by(year).all()
+
+        return {int(rollup_year): round(co2, 2)
+                for rollup_year, co2 in co2_per_year}
+
+##############################################################################
+# Cache invalidation
+
+
+def clear_car_factor_cache(mapper, connection, target):
+    """Drop the cached car CO2 factors whenever the catalog changes."""
+
+    car_factor_cache.invalidate()
+
+
+def clear_car_catalog(mapper, connection, target):
+    """Rebuild the catalog tree and CO2 ranking whenever the catalog
+    changes."""
+
+    car_catalog_index.invalidate()
+    car_emissions_index.invalidate()
+
+
+def clear_zipcode_factor_index(mapper, connection, target):
+    """Reload the zipcode factors whenever the zipcodes or regions change."""
+
+    zipcode_factor_index.invalidate()
+
+
+def invalidate_co2_timelines(user_id=None):
+    """Drop the cached CO2 timelines of one user, or of everyone if no user is
+    given, straight away."""
+
+    if user_id is None:
+        co2_timeline_cache.invalidate()
+    else:
+        for source in ("trip", "kwh", "ng", "trip_miles"):
+            co2_timeline_cache.invalidate((user_id, source))
+
+
+def get_cached_co2_timeline(user_id, source, loader):
+    """Get one of the user's cached CO2 timelines, loading it with loader() if
+    it isn't cached yet or was cached at older data or reference versions.
+    Each worker process has its own cache, so a change committed by another
+    worker is only noticed through the versions it bumped."""
+
+    key = (user_id, source)
+    versions = User.get_data_versions(user_id)
+
+    def load():
+        return versions, loader()
+
+    cached_versions, timeline = co2_timeline_cache.get(key, load)
+
+    if cached_versions != versions:
+        co2_timeline_cache.invalidate(key)
+        cached_versions, timeline = co2_timeline_cache.get(key, load)
+
+    return timeline
+
+
+def expire_co2_timelines(user_id=None):
+    """Drop the cached CO2 timelines of one user, or of everyone if no user is
+    given, when the session's transaction is committed or rolled back. Until
+    then other requests can't see the change, and would cache the timelines
+    from before it again. Called after loads that write the logs without the
+    ORM."""
+
+    db.session.info.setdefault("expired_co2_timelines", set()).add(user_id)
+
+
+def emission_factors_changed(sources):
+    """Recalculate every user's rollup rows of the given sources, count a new
+    reference version and drop the cached CO2 timelines, after the regions, zipcodes or cars they were
+    calculated with were reloaded. Call once the factor caches have been
+    invalidated; the change is left in the session to be committed."""
+
+    DailyCO2Rollup.rebuild(sources=sources)
+    ReferenceVersion.bump()
+    expire_co2_timelines()
+
+
+def note_changed_co2_timelines(session, flush_context):
+    """Collect the users whose logs, cars or residences were written by a
+    flush, to drop their cached timelines when the transaction ends. The users
+    of electricity and natural gas logs are found through their loaded
+    residence, or with one query for all of the others."""
+
+    user_ids = set()
+    residence_ids = set()
+
+    for target in list(session.new) + list(session.dirty) + \
+            list(session.deleted):
+        if isinstance(target, (Car, Region, Zipcode)):
+            # the emission factors changed
+            user_ids.add(None)
+        elif isinstance(target, (TripLog, UserCar, Residence)):
+            user_ids.add(target.user_id)
+        elif isinstance(target, (ElectricityLog, NGLog)):
+            residence = target.__dict__.get("residence")
+            if residence is not None:
+                user_ids.add(residence.user_id)
+            else:
+                residence_ids.add(target.residence_id)
+
+    if residence_ids:
+        user_ids.update(user_id for user_id, in session.execute(
+            select([Residence.user_id])
+            .where(Residence.residence_id.in_(residence_ids))))
+
+    if user_ids:
+        session.info.setdefault("expired_co2_timelines", set()) \
+            .update(user_ids)
+
+
+def clear_expired_co2_timelines(session):
+    """Drop the cached timelines of the users changed in a transaction once it
+    has been committed, or rolled back, as they may have been cached from its
+    uncommitted rows."""
+
+    session.info.pop("data_versions", None)
+    user_ids = session.info.pop("expired_co2_timelines", None)
+
+    if not user_ids:
+        return
+
+    if None in user_ids:
+        invalidate_co2_timelines()
+    else:
+        for user_id in user_ids:
+            invalidate_co2_timelines(user_id)
+
+
+for change_event in ("after_insert", "after_update", "after_delete"):
+    event.listen(Car, change_event, clear_car_factor_cache)
+    event.listen(Car, change_event, clear_car_catalog)
+    event.listen(Region, change_event, clear_zipcode_factor_index)
+    event.listen(Zipcode, change_event, clear_zipcode_factor_index)
+
+event.listen(Session, "after_flush", note_changed_co2_timelines)
+event.listen(Session, "after_commit", clear_expired_co2_timelines)
+event.listen(Session, "after_rollback", clear_expired_co2_timelines)
+
 ##############################################################################
 # Helper functions
 
@@ -969,6 +1902,17 @@ def initialize_test_data():
     db.session.add_all([triplog_1, triplog_2, elect_log_1, elect_log_2, ng_log])
     db.session.commit()
 
+    DailyCO2Rollup.rebuild()
+    db.session.commit()
+
+
+def get_year_bounds(year):
+    """Get the first and last day of a year as date objects."""
+
+    year = int(year)
+
+    return date(year, 1, 1), date(year, 12, 31)
+
 
 def days_btw_today_and_jan1():
     now = datetime.now()
@@ -0,0 +1,168 @@
+"""Opt-in cProfile capture of single requests.
+
+Profiling is off unless a request asks for it with an X-Profile header that
+carries the PROFILE_TOKEN, or is picked at random with PROFILE_SAMPLE_RATE
+(0 to 1). A picked request runs under cProfile and its stats are written to
+PROFILE_DIR as a .prof file named after its time, route, user and duration,
+
+    20170301-120000-123456_dashboard_u1_153ms.prof
+
+which pstats, snakeviz or gprof2dot can load. Only the newest PROFILE_KEEP
+captures are kept.
+
+    PROFILE_DIR=profiles PROFILE_SAMPLE_RATE=0.01 PROFILE_TOKEN=...
+"""
+
+import cProfile
+import os
+import pstats
+import random
+import re
+import threading
+import time
+from datetime import datetime
+
+PROFILE_HEADER = "X-Profile"
+
+# 20170301-120000-123456_dashboard_u1_153ms.prof
+CAPTURE_NAME = re.compile(r"^(\d{8}-\d{6}-\d{6})_([\w.]+)_u(\w+)_(\d+)ms\.prof$")
+
+
+class RequestProfiler(object):
+    """Decides which requests to profile and keeps their captures in a
+    directory. The decision is counted and timed, so the cost of the hook on
+    requests that aren't profiled can be checked."""
+
+    def __init__(self, directory, sample_rate=0.0, token=None, keep=200):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.token = token
+        self.keep = keep
+        self.checks = 0
+        self.check_seconds = 0.0
+        self.captures = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<RequestProfiler Directory=%s, Rate=%s, Captures=%s>" % \
+            (self.directory, self.sample_rate, self.captures)
+
+    def should_profile(self, header_value=None):
+        """Decide whether to profile a request from its X-Profile header and
+        the sampling rate."""
+
+        start = time.time()
+
+        profile = bool(self.token and header_value == self.token) or \
+            (self.sample_rate > 0 and random.random() < self.sample_rate)
+
+        self.checks += 1
+        self.check_seconds += time.time() - start
+
+        return profile
+
+    def start(self):
+        """Start profiling the current thread. Returns the profile, which is
+        stopped by save()."""
+
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def save(self, profile, route, user_id, seconds):
+        """Stop a profile and write it to the capture directory. Returns the
+        capture's file name."""
+
+        profile.disable()
+
+        name = "%s_%s_u%s_%dms.prof" % (
+            datetime.now().strftime("%Y%m%d-%H%M%S-%f"),
+            re.sub(r"[^\w.]", "_", route or "not_found"),
+            user_id or "anon", seconds * 1000)
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # write it under a temporary name so the admin page never sees half
+        # of a capture
+        path = os.path.join(self.directory, name)
+        profile.dump_stats(path + ".tmp")
+        os.rename(path + ".tmp", path)
+
+        with self._lock:
+            self.captures += 1
+            self.prune()
+
+        return name
+
+    def prune(self):
+        """Delete the oldest captures beyond the newest keep."""
+
+        for name in self.get_names()[self.keep:]:
+            os.remove(os.path.join(self.directory, name))
+
+    def get_names(self):
+        """Get the file names of the captures, newest first."""
+
+        if not os.path.isdir(self.directory):
+            return []
+
+        return sorted((name for name in os.listdir(self.directory)
+                       if CAPTURE_NAME.match(name)), reverse=True)
+
+    def get_captures(self, limit=20, top=10):
+        """Get the newest captures as dictionaries, with their top functions
+        by cumulative time."""
+
+        captures = []
+        for name in self.get_names()[:limit]:
+            taken_at, route, user_id, ms = CAPTURE_NAME.match(name).groups()
+            captures.append({
+                "name": name,
+                "taken_at": datetime.strptime(taken_at, "%Y%m%d-%H%M%S-%f"),
+                "route": route,
+                "user_id": user_id,
+                "ms": int(ms),
+                "functions": self.get_top_functions(name, top)})
+
+        return captures
+
+    def get_top_functions(self, name, top=10):
+        """Get the functions of a capture that took the most cumulative time
+        as dictionaries."""
+
+        stats = pstats.Stats(os.path.join(self.directory, name))
+        stats.sort_stats("cumulative")
+
+        functions = []
+        for function in stats.fcn_list[:top]:
+            calls, primitive_calls, tottime, cumtime, callers = \
+                stats.stats[function]
+            filename, line, function_name = function
+            functions.append({
+                "function": "%s:%s(%s)" % (os.path.basename(filename), line,
+                                           function_name),
+                "calls": calls,
+                "tottime_ms": round(tottime * 1000, 2),
+                "cumtime_ms": round(cumtime * 1000, 2)})
+
+        return functions
+
+    def get_overhead(self):
+        """How many requests were checked and the average time the check took,
+        in microseconds."""
+
+        return {"checks": self.checks,
+                "captures": self.captures,
+                "avg_check_us": round(
+                    self.check_seconds * 1000000 / (self.checks or 1), 2)}
+
+
+def make_request_profiler():
+    """Set up the profiler from the environment. It is off unless
+    PROFILE_TOKEN or PROFILE_SAMPLE_RATE is set."""
+
+    return RequestProfiler(os.environ.get("PROFILE_DIR", "profiles"),
+                           float(os.environ.get("PROFILE_SAMPLE_RATE", 0)),
+                           os.environ.get("PROFILE_TOKEN") or None,
+                           int(os.environ.get("PROFILE_KEEP", 200)))
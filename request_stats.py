@@ -0,0 +1,245 @@
+"""Per-request SQL and timing statistics.
+
+Every SQL statement run by SQLAlchemy while a request is being handled is
+counted and timed, along with the rows it returned, so N+1 query patterns
+show up in the X-Query-Count and Server-Timing headers and in the request
+log instead of only as slow pages. Each route's requests are also totalled,
+with a latency histogram that /metrics exports, and routes that run more
+queries than their budget are flagged.
+"""
+
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+log = logging.getLogger("carbon_calc.requests")
+log.addHandler(logging.NullHandler())  # silent unless logging is configured
+
+# statistics of the request being handled by each thread
+_current = threading.local()
+
+# upper bounds of the request latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+class RequestStats(object):
+    """The queries, database time and rows of one request."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.rows = 0
+        self.seconds = None
+
+    def __repr__(self):
+        return "<RequestStats Queries=%s, DB=%.1fms, Rows=%s>" % \
+            (self.queries, self.db_seconds * 1000, self.rows)
+
+    def add_query(self, seconds, rows):
+        """Count a finished query."""
+
+        self.queries += 1
+        self.db_seconds += seconds
+        if rows > 0:
+            self.rows += rows
+
+    def finish(self):
+        """Stop the request's clock. Returns the wall time in seconds."""
+
+        self.seconds = time.time() - self.start
+        return self.seconds
+
+    def get_server_timing(self):
+        """Server-Timing header value with the database and total time."""
+
+        return 'db;dur=%.1f;desc="%s queries", total;dur=%.1f' % \
+            (self.db_seconds * 1000, self.queries,
+             (self.seconds or 0) * 1000)
+
+
+class RouteStats(object):
+    """Totals of every request to a route since the server started."""
+
+    def __init__(self, route):
+        self.route = route
+        self.requests = 0
+        self.over_budget = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.db_seconds = 0.0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        # requests per LATENCY_BUCKETS bucket, then those over the last one
+        self.latencies = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def __repr__(self):
+        return "<RouteStats Route=%s, Requests=%s>" % (self.route,
+                                                       self.requests)
+
+    def add(self, stats, over_budget=False):
+        """Add a finished request."""
+
+        self.requests += 1
+        self.over_budget += over_budget
+        self.queries += stats.queries
+        self.max_queries = max(self.max_queries, stats.queries)
+        self.db_seconds += stats.db_seconds
+        self.seconds += stats.seconds
+        self.max_seconds = max(self.max_seconds, stats.seconds)
+        self.latencies[bisect_left(LATENCY_BUCKETS, stats.seconds)] += 1
+
+    def to_dict(self):
+        """The totals and averages as a dictionary."""
+
+        requests = self.requests or 1
+
+        return {"route": self.route,
+                "requests": self.requests,
+                "over_budget": self.over_budget,
+                "avg_queries": round(float(self.queries) / requests, 1),
+                "max_queries": self.max_queries,
+                "avg_db_ms": round(self.db_seconds * 1000 / requests, 1),
+                "avg_ms": round(self.seconds * 1000 / requests, 1),
+                "max_ms": round(self.max_seconds * 1000, 1)}
+
+
+# RouteStats keyed on the route's endpoint
+route_stats = {}
+_route_stats_lock = threading.Lock()
+
+
+def start_request():
+    """Start counting the queries of the current thread's request."""
+
+    _current.stats = RequestStats()
+    return _current.stats
+
+
+def get_current_stats():
+    """Get the statistics of the current thread's request, None outside of a
+    request."""
+
+    return getattr(_current, "stats", None)
+
+
+def finish_request(route, budget=None):
+    """Stop counting the current request's queries and add it to its route's
+    totals. Returns (stats, over_budget), or (None, False) if no request was
+    started."""
+
+    stats = get_current_stats()
+    _current.stats = None
+
+    if stats is None:
+        return None, False
+
+    stats.finish()
+    over_budget = budget is not None and stats.queries > budget
+    add_route_request(route, stats, over_budget)
+
+    return stats, over_budget
+
+
+def add_route_request(route, stats, over_budget=False):
+    """Add a finished request's statistics to its route's totals."""
+
+    with _route_stats_lock:
+        if route not in route_stats:
+            route_stats[route] = RouteStats(route)
+        route_stats[route].add(stats, over_budget)
+
+
+def log_request(method, path, route, status, stats, budget=None,
+                over_budget=False):
+    """Write one JSON log line for a finished request, as a warning when the
+    route went over its query budget."""
+
+    line = json.dumps({"method": method,
+                       "path": path,
+                       "route": route,
+                       "status": status,
+                       "ms": round(stats.seconds * 1000, 1),
+                       "queries": stats.queries,
+                       "db_ms": round(stats.db_seconds * 1000, 1),
+                       "rows": stats.rows,
+                       "query_budget": budget,
+                       "over_budget": over_budget}, sort_keys=True)
+
+    if over_budget:
+        log.warning(line)
+    else:
+        log.info(line)
+
+
+def get_route_stats():
+    """Get the totals of every route as dictionaries, busiest first."""
+
+    with _route_stats_lock:
+        routes = [stats.to_dict() for stats in route_stats.values()]
+
+    return sorted(routes, key=lambda stats: -stats["requests"])
+
+
+def get_route_latencies():
+    """Get the latency histogram of every route, as (requests per bucket,
+    total seconds) keyed by route."""
+
+    with _route_stats_lock:
+        return {route: (list(stats.latencies), stats.seconds)
+                for route, stats in route_stats.items()}
+
+
+def reset_route_stats():
+    """Forget the route totals."""
+
+    with _route_stats_lock:
+        route_stats.clear()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context,
+                      executemany):
+    if get_current_stats() is not None:
+        conn.info.setdefault("query_start", []).append(time.time())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    stats = get_current_stats()
+    query_starts = conn.info.get("query_start")
+
+    if stats is None or not query_starts:
+        return
+
+    seconds = time.time() - query_starts.pop()
+
+    # rowcount is the number of rows a SELECT returned on PostgreSQL
+    rows = cursor.rowcount if statement.lstrip()[:6].upper() == "SELECT" \
+        else 0
+
+    stats.add_query(seconds, rows)
+
+
+@event.listens_for(Engine, "handle_error")
+def count_failed_query(context):
+    """Stop the timer of a statement that raised, so its start isn't left
+    behind for the next statement on the connection to pop. The statement
+    still counts, since it was sent to the database."""
+
+    stats = get_current_stats()
+    conn = context.connection
+    query_starts = conn.info.get("query_start") if conn is not None else None
+
+    if not query_starts:
+        return
+
+    seconds = time.time() - query_starts.pop()
+
+    if stats is not None:
+        stats.add_query(seconds, 0)
@@ -0,0 +1,50 @@
+"""Rebuild or check the daily CO2 rollup table.
+
+    python rollup.py rebuild [--user USER_ID]
+    python rollup.py check [--user USER_ID]
+"""
+
+import argparse
+from model import connect_to_db, db, DailyCO2Rollup
+from server import app
+
+
+def rebuild_rollup(user_id=None):
+    """Recalculate the rollup from the raw logs and commit it."""
+
+    print "\n Rebuild daily CO2 rollup \n"
+
+    DailyCO2Rollup.rebuild(user_id)
+    db.session.commit()
+
+
+def check_rollup(user_id=None):
+    """Print every rollup row that doesn't match the raw logs. Returns the
+    number of mismatched rows."""
+
+    print "\n Check daily CO2 rollup \n"
+
+    mismatches = DailyCO2Rollup.check_consistency(user_id)
+
+    for row in mismatches:
+        print "%(source)s user=%(user_id)s residence=%(residence_id)s " \
+            "car=%(usercar_id)s day=%(day)s rollup=%(rollup_co2)s " \
+            "raw=%(raw_co2)s" % row
+
+    print "%s mismatched rows" % len(mismatches)
+
+    return len(mismatches)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("command", choices=["rebuild", "check"])
+    parser.add_argument("--user", type=int, default=None)
+    args = parser.parse_args()
+
+    connect_to_db(app)
+
+    if args.command == "rebuild":
+        rebuild_rollup(args.user)
+    elif check_rollup(args.user):
+        raise SystemExit(1)
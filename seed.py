@@ -2,9 +2,14 @@
 
 from sqlalchemy import func
 from model import Region, Zipcode, Car, TransitType, ElectricityLog, NGLog, TripLog
+from model import User, Residence, DailyCO2Rollup, expire_co2_timelines
+from model import emission_factors_changed
 from model import connect_to_db, db
 from server import app
+from bulk_load import BulkLoader, blank_to_none
+from interval_data import load_daily_usage, read_usage_csv, parse_day
 import csv
+import logging
 
 
 def load_regions():
@@ -12,95 +17,110 @@ def load_regions():
 
     print "\n Regions \n"
 
-    # Read region file and insert data
-    for row in open("seed-data/regions.csv"):
-        row = row.rstrip()
-        region_id, name, lb_co2e_mega_wh = row.split(",")
+    def region_values(row):
+        region_id, name, lb_co2e_mega_wh = row.rstrip().split(",")
+        return region_id, name, float(lb_co2e_mega_wh)
 
-        region = Region(region_id=region_id, name=name,
-                        lb_co2e_mega_wh=lb_co2e_mega_wh)
-
-        # Add to the session so the data will be stored
-        db.session.add(region)
+    # Stream the region file into the table
+    loader = BulkLoader(Region.__table__,
+                        ["region_id", "name", "lb_co2e_mega_wh"])
+    with open("seed-data/regions.csv") as regions_file:
+        loader.load(regions_file, region_values)
 
     # Commit the changes to the database
     db.session.commit()
 
+    # Zipcode factors may be from the old reference tables
+    Zipcode.invalidate_factor_index()
+
+    # The daily electricity CO2 was calculated with the old factors
+    emission_factors_changed(["kwh"])
+    db.session.commit()
+
 
 def load_zipcodes():
     """Load zipcodes into database."""
 
     print "\n Zipcodes \n"
 
-    # Read zipcode file and insert data
-    for row in open("seed-data/zipcode-regions.csv"):
-        row = row.rstrip()
+    def zipcode_values(row):
         zipcode_id, state, region_id, secondary_region_id, tertiary_region_id \
-            = row.split(",")
+            = row.rstrip().split(",")
+        if not zipcode_id or not region_id:
+            raise ValueError("missing zipcode or region")
+        return zipcode_id, region_id
 
-        zipcode = Zipcode(zipcode_id=zipcode_id, region_id=region_id)
-
-        # Add to the session so the data will be stored
-        db.session.add(zipcode)
+    # Stream the zipcode file into the table
+    loader = BulkLoader(Zipcode.__table__, ["zipcode_id", "region_id"])
+    with open("seed-data/zipcode-regions.csv") as zipcodes_file:
+        loader.load(zipcodes_file, zipcode_values)
 
     # Commit the changes to the database
     db.session.commit()
 
+    # Zipcode factors may be from the old reference tables
+    Zipcode.invalidate_factor_index()
+
+    # The daily electricity CO2 was calculated with the old factors
+    emission_factors_changed(["kwh"])
+    db.session.commit()
+
 
 def load_cars():
     """Load cars into database."""
 
     print "\n Load Cars \n"
 
+    def car_values(row):
+        return (int(row["id"]),  # vehicle id
+                row["make"],  # manufacturer
+                row["model"],  # carline
+                row["fuelType1"],  # primary fuel
+                int(row["year"]),  # model year
+                row["cylinders"],
+                row["drive"],
+                row["engId"],
+                row["eng_dscr"],
+                row["displ"],  # engine displacement in liters
+                row["trans_dscr"],  # transmission descriptor
+                row["trany"],
+                blank_to_none(row["co2TailpipeGpm"], float),  # tailpipe CO2
+                blank_to_none(row["city08"], float),  # city MPG for fuelType1
+                blank_to_none(row["highway08"], float),  # highway MPG
+                blank_to_none(row["comb08"], float),  # combined MPG
+                )
+
+    loader = BulkLoader(Car.__table__,
+                        ["car_id", "make", "model", "fuel_type", "year",
+                         "cylinders", "drive", "eng_id", "eng_description",
+                         "displacement", "trans_description", "transmission",
+                         "grams_co2_mile", "mpg_street", "mpg_hw",
+                         "mpg_combo"])
+
     with open('seed-data/vehicles.csv') as csvfile:
         reader = csv.DictReader(csvfile)
-        for row in reader:
-            car = Car(car_id=row["id"],  # vehicle id
-                      make=row["make"],  # manufacturer
-                      model=row["model"],  # carline
-                      fuel_type=row["fuelType1"],  # primary fuel
-                      year=row["year"],  # model year
-                      cylinders=row["cylinders"],
-                      drive=row["drive"],
-                      eng_id=row["engId"],
-                      eng_description=row["eng_dscr"],
-                      displacement=row["displ"],  # engine displacement in liters
-                      trans_description=row["trans_dscr"],  # transmission descriptor
-                      transmission=row["trany"],
-                      grams_co2_mile=row["co2TailpipeGpm"],  # tailpipe CO2
-                      mpg_street=row["city08"],  # city MPG for fuelType1
-                      mpg_hw=row["highway08"],  # highway MPG for fuelType1
-                      mpg_combo=row["comb08"],  # combined MPG for fuelType1
-                      )
-
-            # Add to the session so the data will be stored
-            db.session.add(car)
+        loader.load(reader, car_values)
 
     # Commit the changes to the database
     db.session.commit()
 
+    # Cached CO2 factors and the dropdown tree may be from the old catalog
+    Car.invalidate_factor_cache()
+    Car.invalidate_catalog()
+
+    # The daily trip CO2 was calculated with the old factors
+    emission_factors_changed(["trip"])
+    db.session.commit()
+
 
 def load_daily_kwh(residence_id, csv_file):
     """Load kwh into database."""
 
     print "\n Load kwh \n"
 
-    with open(csv_file) as csvfile:
-        reader = csv.DictReader(csvfile)
-        kwh_data = {}
-        for row_dict in reader:
-            date = row_dict["DATE"]
-            usage = float(row_dict["USAGE"])
-
-            kwh_data[date] = kwh_data.get(date, 0) + usage
-
-        for date in kwh_data:
-            elect_log = ElectricityLog(residence_id=residence_id,
-                                       kwh=kwh_data[date],
-                                       start_date=date,
-                                       end_date=date
-                                       )
-            db.session.add(elect_log)
+    with open(csv_file) as usage_file:
+        load_daily_usage("kwh", residence_id, read_usage_csv(usage_file))
+
     db.session.commit()
 
 
@@ -109,22 +129,9 @@ def load_daily_ng(residence_id, csv_file):
 
     print "\n Load Natural Gas \n"
 
-    with open(csv_file) as csvfile:
-        reader = csv.DictReader(csvfile)
-        ng_data = {}
-        for row_dict in reader:
-            date = row_dict["DATE"]
-            usage = float(row_dict["USAGE"])
-
-            ng_data[date] = ng_data.get(date, 0) + usage
-
-        for date in ng_data:
-            ng_log = NGLog(residence_id=residence_id,
-                           therms=ng_data[date],
-                           start_date=date,
-                           end_date=date
-                           )
-            db.session.add(ng_log)
+    with open(csv_file) as usage_file:
+        load_daily_usage("ng", residence_id, read_usage_csv(usage_file))
+
     db.session.commit()
 
 
@@ -133,15 +140,30 @@ def load_bill_ng(residence_id, csv_file):
 
     print "\n Load Natural Gas \n"
 
+    days = set()
+
+    def ng_values(row):
+        if not row["START DATE"] or not row["END DATE"]:
+            raise ValueError("missing bill dates")
+        values = (residence_id, float(row["USAGE"]),
+                  parse_day(row["START DATE"]), parse_day(row["END DATE"]))
+        days.add(values[2])
+        return values
+
+    loader = BulkLoader(NGLog.__table__,
+                        ["residence_id", "therms", "start_date", "end_date"])
+
     with open(csv_file) as csvfile:
         reader = csv.DictReader(csvfile)
-        for row in reader:
-            ng_log = NGLog(residence_id=residence_id,
-                           therms=row["USAGE"],
-                           start_date=row["START DATE"],
-                           end_date=row["END DATE"]
-                           )
-            db.session.add(ng_log)
+        loader.load(reader, ng_values)
+
+    # Recalculate the user's daily CO2 of the bills in the same transaction
+    user_id = Residence.query.get(residence_id).user_id
+    if days:
+        DailyCO2Rollup.update_range(user_id, min(days), max(days), ["ng"],
+                                    residence_id)
+    expire_co2_timelines(user_id)
+    User.bump_data_version(user_id)
     db.session.commit()
 
 
@@ -150,17 +172,33 @@ def load_trips(csv_file):
 
     print "\n Load Trips \n"
 
+    # the days loaded for each user
+    user_days = {}
+
+    def trip_values(row):
+        values = (int(row["user_id"]),
+                  blank_to_none(row["usercar_id"], int),
+                  int(row["transportation_type"]),
+                  parse_day(row["date"]),
+                  float(row["miles"]),
+                  blank_to_none(row["number_of_passengers"], int),
+                  )
+        user_days.setdefault(values[0], set()).add(values[3])
+        return values
+
+    loader = BulkLoader(TripLog.__table__,
+                        ["user_id", "usercar_id", "transportation_type", "date",
+                         "miles", "number_of_passengers"])
+
     with open(csv_file) as csvfile:
         reader = csv.DictReader(csvfile)
-        for row in reader:
-            trip_log = TripLog(user_id=row["user_id"],
-                               usercar_id=row["usercar_id"],
-                               transportation_type=row["transportation_type"],
-                               date=row["date"],
-                               miles=row["miles"],
-                               number_of_passengers=row["number_of_passengers"],
-                               )
-            db.session.add(trip_log)
+        loader.load(reader, trip_values)
+
+    # Recalculate each user's daily CO2 of the trips in the same transaction
+    for user_id, days in user_days.items():
+        DailyCO2Rollup.update_range(user_id, min(days), max(days), ["trip"])
+        expire_co2_timelines(user_id)
+        User.bump_data_version(user_id)
     db.session.commit()
 
 
@@ -177,6 +215,9 @@ def load_transit_type():
 if __name__ == "__main__":
     connect_to_db(app)
 
+    # print the load report of each table, see bulk_load.py
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
     # Call functions to import the data
     # load_regions()
     # load_zipcodes()
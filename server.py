@@ -3,14 +3,32 @@
 from datetime import datetime, date, timedelta
 from jinja2 import StrictUndefined
 from flask import (Flask, render_template, redirect, request, flash,
-                   session, jsonify)
+                   session, jsonify, g, url_for, abort, send_from_directory)
 from flask_debugtoolbar import DebugToolbarExtension
 from model import (connect_to_db, db, User, Residence, ElectricityLog, NGLog,
-                   UserCar, Car, TripLog)
+                   UserCar, Car, TripLog, DailyCO2Rollup, Region, Zipcode,
+                   LOG_PAGE_SIZE, MAX_LOG_PAGE_SIZE, KWH_TO_MEGA_WH, GRAMS_TO_LBS,
+                   parse_log_cursor)
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy import func
-import requests
+from emissions import price_monthly, round_half_away
+from interval_data import load_daily_usage, read_intervals
+from trip_import import import_trips, read_trip_rows, read_trip_json
+from distance import (make_distance_resolver, DistanceError,
+                      DistanceConfigError)
+from zipcode_lookup import make_zipcode_resolver, ZipcodeError
+import request_stats
+import metrics
+from cache import get_cache_stats
+from request_profiler import make_request_profiler, PROFILE_HEADER
+import logging
 import os
+import time
+import json
+import gzip
+import hashlib
+from cStringIO import StringIO
+from functools import wraps
 from passlib.hash import pbkdf2_sha256
 
 # source misc/secrets.sh in terminal before running server
@@ -20,6 +38,201 @@ app = Flask(__name__)
 app.secret_key = "ABC"  # Required to use Flask sessions and the debug toolbar
 app.jinja_env.undefined = StrictUndefined  # Undefined variable in Jinja2 will raise an error.
 
+# looks up trip distances, see distance.py for the settings
+distance_resolver = make_distance_resolver()
+
+zipcode_resolver = make_zipcode_resolver()
+
+# profiles single requests on demand, see request_profiler.py for the settings
+request_profiler = make_request_profiler()
+
+# users who may see the profiles, a comma separated list of ids
+app.config["ADMIN_USER_IDS"] = set(
+    int(user_id) for user_id in os.environ.get("ADMIN_USER_IDS", "").split(",")
+    if user_id.strip())
+
+# most SQL queries a request should take, per endpoint where they differ
+app.config["QUERY_BUDGET"] = int(os.environ.get("QUERY_BUDGET", 25))
+app.config["QUERY_BUDGETS"] = {}
+
+
+def get_query_budget(endpoint):
+    """Get the most SQL queries a request to an endpoint should take."""
+
+    return app.config["QUERY_BUDGETS"].get(endpoint,
+                                           app.config["QUERY_BUDGET"])
+
+
+@app.before_request
+def start_request_timer():
+    """Note when the request started and start counting its SQL queries, so
+    its response time and queries can be reported."""
+
+    g.request_start = time.time()
+    request_stats.start_request()
+
+
+@app.after_request
+def add_response_time(response):
+    """Report how long the request took in the X-Response-Time header, in
+    milliseconds, and its SQL queries in the X-Query-Count and Server-Timing
+    headers. Every request is logged, as a warning if it took more queries
+    than its endpoint's budget."""
+
+    if hasattr(g, "request_start"):
+        elapsed_ms = (time.time() - g.request_start) * 1000
+        response.headers["X-Response-Time"] = "%.1fms" % elapsed_ms
+
+    route = request.endpoint or "not_found"
+    budget = get_query_budget(route)
+    stats, over_budget = request_stats.finish_request(route, budget)
+
+    if stats is not None:
+        response.headers["X-Query-Count"] = str(stats.queries)
+        response.headers["Server-Timing"] = stats.get_server_timing()
+        if over_budget:
+            response.headers["X-Query-Budget-Exceeded"] = str(budget)
+
+        request_stats.log_request(request.method, request.path, route,
+                                  response.status_code, stats, budget,
+                                  over_budget)
+
+    return response
+
+
+@app.before_request
+def start_profile():
+    """Run the view under cProfile if the request asked for it with the
+    X-Profile header or was picked by the sampling rate."""
+
+    if request_profiler.should_profile(request.headers.get(PROFILE_HEADER)):
+        g.profile_start = time.time()
+        g.profile = request_profiler.start()
+
+
+@app.after_request
+def save_profile(response):
+    """Write the request's profile, if it has one, and name the capture in the
+    X-Profile-Capture header."""
+
+    profile = g.pop("profile", None)
+
+    if profile is not None:
+        name = request_profiler.save(profile, request.endpoint,
+                                     session.get("user_id"),
+                                     time.time() - g.profile_start)
+        response.headers["X-Profile-Capture"] = name
+
+    return response
+
+
+@app.teardown_request
+def stop_profile(exception=None):
+    """Stop the profile of a request that failed before it could be saved, so
+    the thread isn't left profiling."""
+
+    profile = g.pop("profile", None)
+
+    if profile is not None:
+        profile.disable()
+
+
+@app.after_request
+def note_response_status(response):
+    """Keep the response's status for the request metrics."""
+
+    g.response_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def count_request(exception=None):
+    """Count the finished request for /metrics. A request that failed before
+    it had a response counts as a 500, and is added to its route's totals
+    here since add_response_time didn't run."""
+
+    if not hasattr(g, "request_start"):
+        return
+
+    route = request.endpoint or "not_found"
+    status = 500 if exception is not None else g.get("response_status", 500)
+
+    request_stats.finish_request(route, get_query_budget(route))
+    metrics.observe_request(route, request.method, status)
+
+
+GZIP_MIN_BYTES = 1024  # smaller responses aren't worth compressing
+GZIP_ETAG_SUFFIX = "-gzip"  # tells the gzip body's ETag from the plain one's
+
+
+@app.after_request
+def gzip_json(response):
+    """Compress large JSON responses for browsers that accept gzip. The
+    compressed body is a different representation, so it gets its own
+    strong ETag."""
+
+    if (response.mimetype != "application/json" or
+            response.status_code != 200 or
+            response.direct_passthrough or
+            "Content-Encoding" in response.headers or
+            "gzip" not in request.headers.get("Accept-Encoding", "").lower()):
+        return response
+
+    data = response.get_data()
+    if len(data) < GZIP_MIN_BYTES:
+        return response
+
+    buf = StringIO()
+    with gzip.GzipFile(mode="wb", fileobj=buf, compresslevel=6) as gzip_file:
+        gzip_file.write(data)
+
+    response.set_data(buf.getvalue())
+    response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(etag + GZIP_ETAG_SUFFIX, weak)
+
+    return response
+
+
+def versioned_json(view):
+    """Serve a chart's JSON with a strong ETag made from the user, the version
+    of their data, the version of the emission factors and the request's
+    parameters. When the browser already has that ETag, answer 304 Not
+    Modified without calculating the chart."""
+
+    @wraps(view)
+    def view_with_etag(*args, **kwargs):
+        user_id = session.get("user_id")
+        if not user_id:
+            return view(*args, **kwargs)
+
+        # the charts are priced with the shared emission factors, and the
+        # current year is projected from today's date, so include both
+        data_version, reference_version = User.get_data_versions(user_id)
+        etag = hashlib.md5(json.dumps([
+            user_id, data_version, reference_version,
+            date.today().isoformat(), request.path,
+            sorted(request.args.items(multi=True))])).hexdigest()
+
+        cached_etag = get_cached_etag(etag)
+        if cached_etag:
+            response = app.response_class(status=304)
+            response.set_etag(cached_etag)
+        else:
+            response = view(*args, **kwargs)
+            response.set_etag(etag)
+
+        # only this user's browser may keep it, and it must check first
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+
+        return response
+
+    return view_with_etag
+
 ###  Users, Login, Signup, Logout #############################################
 
 
@@ -32,18 +245,15 @@ def homepage():
 
     if user_id:
         name = User.query.get(user_id).name
-        years = set()
-        years.update(TripLog.get_trip_years(user_id),
-                     ElectricityLog.get_kwh_years(user_id),
-                     NGLog.get_ng_years(user_id)
-                     )
         this_year = date.today().year
 
         makes = Car.get_unique_makes()
         usercars = UserCar.query.filter_by(user_id=user_id).order_by(
             UserCar.is_default.desc(), UserCar.usercar_id.desc()).all()
 
+        # the yearly totals also give the years that have data
         co2_per_yr = get_yearly_totals(user_id)
+        years = co2_per_yr.keys()
 
         if co2_per_yr.get(this_year):
             trees_to_offset = int(round(
@@ -165,6 +375,7 @@ def add_residence():
     if is_default is None:
         is_default = False
 
+    User.bump_data_version(user_id)
     Residence.create(user_id, zipcode, name_or_address, is_default,
                      number_of_residents)
 
@@ -198,6 +409,7 @@ def edit_residence():
     edited_residence.number_of_residents = number_of_residents
     edited_residence.is_default = is_default
 
+    User.bump_data_version(user_id)
     db.session.commit()
 
     return redirect("/profile")
@@ -221,6 +433,7 @@ def add_car():
     else:
         is_default = True
 
+    User.bump_data_version(user_id)
     UserCar.create(user_id, make, model, year, cylinders, transmission,
                    is_default)
 
@@ -237,76 +450,109 @@ def get_car_data():
     cylinders = request.args.get('cylinders')
     transmission = request.args.get('transmission')
 
-    query = db.session.query(Car.make, Car.model, Car.year, Car.cylinders,
-                             Car.transmission)
+    # filters the in-memory catalog on the values the user has inputed
+    models = Car.get_catalog().find(make, model, year, cylinders,
+                                    transmission)
+
+    return jsonify(models)
 
-    # applies filters to the query based on what values the user has inputed
-    if make:
-        query = query.filter(Car.make == make).distinct()
 
-    if model:
-        query = query.filter(Car.model == model).distinct()
+@app.route("/cars/catalog.json", methods=["GET"])
+def get_car_catalog():
+    """Get the make > model > year > cylinders > transmissions tree of the
+    catalog, or the slice of it below the make, model, year and cylinders
+    given. Responses carry an ETag so browsers only download the catalog again
+    after it changes."""
 
-    if year:
-        query = query.filter(Car.year == year).distinct()
+    catalog = Car.get_catalog()
 
-    if cylinders:
-        query = query.filter(Car.cylinders == cylinders).distinct()
+    path = []
+    for level in ["make", "model", "year", "cylinders"]:
+        value = request.args.get(level)
+        if value is None:
+            break
+        path.append(value)
 
-    if transmission:
-        query = query.filter(Car.transmission == transmission).distinct()
+    # the whole tree is serialized once when the catalog is built
+    if not path:
+        return conditional_json(catalog.json, catalog.version)
 
-    models = []
+    etag = catalog.get_slice_etag(*path)
+    if etag in request.if_none_match:
+        return conditional_json("", etag)
 
-    # creates a list of dictionaries
-    for car_tuple in query.all():
-        car_dict = {}
-        car_dict["make"] = car_tuple[0]
-        car_dict["model"] = car_tuple[1]
-        car_dict["year"] = car_tuple[2]
-        car_dict["cylinders"] = car_tuple[3]
-        car_dict["transmission"] = car_tuple[4]
-        models.append(car_dict)
+    branch = catalog.get_slice(*path)
+    if branch is None:
+        return jsonify({}), 404
 
-    return jsonify(models)
+    return conditional_json(json.dumps(branch, sort_keys=True), etag)
 
 
 ###  Electricity Data #########################################################
 
 @app.route("/kwh-log", methods=["GET"])
 def view_kwh_log():
-    """Lists all kwh the user has entered. User can enter and edit data on this
-    page."""
+    """Lists the kwh the user has entered, a page at a time. User can enter and
+    edit data on this page."""
 
     user_id = session.get("user_id")
 
     if user_id:
 
-        electricity_logs = ElectricityLog.query.filter(
-            ElectricityLog.residence.has(Residence.user_id == user_id)
-            ).order_by(ElectricityLog.start_date.desc()).all()
+        page_args = get_log_page_args()
+        residence_id = request.args.get("residence_id", type=int)
+
+        electricity_logs, next_cursor = ElectricityLog.get_page(
+            user_id, residence_id=residence_id, **page_args)
 
         residences = Residence.query.filter_by(user_id=user_id).order_by(
             Residence.is_default.desc(), Residence.residence_id.desc()).all()
 
-        if electricity_logs:
+        years = list(reversed(ElectricityLog.get_kwh_years(user_id)))
+
+        if years:
             summary = ElectricityLog.get_electricity_summary(user_id)
         else:
             summary = None
 
-        years = reversed(ElectricityLog.get_kwh_years(user_id))
-
         return render_template("kwh-list.html",
                                electricity_logs=electricity_logs,
                                residences=residences,
                                summary=summary,
-                               years=years)
+                               years=years,
+                               filters=get_log_filters(residence_id=residence_id),
+                               next_page=get_next_page_url(next_cursor))
 
     # return to homepage when not logged in
     else:
         return redirect("/")
 
 
+@app.route("/kwh-log.json", methods=["GET"])
+def get_kwh_log_page():
+    """Get a page of the kwh the user has entered, for infinite scroll. Takes
+    the same paging and filter arguments as /kwh-log."""
+
+    user_id = session.get("user_id")
+
+    if not user_id:
+        return jsonify({"error": "Please log in"}), 401
+
+    electricity_logs, next_cursor = ElectricityLog.get_page(
+        user_id, residence_id=request.args.get("residence_id", type=int),
+        **get_log_page_args())
+
+    logs = [{"elect_id": log.elect_id,
+             "start_date": log.start_date.isoformat(),
+             "end_date": log.end_date.isoformat(),
+             "kwh": log.kwh,
+             "residence": log.residence.name_or_address,
+             "co2": round(log.co2_calc(), 2)}
+            for log in electricity_logs]
+
+    return jsonify({"logs": logs, "next": next_cursor})
+
+
 @app.route("/add-kwh", methods=["POST"])
 def add_kwh():
     """User kwh data for the user."""
@@ -330,6 +576,8 @@ def add_kwh():
                              residence_id=residence_id)
 
     db.session.add(new_kwh)
+    DailyCO2Rollup.update_for(new_kwh)
+    User.bump_data_version(user_id)
     db.session.commit()
 
     return redirect("/kwh-log")
@@ -349,53 +597,119 @@ def edit_kwh():
         user_id=user_id, name_or_address=name_or_address).one().residence_id
 
     edited_kwh = ElectricityLog.query.get(elect_id)
+    old_rollup_key = DailyCO2Rollup.get_key(edited_kwh)
 
     edited_kwh.start_date = start_date
     edited_kwh.end_date = end_date
     edited_kwh.kwh = kwh
     edited_kwh.residence_id = residence_id
 
+    DailyCO2Rollup.update_for(edited_kwh, old_rollup_key)
+    User.bump_data_version(user_id)
     db.session.commit()
 
     return redirect("/kwh-log")
 
 
+@app.route("/upload-usage", methods=["POST"])
+def upload_usage():
+    """Import a utility usage CSV or Green Button XML file as daily electricity
+    or natural gas logs. Days that were already uploaded are replaced."""
+
+    user_id = session.get("user_id")
+    usage_type = request.form.get("usage_type", "kwh")
+    name_or_address = request.form.get("residence")
+    usage_file = request.files.get("usage_file")
+
+    if usage_type == "ng":
+        log_page = "/ng-log"
+    else:
+        usage_type = "kwh"
+        log_page = "/kwh-log"
+
+    residence = Residence.query.filter_by(
+        user_id=user_id, name_or_address=name_or_address).first()
+
+    if not user_id or residence is None or usage_file is None:
+        flash("Please choose a residence and a file to upload.")
+        return redirect(log_page)
+
+    loader = load_daily_usage(usage_type, residence.residence_id,
+                              read_intervals(usage_file.stream,
+                                             usage_file.filename))
+    db.session.commit()
+
+    flash("Uploaded %s days of data (%s rows skipped)" %
+          (loader.loaded, loader.rejected))
+
+    return redirect(log_page)
+
+
 ###  Natural Gas Data #########################################################
 
 @app.route("/ng-log", methods=["GET"])
 def view_ng_log():
-    """Lists all kwh the user has entered. User can enter and edit data on this
-    page."""
+    """Lists the therms the user has entered, a page at a time. User can enter
+    and edit data on this page."""
 
     user_id = session.get("user_id")
 
     if user_id:
 
-        ng_logs = NGLog.query.filter(
-            NGLog.residence.has(Residence.user_id == user_id)
-            ).order_by(NGLog.start_date.desc()).all()
+        page_args = get_log_page_args()
+        residence_id = request.args.get("residence_id", type=int)
+
+        ng_logs, next_cursor = NGLog.get_page(
+            user_id, residence_id=residence_id, **page_args)
 
         residences = Residence.query.filter_by(user_id=user_id).order_by(
             Residence.is_default.desc(), Residence.residence_id.desc()).all()
 
-        if ng_logs:
+        years = list(reversed(NGLog.get_ng_years(user_id)))
+
+        if years:
             summary = NGLog.get_ng_summary(user_id)
         else:
             summary = None
 
-        years = reversed(NGLog.get_ng_years(user_id))
-
         return render_template("ng-list.html",
                                ng_logs=ng_logs,
                                residences=residences,
                                summary=summary,
-                               years=years)
+                               years=years,
+                               filters=get_log_filters(residence_id=residence_id),
+                               next_page=get_next_page_url(next_cursor))
 
     # return to homepage when not logged in
     else:
         return redirect("/")
 
 
+@app.route("/ng-log.json", methods=["GET"])
+def get_ng_log_page():
+    """Get a page of the therms the user has entered, for infinite scroll.
+    Takes the same paging and filter arguments as /ng-log."""
+
+    user_id = session.get("user_id")
+
+    if not user_id:
+        return jsonify({"error": "Please log in"}), 401
+
+    ng_logs, next_cursor = NGLog.get_page(
+        user_id, residence_id=request.args.get("residence_id", type=int),
+        **get_log_page_args())
+
+    logs = [{"ng_id": log.ng_id,
+             "start_date": log.start_date.isoformat(),
+             "end_date": log.end_date.isoformat(),
+             "therms": log.therms,
+             "residence": log.residence.name_or_address,
+             "co2": round(log.co2_calc(), 2)}
+            for log in ng_logs]
+
+    return jsonify({"logs": logs, "next": next_cursor})
+
+
 @app.route("/add-ng", methods=["POST"])
 def add_ng():
     """Add natural gas data for the user."""
@@ -415,6 +729,8 @@ def add_ng():
                        therms=therms, residence_id=residence_id)
 
     db.session.add(new_therms)
+    DailyCO2Rollup.update_for(new_therms)
+    User.bump_data_version(user_id)
     db.session.commit()
 
     return redirect("/ng-log")
@@ -434,12 +750,15 @@ def edit_ng():
         user_id=user_id, name_or_address=name_or_address).one().residence_id
 
     edited_ng = NGLog.query.get(ng_id)
+    old_rollup_key = DailyCO2Rollup.get_key(edited_ng)
 
     edited_ng.start_date = start_date
     edited_ng.end_date = end_date
     edited_ng.therms = therms
     edited_ng.residence_id = residence_id
 
+    DailyCO2Rollup.update_for(edited_ng, old_rollup_key)
+    User.bump_data_version(user_id)
     db.session.commit()
 
     return redirect("/ng-log")
@@ -449,54 +768,72 @@ def edit_ng():
 
 @app.route("/trip-log", methods=["GET"])
 def view_trip_log():
-    """Lists all trips the user has entered. User can enter and edit data on
-    this page."""
+    """Lists the trips the user has entered, a page at a time. User can enter
+    and edit data on this page."""
 
     user_id = session.get("user_id")
 
     if user_id:
 
-        trip_logs = TripLog.query.filter_by(user_id=user_id).order_by(
-            TripLog.date.desc(), TripLog.trip_id).all()
+        page_args = get_log_page_args()
+        usercar_id = request.args.get("usercar_id", type=int)
+
+        trip_logs, next_cursor = TripLog.get_page(
+            user_id, usercar_id=usercar_id, **page_args)
 
         usercars = UserCar.query.filter_by(user_id=user_id).order_by(
             UserCar.is_default.desc(), UserCar.usercar_id.desc()).all()
 
-        # pre-load all of the avgerage co2 factors for the usercars
-        avg_grams_co2_mile_factors = {}
-        for usercar in usercars:
-            if not avg_grams_co2_mile_factors.get(usercar.usercar_id):
-                avg_grams_co2_mile_factors[usercar.usercar_id] = \
-                    usercar.calculate_avg_grams_co2_mile()
+        # combine the trip objects with their co2 for passing into jinja
+        trips_and_co2 = zip(trip_logs, get_trip_co2s(user_id, trip_logs))
 
-        # calculate co2 for each trip the user has entered
-        trip_co2s = []
-        for trip in trip_logs:
-            avg_grams_co2_mile_factor = avg_grams_co2_mile_factors[trip.usercar_id]
-            co2 = round(trip.co2_calc(avg_grams_co2_mile_factor), 2)
-            trip_co2s.append(co2)
+        years = list(reversed(TripLog.get_trip_years(user_id)))
 
-        # combine the trip objects with the co2 results for passing into jinja
-        trips_and_co2 = zip(trip_logs, trip_co2s)
-
-        if trip_logs:
+        if years:
             summary = TripLog.get_trip_summary(user_id)
         else:
             summary = None
 
-        years = reversed(TripLog.get_trip_years(user_id))
-
         return render_template("trip-list.html",
                                trip_logs=trips_and_co2,
                                usercars=usercars,
                                summary=summary,
-                               years=years)
+                               years=years,
+                               filters=get_log_filters(usercar_id=usercar_id),
+                               next_page=get_next_page_url(next_cursor))
 
     # return to homepage when not logged in
     else:
         return redirect("/")
 
 
+@app.route("/trip-log.json", methods=["GET"])
+def get_trip_log_page():
+    """Get a page of the trips the user has entered, for infinite scroll.
+    Takes the same paging and filter arguments as /trip-log."""
+
+    user_id = session.get("user_id")
+
+    if not user_id:
+        return jsonify({"error": "Please log in"}), 401
+
+    trip_logs, next_cursor = TripLog.get_page(
+        user_id, usercar_id=request.args.get("usercar_id", type=int),
+        **get_log_page_args())
+
+    # trips logged without a car have no car to show
+    logs = [{"trip_id": trip.trip_id,
+             "date": trip.date.isoformat(),
+             "miles": trip.miles,
+             "usercar_id": trip.usercar_id,
+             "car": "%s %s %s" % (trip.usercar.make, trip.usercar.model,
+                                  trip.usercar.year) if trip.usercar else None,
+             "co2": co2}
+            for trip, co2 in zip(trip_logs, get_trip_co2s(user_id, trip_logs))]
+
+    return jsonify({"logs": logs, "next": next_cursor})
+
+
 @app.route("/add-trip", methods=["POST"])
 def add_trip():
     """Add transportation data for the user."""
@@ -514,6 +851,7 @@ def add_trip():
 
     user_id = session.get("user_id")
 
+    User.bump_data_version(user_id)
     TripLog.create(user_id, usercar_id, date, miles)
 
     return redirect("/trip-log")
@@ -529,16 +867,54 @@ def edit_trip():
     usercar_id = request.form.get("car")
 
     edited_trip = TripLog.query.get(trip_id)
+    old_rollup_key = DailyCO2Rollup.get_key(edited_trip)
 
     edited_trip.date = date
     edited_trip.miles = miles
     edited_trip.usercar_id = usercar_id
 
+    DailyCO2Rollup.update_for(edited_trip, old_rollup_key)
+    User.bump_data_version(session.get("user_id"))
     db.session.commit()
 
     return redirect("/trip-log")
 
 
+@app.route("/import-trips", methods=["POST"])
+def import_trip_batch():
+    """Import a batch of trips from an uploaded CSV or JSON file, or a JSON
+    request body. Trips without miles get the distance between their origin
+    and destination. Returns how many trips were imported and the errors of
+    the rows that were skipped."""
+
+    user_id = session.get("user_id")
+
+    if not user_id:
+        return jsonify({"error": "Please log in"}), 401
+
+    trip_file = request.files.get("trip_file")
+
+    try:
+        if trip_file is not None:
+            rows = read_trip_rows(trip_file.stream, trip_file.filename)
+        else:
+            rows = read_trip_json(request.get_json(force=True, silent=True))
+    except ValueError as e:
+        return jsonify({"error": "Could not read the trips: %s" % e}), 400
+
+    try:
+        loader = import_trips(user_id, rows, distance_resolver)
+    except DistanceConfigError:
+        return jsonify({"error": "Distances can't be looked up right now, "
+                                 "please enter miles instead"}), 503
+
+    db.session.commit()
+
+    return jsonify({"imported": loader.loaded,
+                    "rejected": loader.rejected,
+                    "errors": loader.errors})
+
+
 @app.route("/get-distance", methods=["GET"])
 def get_distance():
     """Get the distance from google distance matrix api based on the origin
@@ -546,87 +922,40 @@ def get_distance():
 
     origin = request.args.get('origin')
     destination = request.args.get('destination')
-    api_key = os.environ['GOOGLE_API_KEY']
-
-    payload = {"units": "imperial",
-               "origins": origin,
-               "destinations": destination,
-               "key": api_key,
-               "mode": "driving"
-               }
-
-    r = requests.get("https://maps.googleapis.com/maps/api/distancematrix/json?",
-                     params=payload)
-
-    distance_info = r.json()
-
-    # Gets the distance value from the returned JSON
 
-    ## either add in a try/except use .get() to make better error messages and so
-    # server doesn't fail
-    distance_meters = distance_info["rows"][0]["elements"][0]["distance"]["value"]
-    meters_to_miles = 0.00062137  # 0.00062137 miles in 1 meter
-    distance_miles = distance_meters * meters_to_miles
+    try:
+        distance_miles = distance_resolver.get_miles(origin, destination)
+    except DistanceError:
+        return "Distance not found", 404
+    except DistanceConfigError:
+        return "Distance lookups are not available", 503
 
-    return str(round(distance_miles, 2))
+    return str(distance_miles)
 
 
 ###  Homepage Charts ##########################################################
 
 @app.route("/year-comparison-json", methods=["GET"])
+@versioned_json
 def get_year_comparison_data():
 
     user_id = session.get("user_id")
 
-    years = [2017, 2016, 2015, 2014]
-    this_year = date.today().year
-    days_this_year = days_btw_today_and_jan1()
-
-    trip_co2 = TripLog.get_co2_per_yr(user_id)
-    kwh_co2 = ElectricityLog.get_co2_per_yr(user_id)
-    ng_co2 = NGLog.get_co2_per_yr(user_id)
-
-    co2_per_yr = []
-
-    for year in years:
-        total = 0
-        if trip_co2.get(year):
-            total += trip_co2[year]["total"]
-        if kwh_co2.get(year):
-            total += kwh_co2[year]["total"]
-        if ng_co2.get(year):
-            total += ng_co2[year]["total"]
-
-        if year != this_year:
-            co2_per_yr.append(round(total, 2))
-        else:
-            yr_projected = round(total / days_this_year, 2) * 365
-            co2_per_yr.append(yr_projected)
-
-    return jsonify(co2_per_yr)
+    return jsonify(get_year_comparison(get_co2_per_yr_per_source(user_id)))
 
 
 @app.route("/co2-per-datatype.json", methods=["GET"])
+@versioned_json
 def get_co2_per_datatype():
 
     user_id = session.get("user_id")
     year = request.args.get("year")
 
-    start_date = "1/1/1900"
-    end_date = "1/1/2036"
-
-    if year != "ALL YEARS":
-        start_date = "1/1/%s" % (year)
-        end_date = "12/31/%s" % (year)
-
-    trip_co2 = TripLog.sum_trip_co2(user_id, start_date, end_date)
-    kwh_co2 = ElectricityLog.sum_kwh_co2(user_id, start_date, end_date)
-    ng_co2 = NGLog.sum_ng_co2(user_id, start_date, end_date)
-
-    return jsonify([trip_co2, kwh_co2, ng_co2])
+    return jsonify(get_co2_per_datatype_for_year(user_id, year))
 
 
 @app.route("/co2-trend.json", methods=["GET"])
+@versioned_json
 def get_co2_trend():
     """Calculate the monthly CO2 for each CO2 source for a given year and
     return as json."""
@@ -634,30 +963,11 @@ def get_co2_trend():
     user_id = session.get("user_id")
     year = request.args.get("year")
 
-    months = {1: 31, 2: 28, 3: 31, 4: 30, 5: 31, 6: 30, 7: 31, 8: 31, 9: 30,
-              10: 31, 11: 30, 12: 31}
-
-    months = sorted(months.items())
-    trip_co2_per_month = []
-    kwh_co2_per_month = []
-    ng_co2_per_month = []
-
-    for month in months:
-        start_date = "%s/1/%s" % (month[0], year)
-        end_date = "%s/%s/%s" % (month[0], month[1], year)
-        trip_co2_per_month.append(
-            TripLog.sum_trip_co2(user_id, start_date, end_date))
-        kwh_co2_per_month.append(
-            ElectricityLog.sum_kwh_co2(user_id, start_date, end_date))
-        ng_co2_per_month.append(
-            NGLog.sum_ng_co2(user_id, start_date, end_date))
-
-    return jsonify({"trip": trip_co2_per_month,
-                    "kwh": kwh_co2_per_month,
-                    "ng": ng_co2_per_month})
+    return jsonify(get_co2_trend_for_year(user_id, year))
 
 
 @app.route("/co2-other-location.json", methods=["GET"])
+@versioned_json
 def get_co2_other_location():
     """Calculate the kwh CO2 for the user's current residence and as well as the
     potential CO2 at a different location and return as JSON."""
@@ -666,58 +976,50 @@ def get_co2_other_location():
     year = request.args.get("year")
     zipcode = request.args.get("zipcode")
 
-    months = {1: 31, 2: 28, 3: 31, 4: 30, 5: 31, 6: 30, 7: 31, 8: 31, 9: 30,
-              10: 31, 11: 30, 12: 31}
-
-    months = sorted(months.items())
-
-    kwh_co2_per_month = []
-    kwh_co2_per_month_other_location = []
-
     if datetime.now().year == int(year):
         days = days_btw_today_and_jan1()
     else:
         days = 365
 
-    for month in months:
-        start_date = "%s/1/%s" % (month[0], year)
-        end_date = "%s/%s/%s" % (month[0], month[1], year)
+    # load the monthly kWh once and price them at the other location, instead
+    # of two sums per month
+    kwh_co2_per_month = ElectricityLog.sum_kwh_co2_per_month(user_id,
+                                                             int(year))
+    monthly_kwh = ElectricityLog.sum_kwh_per_month(user_id, int(year))
+    lbs_co2_kwh = Zipcode.get_lb_co2e_mega_wh(zipcode) * KWH_TO_MEGA_WH
 
-        # CO2 per month
-        kwh_co2_per_month.append(
-            ElectricityLog.sum_kwh_co2(user_id, start_date, end_date))
-        kwh_co2_per_month_other_location.append(
-            ElectricityLog.sum_kwh_co2_other_location(user_id, zipcode,
-                                                      start_date, end_date))
+    co2_per_month = price_monthly(monthly_kwh, [lbs_co2_kwh])[0]
+    kwh_co2_per_month_other_location = \
+        round_half_away(co2_per_month[0], 2).tolist()
 
-        # CO2 per day (rate)
-        co2_daily_rate = round(sum(kwh_co2_per_month) / days, 2)
-        co2_daily_rate_other_location = round(sum(
-            kwh_co2_per_month_other_location) / days, 2)
+    # CO2 per day (rate)
+    co2_daily_rate = round(sum(kwh_co2_per_month) / days, 2)
+    co2_daily_rate_other_location = round(sum(
+        kwh_co2_per_month_other_location) / days, 2)
 
-        # Total CO2 for the year
-        kwh_co2_per_year = round(sum(kwh_co2_per_month), 2)
-        kwh_co2_per_year_other_location = round(sum(
-            kwh_co2_per_month_other_location), 2)
+    # Total CO2 for the year
+    kwh_co2_per_year = round(sum(kwh_co2_per_month), 2)
+    kwh_co2_per_year_other_location = round(sum(
+        kwh_co2_per_month_other_location), 2)
 
-        # percent change = (current - new) / current * 100
-        try:
-            percent_change = int(abs(
-                kwh_co2_per_year - kwh_co2_per_year_other_location
-                ) / kwh_co2_per_year * 100)
-        except ZeroDivisionError:
-            percent_change = None
-
-        if percent_change is None:
-            statement = "There is no data for that year to compare."
-        elif kwh_co2_per_year > kwh_co2_per_year_other_location:
-            statement = "This location {} your carbon footprint by {}%".format(
-                "decreases", percent_change)
-        elif kwh_co2_per_year < kwh_co2_per_year_other_location:
-            statement = "This location {} your carbon footprint by {}%".format(
-                "increases", percent_change)
-        elif kwh_co2_per_year == kwh_co2_per_year_other_location:
-            statement = "This location doesn't change the carbon footprint"
+    # percent change = (current - new) / current * 100
+    try:
+        percent_change = int(abs(
+            kwh_co2_per_year - kwh_co2_per_year_other_location
+            ) / kwh_co2_per_year * 100)
+    except ZeroDivisionError:
+        percent_change = None
+
+    if percent_change is None:
+        statement = "There is no data for that year to compare."
+    elif kwh_co2_per_year > kwh_co2_per_year_other_location:
+        statement = "This location {} your carbon footprint by {}%".format(
+            "decreases", percent_change)
+    elif kwh_co2_per_year < kwh_co2_per_year_other_location:
+        statement = "This location {} your carbon footprint by {}%".format(
+            "increases", percent_change)
+    elif kwh_co2_per_year == kwh_co2_per_year_other_location:
+        statement = "This location doesn't change the carbon footprint"
 
     return jsonify({"current_monthly_co2": kwh_co2_per_month,
                     "new_monthly_co2": kwh_co2_per_month_other_location,
@@ -735,92 +1037,143 @@ def get_zipcode():
 
     city = request.args.get('city')
     state = request.args.get('state')
-    api_key = os.environ['ZIP_CODE_API_KEY']
 
-    params = {"api_key": api_key,
-              "city": city,
-              "state": state,
-              }
+    try:
+        return zipcode_resolver.get_zipcode(city, state)
+    except ZipcodeError:
+        return "Zipcode not found", 404
+
+
+@app.route("/zipcodes.json", methods=["GET"])
+def get_city_zipcodes():
+    """Get every zipcode of a city with its grid region."""
+
+    city = request.args.get('city')
+    state = request.args.get('state')
+
+    try:
+        zipcodes = zipcode_resolver.get_candidates(city, state)
+    except ZipcodeError:
+        return jsonify({"error": "Zipcode not found"}), 404
+
+    return jsonify({"zipcodes": zipcodes})
+
+
+@app.route("/co2-all-locations.json", methods=["GET"])
+@versioned_json
+def get_co2_all_locations():
+    """Price the user's electricity for a year in every grid region and return
+    the regions ranked from lowest to highest CO2, to show the best and worst
+    places to live. The monthly kWh are loaded once and multiplied by every
+    region factor at the same time."""
 
-    #  https://www.zipcodeapi.com/rest/<api_key>/city-zips.<format>/<city>/<state>
-    url = "https://www.zipcodeapi.com/rest/{api_key}/city-zips.json/{city}/{state}".format(**params)
-    print url
+    user_id = session.get("user_id")
+    year = request.args.get("year", date.today().year, type=int)
+
+    monthly_kwh = ElectricityLog.sum_kwh_per_month(user_id, year)
+    current_monthly_co2 = ElectricityLog.sum_kwh_co2_per_month(user_id, year)
+    current_co2 = round(sum(current_monthly_co2), 2)
+
+    regions = Region.get_factors()
+    lbs_co2_kwh = [lb_co2e_mega_wh * KWH_TO_MEGA_WH
+                   for region_id, name, lb_co2e_mega_wh in regions]
 
-    r = requests.get(url)
-    zipcode_info = r.json()
+    co2_per_month, co2_per_year = price_monthly(monthly_kwh, lbs_co2_kwh)
+    co2_per_month = round_half_away(co2_per_month, 2)
+    co2_per_year = round_half_away(co2_per_year, 2)
 
-    zipcode = zipcode_info["zip_codes"][0]
+    ranked_regions = []
+    for rank, i in enumerate(co2_per_year.argsort(kind="mergesort"), 1):
+        region_id, name, lb_co2e_mega_wh = regions[i]
+        annual_co2 = float(co2_per_year[i])
+
+        # percent change = (new - current) / current * 100
+        if current_co2:
+            percent_change = int(round(
+                (annual_co2 - current_co2) / current_co2 * 100))
+        else:
+            percent_change = None
 
-    return zipcode
+        ranked_regions.append({"rank": rank,
+                               "region_id": region_id,
+                               "name": name,
+                               "lb_co2e_mega_wh": lb_co2e_mega_wh,
+                               "annual_co2": annual_co2,
+                               "monthly_co2": co2_per_month[i].tolist(),
+                               "percent_change": percent_change})
+
+    return jsonify({"year": year,
+                    "monthly_kwh": monthly_kwh,
+                    "current_annual_co2": current_co2,
+                    "current_monthly_co2": current_monthly_co2,
+                    "regions": ranked_regions})
 
 
 @app.route("/co2-other-car.json", methods=["GET"])
+@versioned_json
 def get_co2_other_car():
     """Calculate the trip CO2 for the user's current car and as well as the
     potential CO2 at a different car and return as JSON."""
 
     user_id = session.get("user_id")
-    trip_year = request.args.get("tripYear")
-    usercar_id = request.args.get("userCarId")
+    trip_year = int(request.args.get("tripYear"))
+    usercar_id = request.args.get("userCarId", type=int)
     make = request.args.get("make")
     model = request.args.get("model")
     car_year = request.args.get("carYear")
     cylinders = request.args.get("cylinders")
     transmission = request.args.get("transmission")
 
-    months = {1: 31, 2: 28, 3: 31, 4: 30, 5: 31, 6: 30, 7: 31, 8: 31, 9: 30,
-              10: 31, 11: 30, 12: 31}
+    if datetime.now().year == trip_year:
+        days = days_btw_today_and_jan1() or 1
+    else:
+        days = 365
 
-    months = sorted(months.items())
+    # the miles per month come from the cached vector, so the other car's CO2
+    # is one factor lookup instead of a query per month
+    try:
+        monthly_miles, trip_co2_per_month = get_trip_miles_and_co2_per_month(
+            user_id, trip_year, usercar_id)
+    except KeyError:
+        monthly_miles, trip_co2_per_month = [0] * 12, [0] * 12
+
+    if any(monthly_miles):
+        lbs_co2_mile_other_car = Car.get_avg_grams_co2_mile(
+            make, model, car_year, cylinders, transmission) * GRAMS_TO_LBS
+    else:
+        lbs_co2_mile_other_car = 0
 
-    trip_co2_per_month = []
-    trip_co2_per_month_other_car = []
+    trip_co2_per_month_other_car = [round(miles * lbs_co2_mile_other_car, 2)
+                                    for miles in monthly_miles]
 
-    if datetime.now().year == int(trip_year):
-        days = days_btw_today_and_jan1()
-    else:
-        days = 365
+    # CO2 per day (rate)
+    co2_daily_rate = round(sum(trip_co2_per_month) / days, 2)
+    co2_daily_rate_other_car = round(sum(
+        trip_co2_per_month_other_car) / days, 2)
 
-    for month in months:
-        start_date = "%s/1/%s" % (month[0], trip_year)
-        end_date = "%s/%s/%s" % (month[0], month[1], trip_year)
-
-        # CO2 per month
-        trip_co2_per_month.append(
-            TripLog.sum_trip_co2(user_id, start_date, end_date, usercar_id))
-
-        trip_co2_per_month_other_car.append(
-            TripLog.sum_trip_co2_other_car(user_id, make, model, car_year,
-                                           cylinders, transmission, start_date,
-                                           end_date, usercar_id))
-        # CO2 per day (rate)
-        co2_daily_rate = round(sum(trip_co2_per_month) / days, 2)
-        co2_daily_rate_other_car = round(sum(
-            trip_co2_per_month_other_car) / days, 2)
-
-        # Total CO2 for the year
-        trip_co2_per_year = round(sum(trip_co2_per_month), 2)
-        trip_co2_per_year_other_car = round(sum(
-            trip_co2_per_month_other_car), 2)
-
-        # percent change = (current - new) / current * 100
-        try:
-            percent_change = int(abs(
-                trip_co2_per_year - trip_co2_per_year_other_car
-                ) / trip_co2_per_year * 100)
-        except ZeroDivisionError:
-            percent_change = None
+    # Total CO2 for the year
+    trip_co2_per_year = round(sum(trip_co2_per_month), 2)
+    trip_co2_per_year_other_car = round(sum(
+        trip_co2_per_month_other_car), 2)
 
-        if percent_change is None:
-            statement = "There is no data for that year to compare."
-        elif trip_co2_per_year > trip_co2_per_year_other_car:
-            statement = "This car {} your carbon footprint by {}%".format(
-                "decreases", percent_change)
-        elif trip_co2_per_year < trip_co2_per_year_other_car:
-            statement = "This car {} your carbon footprint by {}%".format(
-                "increases", percent_change)
-        elif trip_co2_per_year == trip_co2_per_year_other_car:
-            statement = "This car doesn't change the carbon footprint"
+    # percent change = (current - new) / current * 100
+    try:
+        percent_change = int(abs(
+            trip_co2_per_year - trip_co2_per_year_other_car
+            ) / trip_co2_per_year * 100)
+    except ZeroDivisionError:
+        percent_change = None
+
+    if percent_change is None:
+        statement = "There is no data for that year to compare."
+    elif trip_co2_per_year > trip_co2_per_year_other_car:
+        statement = "This car {} your carbon footprint by {}%".format(
+            "decreases", percent_change)
+    elif trip_co2_per_year < trip_co2_per_year_other_car:
+        statement = "This car {} your carbon footprint by {}%".format(
+            "increases", percent_change)
+    elif trip_co2_per_year == trip_co2_per_year_other_car:
+        statement = "This car doesn't change the carbon footprint"
 
     return jsonify({"current_monthly_co2": trip_co2_per_month,
                     "new_monthly_co2": trip_co2_per_month_other_car,
@@ -832,7 +1185,156 @@ def get_co2_other_car():
                     })
 
 
+@app.route("/co2-other-cars.json", methods=["POST"])
+def get_co2_other_cars():
+    """Compare the trip CO2 of the user's car, or all of their cars, for a year
+    with several candidate cars at once. Takes a JSON body of
+
+        {"tripYear": 2017, "userCarId": 1,
+         "candidates": [{"make": ..., "model": ..., "year": ...,
+                         "cylinders": ..., "transmission": ...}, ...]}
+
+    The user's miles per month come from a cached vector and each candidate's
+    CO2 factor is looked up once, so the time doesn't grow with the number of
+    trips."""
+
+    user_id = session.get("user_id")
+
+    if not user_id:
+        return jsonify({"error": "Please log in"}), 401
+
+    data = request.get_json(force=True, silent=True) or {}
+    candidates = data.get("candidates")
+
+    try:
+        trip_year = int(data.get("tripYear") or date.today().year)
+        usercar_id = int(data["userCarId"]) if data.get("userCarId") else None
+    except (TypeError, ValueError):
+        return jsonify({"error": "Unknown year or car"}), 400
+
+    if not isinstance(candidates, list) or not candidates or \
+            len(candidates) > MAX_CAR_CANDIDATES:
+        return jsonify({"error": "Send 1 to %s candidate cars" %
+                        MAX_CAR_CANDIDATES}), 400
+
+    try:
+        monthly_miles, current_monthly_co2 = get_trip_miles_and_co2_per_month(
+            user_id, trip_year, usercar_id)
+    except KeyError:
+        return jsonify({"error": "Unknown year or car"}), 400
+
+    current_co2 = round(sum(current_monthly_co2), 2)
+
+    if datetime.now().year == trip_year:
+        days = days_btw_today_and_jan1() or 1
+    else:
+        days = 365
+
+    # look each candidate's factor up once
+    comparisons = []
+    lbs_co2_mile = []
+    for candidate in candidates:
+        comparison = {level: candidate.get(level)
+                      for level in ["make", "model", "year", "cylinders",
+                                    "transmission"]} \
+            if isinstance(candidate, dict) else {}
+
+        try:
+            avg_grams_co2_mile = Car.get_avg_grams_co2_mile(**comparison)
+        except (TypeError, ValueError, ZeroDivisionError):
+            comparison["error"] = "Car not found"
+        else:
+            comparison["avg_grams_co2_mile"] = round(avg_grams_co2_mile, 2)
+            lbs_co2_mile.append(avg_grams_co2_mile * GRAMS_TO_LBS)
+
+        comparisons.append(comparison)
+
+    if lbs_co2_mile:
+        co2_per_month, co2_per_year = price_monthly(monthly_miles,
+                                                    lbs_co2_mile)
+        co2_per_month = round_half_away(co2_per_month, 2)
+        co2_per_year = round_half_away(co2_per_year, 2)
+
+    priced = 0
+    for comparison in comparisons:
+        if "error" in comparison:
+            continue
+
+        yearly_co2 = float(co2_per_year[priced])
+        comparison["monthly_co2"] = co2_per_month[priced].tolist()
+        comparison["yearly_co2"] = yearly_co2
+        comparison["daily_rate"] = round(yearly_co2 / days, 2)
+
+        # percent change = (new - current) / current * 100
+        if current_co2:
+            comparison["percent_change"] = int(round(
+                (yearly_co2 - current_co2) / current_co2 * 100))
+        else:
+            comparison["percent_change"] = None
+
+        priced += 1
+
+    return jsonify({"year": trip_year,
+                    "usercar_id": usercar_id,
+                    "monthly_miles": monthly_miles,
+                    "current_monthly_co2": current_monthly_co2,
+                    "current_yearly_co2": current_co2,
+                    "current_daily_rate": round(current_co2 / days, 2),
+                    "candidates": comparisons})
+
+
+@app.route("/cars/recommendations.json", methods=["GET"])
+@versioned_json
+def get_car_recommendations():
+    """Get the k cars of the whole catalog that would have put out the least
+    CO2 for the user's driving in a year (the latest year with trips by
+    default). Takes optional make, fuel_type, drive, min_year and max_year
+    filters. Cars rated at 0 grams of CO2 per mile are only included with
+    include_zero=1."""
+
+    user_id = session.get("user_id")
+
+    trip_years = TripLog.get_trip_years(user_id)
+    trip_year = request.args.get(
+        "tripYear", trip_years[-1] if trip_years else date.today().year,
+        type=int)
+    k = max(1, min(request.args.get("k", 10, type=int), MAX_CAR_CANDIDATES))
+
+    monthly_miles, current_monthly_co2 = get_trip_miles_and_co2_per_month(
+        user_id, trip_year)
+    miles = sum(monthly_miles)
+    current_co2 = round(sum(current_monthly_co2), 2)
+
+    # project this year's driving so far over a whole year
+    if trip_year == date.today().year:
+        year_fraction = (days_btw_today_and_jan1() or 1) / 365.0
+    else:
+        year_fraction = 1.0
+
+    cars = Car.get_emissions_index().find_lowest(
+        k, make=request.args.get("make"),
+        fuel_type=request.args.get("fuel_type"),
+        drive=request.args.get("drive"),
+        min_year=request.args.get("min_year", type=int),
+        max_year=request.args.get("max_year", type=int),
+        include_zero=bool(request.args.get("include_zero", type=int)))
+
+    for car in cars:
+        car["yearly_co2"] = round(
+            miles * car["grams_co2_mile"] * GRAMS_TO_LBS, 2)
+        car["projected_annual_co2"] = round(
+            car["yearly_co2"] / year_fraction, 2)
+        car["savings"] = round(current_co2 - car["yearly_co2"], 2)
+
+    return jsonify({"year": trip_year,
+                    "miles": miles,
+                    "projected_annual_miles": round(miles / year_fraction, 2),
+                    "current_yearly_co2": current_co2,
+                    "cars": cars})
+
+
 @app.route("/co2-day-of-week.json", methods=["GET"])
+@versioned_json
 def get_co2_by_day_of_week():
     """Get the total CO2 for each day of the week from each source given a date
     range."""
@@ -840,23 +1342,189 @@ def get_co2_by_day_of_week():
     user_id = session.get("user_id")
     year = request.args.get("year")
 
-    start_date = "1/1/%s" % (year)
-    end_date = "12/31/%s" % (year)
+    return jsonify(get_co2_per_day_of_week_for_year(user_id, year))
 
-    trip_co2_by_day_of_week = TripLog.calculate_total_co2_per_day_of_week(
-        user_id, start_date, end_date)
 
-    kwh_co2_by_day_of_week = ElectricityLog.calculate_total_co2_per_day_of_week(
-        user_id, start_date, end_date)
+@app.route("/dashboard.json", methods=["GET"])
+@versioned_json
+def get_dashboard_data():
+    """Get the data for every homepage chart in one request, so the homepage
+    loads with a single round trip instead of one per chart. The logs of each
+    source are loaded once, as arrays, and every chart is calculated from
+    them."""
+
+    user_id = session.get("user_id")
+    year = request.args.get("year", str(date.today().year))
+
+    co2_arrays = get_co2_arrays(user_id)
+    co2_per_source = get_co2_per_yr_per_source(user_id, co2_arrays)
+
+    return jsonify({
+        "year_comparison": get_year_comparison(co2_per_source),
+        "co2_per_datatype": get_co2_per_datatype_for_year(user_id, year,
+                                                          co2_arrays),
+        "co2_trend": get_co2_trend_for_year(user_id, year, co2_arrays),
+        "co2_day_of_week": get_co2_per_day_of_week_for_year(user_id, year,
+                                                            co2_arrays),
+        "yearly_totals": get_yearly_totals(user_id, co2_per_source)})
+
+
+###  Admin ####################################################################
+
+@app.route("/request-profiles", methods=["GET"])
+def list_profiles():
+    """List the newest request profiles with their slowest functions."""
+
+    if not is_admin():
+        abort(404)
+
+    return render_template("request-profiles.html",
+                           captures=request_profiler.get_captures(),
+                           overhead=request_profiler.get_overhead(),
+                           profiler=request_profiler)
+
+
+@app.route("/request-profiles/<name>", methods=["GET"])
+def download_profile(name):
+    """Download a request profile as a .prof file."""
 
-    return jsonify({"trip": trip_co2_by_day_of_week.values(),
-                    "kwh": kwh_co2_by_day_of_week.values()})
+    if not is_admin() or name not in request_profiler.get_names():
+        abort(404)
+
+    return send_from_directory(os.path.abspath(request_profiler.directory),
+                               name, as_attachment=True)
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Request, connection pool and cache metrics in the Prometheus text
+    format."""
+
+    return app.response_class(
+        metrics.render(db.engine.pool, get_cache_stats(),
+                       request_stats.get_route_latencies()),
+        content_type=metrics.CONTENT_TYPE)
 
 
 ###  Helper Functions #########################################################
 
 TREE_POUNDS_CO2_PER_YEAR = 48
 
+# most cars compared in one /co2-other-cars.json request
+MAX_CAR_CANDIDATES = 20
+
+
+def is_admin():
+    """Whether the logged in user is one of the ADMIN_USER_IDS."""
+
+    return session.get("user_id") in app.config["ADMIN_USER_IDS"]
+
+
+def get_cached_etag(etag):
+    """Get the ETag of the version of a response that the browser already
+    has, either plain or gzipped, as sent in If-None-Match. Returns None if it
+    has neither."""
+
+    for cached_etag in (etag, etag + GZIP_ETAG_SUFFIX):
+        if cached_etag in request.if_none_match:
+            return cached_etag
+
+
+def conditional_json(body, etag):
+    """Make a JSON response with an ETag, answering 304 Not Modified when the
+    browser already has this version."""
+
+    cached_etag = get_cached_etag(etag)
+    if cached_etag:
+        response = app.response_class(status=304)
+        response.set_etag(cached_etag)
+    else:
+        response = app.response_class(body, mimetype="application/json")
+        response.set_etag(etag)
+
+    response.cache_control.no_cache = True  # revalidate before each use
+
+    return response
+
+
+def get_log_page_args():
+    """Read the page cursor, page size and year of a log listing request. A
+    cursor that isn't one is a bad request."""
+
+    after = request.args.get("after") or None
+    page_size = request.args.get("page_size", LOG_PAGE_SIZE, type=int)
+
+    if after:
+        try:
+            parse_log_cursor(after)
+        except ValueError:
+            abort(400)
+
+    return {"after": after,
+            "page_size": max(1, min(page_size, MAX_LOG_PAGE_SIZE)),
+            "year": request.args.get("year", type=int)}
+
+
+def get_log_filters(**filters):
+    """The page size, year and residence or car filters of a log listing
+    request that is being shown, to carry over to its other pages."""
+
+    filters["page_size"] = request.args.get("page_size", type=int)
+    filters["year"] = request.args.get("year", type=int)
+
+    return {name: value for name, value in filters.items() if value}
+
+
+def get_next_page_url(next_cursor):
+    """URL of the next page of the log listing being shown, None on the last
+    page."""
+
+    if not next_cursor:
+        return None
+
+    args = request.args.to_dict()
+    args["after"] = next_cursor
+
+    return url_for(request.endpoint, **args)
+
+
+def get_trip_miles_and_co2_per_month(user_id, year, usercar_id=None):
+    """Get the miles and pounds of CO2 per month of a car's trips in a year, or
+    of all of the user's cars, from the cached monthly miles. Trips logged
+    without a car are left out, since they weren't driven in any of the cars.
+    Raises KeyError if the car isn't one of the user's."""
+
+    avg_grams_co2_mile_factors = \
+        UserCar.get_avg_grams_co2_mile_factors(user_id)
+
+    if usercar_id and usercar_id not in avg_grams_co2_mile_factors:
+        raise KeyError(usercar_id)
+
+    monthly_miles = [0] * 12
+    co2_per_month = [0] * 12
+    for (trip_year, car_id), car_miles in \
+            TripLog.get_monthly_miles(user_id).items():
+        if trip_year != year or car_id is None or \
+                (usercar_id and car_id != usercar_id):
+            continue
+        for month, miles in enumerate(car_miles):
+            monthly_miles[month] += miles
+            co2_per_month[month] += \
+                miles * avg_grams_co2_mile_factors[car_id] * GRAMS_TO_LBS
+
+    return monthly_miles, [round(co2, 2) for co2 in co2_per_month]
+
+
+def get_trip_co2s(user_id, trip_logs):
+    """Get the pounds of CO2 of each trip, with the CO2 factors of all of the
+    user's cars loaded at once."""
+
+    avg_grams_co2_mile_factors = \
+        UserCar.get_avg_grams_co2_mile_factors(user_id)
+
+    return [round(trip.co2_calc(avg_grams_co2_mile_factors[trip.usercar_id]), 2)
+            for trip in trip_logs]
+
 
 def days_btw_today_and_jan1():
     now = datetime.now()
@@ -866,31 +1534,139 @@ def days_btw_today_and_jan1():
     return (today - jan_first).days
 
 
-def get_yearly_totals(user_id):
+def get_co2_arrays(user_id):
+    """Load all of the logs of each source as arrays, keyed by source, with
+    one query per source."""
 
-    years = set()
-    years.update(TripLog.get_trip_years(user_id),
-                 ElectricityLog.get_kwh_years(user_id),
-                 NGLog.get_ng_years(user_id)
-                 )
+    return {"trip": TripLog.get_log_arrays(user_id),
+            "kwh": ElectricityLog.get_log_arrays(user_id),
+            "ng": NGLog.get_log_arrays(user_id)}
+
+
+def get_co2_per_yr_per_source(user_id, co2_arrays=None):
+    """Get the CO2 per year of each source, keyed by source. Each source is
+    summed with one grouped query, or from its arrays if they are passed
+    in."""
+
+    if co2_arrays is not None:
+        return {source: {year: {"total": co2}
+                         for year, co2 in arrays.per_year().items()}
+                for source, arrays in co2_arrays.items()}
+
+    return {"trip": TripLog.get_co2_per_yr(user_id),
+            "kwh": ElectricityLog.get_co2_per_yr(user_id),
+            "ng": NGLog.get_co2_per_yr(user_id)}
+
+
+def sum_co2_per_yr(co2_per_source):
+    """Add up the yearly CO2 of every source, keyed by year."""
+
+    totals = {}
+
+    for source in ["trip", "kwh", "ng"]:
+        for year, co2 in co2_per_source[source].items():
+            totals[year] = totals.get(year, 0) + co2["total"]
+
+    return totals
+
+
+def get_year_comparison(co2_per_source):
+    """Get the CO2 totals to compare across years, projecting the current year
+    to a full year."""
+
+    years = [2017, 2016, 2015, 2014]
     this_year = date.today().year
     days_this_year = days_btw_today_and_jan1()
 
-    trip_co2 = TripLog.get_co2_per_yr(user_id)
-    kwh_co2 = ElectricityLog.get_co2_per_yr(user_id)
-    ng_co2 = NGLog.get_co2_per_yr(user_id)
+    totals = sum_co2_per_yr(co2_per_source)
 
-    co2_per_yr = {}
+    co2_per_yr = []
 
     for year in years:
-        total = 0
-        if trip_co2.get(year):
-            total += trip_co2[year]["total"]
-        if kwh_co2.get(year):
-            total += kwh_co2[year]["total"]
-        if ng_co2.get(year):
-            total += ng_co2[year]["total"]
+        total = totals.get(year, 0)
 
+        if year != this_year:
+            co2_per_yr.append(round(total, 2))
+        else:
+            yr_projected = round(total / days_this_year, 2) * 365
+            co2_per_yr.append(yr_projected)
+
+    return co2_per_yr
+
+
+def get_co2_per_datatype_for_year(user_id, year, co2_arrays=None):
+    """Get the trip, kWh and natural gas CO2 for a year, or for every year if
+    year is "ALL YEARS". Calculated from the arrays of each source if they are
+    passed in."""
+
+    start_date = "1/1/1900"
+    end_date = "1/1/2036"
+
+    if year != "ALL YEARS":
+        start_date = "1/1/%s" % (year)
+        end_date = "12/31/%s" % (year)
+
+    if co2_arrays is not None:
+        return [co2_arrays[source].total(start_date, end_date)
+                for source in ["trip", "kwh", "ng"]]
+
+    trip_co2 = TripLog.sum_trip_co2(user_id, start_date, end_date)
+    kwh_co2 = ElectricityLog.sum_kwh_co2(user_id, start_date, end_date)
+    ng_co2 = NGLog.sum_ng_co2(user_id, start_date, end_date)
+
+    return [trip_co2, kwh_co2, ng_co2]
+
+
+def get_co2_trend_for_year(user_id, year, co2_arrays=None):
+    """Get the monthly CO2 of each source for a year, from the arrays of each
+    source if they are passed in."""
+
+    if co2_arrays is not None:
+        return {source: arrays.per_month(year)
+                for source, arrays in co2_arrays.items()}
+
+    return {"trip": TripLog.sum_trip_co2_per_month(user_id, year),
+            "kwh": ElectricityLog.sum_kwh_co2_per_month(user_id, year),
+            "ng": NGLog.sum_ng_co2_per_month(user_id, year)}
+
+
+def get_co2_per_day_of_week_for_year(user_id, year, co2_arrays=None):
+    """Get the trip and kWh CO2 per day of the week for a year, from the
+    arrays of each source if they are passed in."""
+
+    start_date = "1/1/%s" % (year)
+    end_date = "12/31/%s" % (year)
+
+    if co2_arrays is not None:
+        return {source: co2_arrays[source].per_day_of_week(
+                    start_date, end_date).values()
+                for source in ["trip", "kwh"]}
+
+    trip_co2_by_day_of_week = TripLog.calculate_total_co2_per_day_of_week(
+        user_id, start_date, end_date)
+
+    kwh_co2_by_day_of_week = ElectricityLog.calculate_total_co2_per_day_of_week(
+        user_id, start_date, end_date)
+
+    return {"trip": trip_co2_by_day_of_week.values(),
+            "kwh": kwh_co2_by_day_of_week.values()}
+
+
+def get_yearly_totals(user_id, co2_per_source=None):
+    """Get the total and daily average CO2 of every year with data. The CO2 per
+    year of each source is calculated unless it is passed in."""
+
+    if co2_per_source is None:
+        co2_per_source = get_co2_per_yr_per_source(user_id)
+
+    this_year = date.today().year
+    days_this_year = days_btw_today_and_jan1()
+
+    totals = sum_co2_per_yr(co2_per_source)
+
+    co2_per_yr = {}
+
+    for year, total in totals.items():
         if year != this_year:
             daily_avg = round(total / 365, 2)
             co2_per_yr[year] = {"total": round(total, 2),
@@ -911,6 +1687,9 @@ if __name__ == "__main__":
 
     connect_to_db(app)
 
+    # log a line per request, see request_stats.py
+    logging.basicConfig(level=logging.INFO)
+
     # Use the DebugToolbar
     # DebugToolbarExtension(app)
 
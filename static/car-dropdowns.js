@@ -26,22 +26,14 @@ function onMakeChange(evt) {
     cylinders.prop("disabled", true);
     transmission.prop("disabled", true);
 
-    $.ajax({
-        url: "/car-data",
-        data: data,
-        success: function(response) {
-
-            cylinders.empty();
-            transmission.empty();
-            model.empty();
-            year.empty();
-
-            populateModels(response);
-            populateYears(response);
-
-        },
-        error: function(response) {
-        }
+    getCars(data, function(response) {
+        cylinders.empty();
+        transmission.empty();
+        model.empty();
+        year.empty();
+
+        populateModels(response);
+        populateYears(response);
     });
 }
 
@@ -53,14 +45,8 @@ function onModelChange(evt) {
     cylinders.empty();
     transmission.empty();
 
-    $.ajax({
-        url: "/car-data",
-        data: data,
-        success: function(response) {
-            populateYears(response);
-        },
-        error: function(response) {
-        }
+    getCars(data, function(response) {
+        populateYears(response);
     });
 
     if (year.val()) {
@@ -69,15 +55,9 @@ function onModelChange(evt) {
         cylinders.prop("disabled", false);
         transmission.prop("disabled", false);
 
-        $.ajax({
-            url: "/car-data",
-            data: data,
-            success: function(response) {
-                populateCylinders(response);
-                populateTransmissions(response);
-            },
-            error: function(response) {
-            }
+        getCars(data, function(response) {
+            populateCylinders(response);
+            populateTransmissions(response);
         });
     }
 }
@@ -90,14 +70,8 @@ function onYearChange(evt) {
     cylinders.empty();
     transmission.empty();
 
-    $.ajax({
-        url: "/car-data",
-        data: data,
-        success: function(response) {
-            populateModels(response);
-        },
-        error: function(response) {
-        }
+    getCars(data, function(response) {
+        populateModels(response);
     });
 
     if (model.val()) {
@@ -106,15 +80,9 @@ function onYearChange(evt) {
         cylinders.prop("disabled", false);
         transmission.prop("disabled", false);
 
-        $.ajax({
-            url: "/car-data",
-            data: data,
-            success: function(response) {
-                populateCylinders(response);
-                populateTransmissions(response);
-            },
-            error: function(response) {
-            }
+        getCars(data, function(response) {
+            populateCylinders(response);
+            populateTransmissions(response);
         });
     }
 }
@@ -126,14 +94,8 @@ function onCylindersChange(evt) {
     data.year = year.val();
     data.cylinders = cylinders.val();
 
-    $.ajax({
-        url: "/car-data",
-        data: data,
-        success: function(response) {
-            populateTransmissions(response);
-        },
-        error: function(response) {
-        }
+    getCars(data, function(response) {
+        populateTransmissions(response);
     });
 }
 
@@ -144,17 +106,57 @@ function onTransmissionChange(evt) {
     data.year = year.val();
     data.transmission = transmission.val();
 
-    $.ajax({
-        url: "/car-data",
-        data: data,
-        success: function(response) {
-            populateCylinders(response);
-        },
-        error: function(response) {
-        }
+    getCars(data, function(response) {
+        populateCylinders(response);
     });
 }
 
+// make -> model -> year -> cylinders -> transmissions slices of the catalog
+var catalogSlices = {};
+
+// Call success with the cars matching data, like the /car-data route does,
+// filtering the catalog slice of the make so each make is only requested once
+function getCars(data, success) {
+    // copy the filters, the caller may change data before the slice arrives
+    var filters = $.extend({}, data);
+
+    if (catalogSlices[filters.make]) {
+        success(filterCars(filters, catalogSlices[filters.make]));
+        return;
+    }
+
+    $.get("/cars/catalog.json", {make: filters.make}, function(slice) {
+        catalogSlices[filters.make] = slice;
+        success(filterCars(filters, slice));
+    });
+}
+
+function filterCars(data, slice) {
+    var cars = [];
+
+    $.each(slice, function(carModel, years) {
+        if (data.model && carModel != data.model) { return; }
+
+        $.each(years, function(carYear, cylindersFound) {
+            if (data.year && carYear != data.year) { return; }
+
+            $.each(cylindersFound, function(carCylinders, transmissions) {
+                if (data.cylinders && carCylinders != data.cylinders) { return; }
+
+                $.each(transmissions, function(i, carTransmission) {
+                    if (data.transmission && carTransmission != data.transmission) { return; }
+
+                    cars.push({make: data.make, model: carModel,
+                               year: parseInt(carYear), cylinders: carCylinders,
+                               transmission: carTransmission});
+                });
+            });
+        });
+    });
+
+    return cars;
+}
+
 function populateModels(response) {
     var selectedModel = model.val();
     model.empty();
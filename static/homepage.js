@@ -2,314 +2,332 @@
 // Yearly Bar Graph ###########################################################
 
 var yearCo2BarChart;
-function updateYearCo2BarChart(response) {
+function drawYearCo2BarChart(response) {
 
     // Make bar of percent of different CO2 source types
     var ctx_bar = $("#yearBarChart");
     ctx_bar.height(1000);
-    var yearData = {};
 
     if (yearCo2BarChart) {
         yearCo2BarChart.destroy();
     }
 
-    $.get("/year-comparison-json", function (response) {
-
-        var data = {
-            labels: ["2017", "2016", "2015", "2014"],
-            datasets: [
-                {
-                    label: "Total CO2",
-                    backgroundColor: [
-                        '#2B5D83',
-                        '#2B5D83',
-                        '#2B5D83',
-                        '#2B5D83'
-                    ],
-                    borderColor: [
-                        'rgba(47,102,144,1)',
-                        'rgba(47,102,144,1)',
-                        'rgba(47,102,144,1)',
-                        'rgba(47,102,144,1)',
-                    ],
-                    borderWidth: 1,
-                    data: response,
-                },
-            ]
-        };
-        yearCo2BarChart = new Chart(ctx_bar, {
-            type: 'bar',
-            data: data,
-            options: {
-                scales: {
-                    yAxes: [{
-                        ticks: {
-                            beginAtZero:true
-                        },
-                        scaleLabel: {
-                                display: true,
-                                labelString: "CO2 lbs"
-                        }
-                    }],
-                    xAxes: [{
-                        barPercentage: 0.6
-                    }]
-                }
+    var data = {
+        labels: ["2017", "2016", "2015", "2014"],
+        datasets: [
+            {
+                label: "Total CO2",
+                backgroundColor: [
+                    '#2B5D83',
+                    '#2B5D83',
+                    '#2B5D83',
+                    '#2B5D83'
+                ],
+                borderColor: [
+                    'rgba(47,102,144,1)',
+                    'rgba(47,102,144,1)',
+                    'rgba(47,102,144,1)',
+                    'rgba(47,102,144,1)',
+                ],
+                borderWidth: 1,
+                data: response,
+            },
+        ]
+    };
+    yearCo2BarChart = new Chart(ctx_bar, {
+        type: 'bar',
+        data: data,
+        options: {
+            scales: {
+                yAxes: [{
+                    ticks: {
+                        beginAtZero:true
+                    },
+                    scaleLabel: {
+                            display: true,
+                            labelString: "CO2 lbs"
+                    }
+                }],
+                xAxes: [{
+                    barPercentage: 0.6
+                }]
             }
-        });
+        }
     });
 }
 
-updateYearCo2BarChart();
+function updateYearCo2BarChart() {
+    $.get("/year-comparison-json", drawYearCo2BarChart);
+}
 
 
 // DONUT CHART ################################################################
 
 var myDonutChart;
-function updateCo2Donut() {
+function drawCo2Donut(response) {
 
     // Make Donut Chart of percent of different CO2 source types
     var ctx_donut = $("#donutChart");
-    var yearData = {};
-    yearData.year = $("#donut-year").val();
 
     if (myDonutChart) {
         myDonutChart.destroy();
     }
-    $.get("/co2-per-datatype.json", yearData, function (response) {
-        var data = {
-            labels: [
-                "Trips",
-                "Electricity",
-                "Natural Gas"
-            ],
-            datasets: [
-                {
-                    data: response,
-                    backgroundColor: [
-                        tripPrimary,
-                        electricityPrimary,
-                        ngPrimary
-                    ],
-                    hoverBackgroundColor: [
-                        tripPrimary,
-                        electricityPrimary,
-                        ngPrimary
-                    ]
-                }]
-            };
-        myDonutChart = new Chart(ctx_donut, {
-            type: 'doughnut',
-            data: data,
-            options: {
-                response: true
-            }
-        });
-        
+
+    var data = {
+        labels: [
+            "Trips",
+            "Electricity",
+            "Natural Gas"
+        ],
+        datasets: [
+            {
+                data: response,
+                backgroundColor: [
+                    tripPrimary,
+                    electricityPrimary,
+                    ngPrimary
+                ],
+                hoverBackgroundColor: [
+                    tripPrimary,
+                    electricityPrimary,
+                    ngPrimary
+                ]
+            }]
+        };
+    myDonutChart = new Chart(ctx_donut, {
+        type: 'doughnut',
+        data: data,
+        options: {
+            response: true
+        }
     });
 }
-updateCo2Donut();
+
+function updateCo2Donut() {
+    var yearData = {};
+    yearData.year = $("#donut-year").val();
+
+    $.get("/co2-per-datatype.json", yearData, drawCo2Donut);
+}
 $("#donut-year").on("change", updateCo2Donut);
 
 
 // LINE GRAPH ################################################################
 
 var myLineChart;
-function updateCo2LineGraph() {
+function drawCo2LineGraph(response) {
 
     // Make Donut Chart of percent of different CO2 source types
     var ctx_line = $("#lineGraph");
-    var yearData = {};
-    yearData.year = $("#trend-year").val();
 
     if (myLineChart) {
         myLineChart.destroy();
     }
-    $.get("/co2-trend.json", yearData, function (response) {
-
-        var data = {
-            labels: ["January", "February", "March", "April", "May", "June",
-                     "July", "August", "September", "October", "November",
-                     "December"],
-            datasets: [
-                {
-                    label: "Trips",
-                    fill: false,
-                    lineTension: 0.1,
-                    backgroundColor: tripPrimary,
-                    borderColor: tripPrimary,
-                    borderCapStyle: 'butt',
-                    borderDash: [],
-                    borderDashOffset: 0.0,
-                    borderJoinStyle: 'miter',
-                    pointBorderColor: tripPrimary,
-                    pointBackgroundColor: "#fff",
-                    pointBorderWidth: 1,
-                    pointHoverRadius: 5,
-                    pointHoverBackgroundColor: tripPrimary,
-                    pointHoverBorderColor: tripPrimary,
-                    pointHoverBorderWidth: 2,
-                    pointRadius: 1,
-                    pointHitRadius: 10,
-                    data: response.trip,
-                    spanGaps: false,
-                },
-                {
-                    label: "Electricity",
-                    fill: false,
-                    lineTension: 0.1,
-                    backgroundColor: electricityPrimary,
-                    borderColor: electricityPrimary,
-                    borderCapStyle: 'butt',
-                    borderDash: [],
-                    borderDashOffset: 0.0,
-                    borderJoinStyle: 'miter',
-                    pointBorderColor: electricityPrimary,
-                    pointBackgroundColor: "#fff",
-                    pointBorderWidth: 1,
-                    pointHoverRadius: 5,
-                    pointHoverBackgroundColor: electricityPrimary,
-                    pointHoverBorderColor: electricityPrimary,
-                    pointHoverBorderWidth: 2,
-                    pointRadius: 1,
-                    pointHitRadius: 10,
-                    data: response.kwh,
-                    spanGaps: false,
-                },
-                {
-                    label: "Natural Gas",
-                    fill: false,
-                    lineTension: 0.1,
-                    backgroundColor: ngPrimary,
-                    borderColor: ngPrimary,
-                    borderCapStyle: 'butt',
-                    borderDash: [],
-                    borderDashOffset: 0.0,
-                    borderJoinStyle: 'miter',
-                    pointBorderColor: ngPrimary,
-                    pointBackgroundColor: "#fff",
-                    pointBorderWidth: 1,
-                    pointHoverRadius: 5,
-                    pointHoverBackgroundColor: ngPrimary,
-                    pointHoverBorderColor: ngPrimary,
-                    pointHoverBorderWidth: 2,
-                    pointRadius: 1,
-                    pointHitRadius: 10,
-                    data: response.ng,
-                    spanGaps: false,
-                }
-            ]
-        };
-        
-        myLineChart = new Chart(ctx_line, {
-            type: 'line',
-            data: data,
-            options: {
-                scales: {
-                    yAxes: [{
-                        ticks: {
-                            beginAtZero:true
-                        },
-                        scaleLabel: {
-                                display: true,
-                                labelString: "CO2 lbs"
-                        }
-                    }]
-                }
+
+    var data = {
+        labels: ["January", "February", "March", "April", "May", "June",
+                 "July", "August", "September", "October", "November",
+                 "December"],
+        datasets: [
+            {
+                label: "Trips",
+                fill: false,
+                lineTension: 0.1,
+                backgroundColor: tripPrimary,
+                borderColor: tripPrimary,
+                borderCapStyle: 'butt',
+                borderDash: [],
+                borderDashOffset: 0.0,
+                borderJoinStyle: 'miter',
+                pointBorderColor: tripPrimary,
+                pointBackgroundColor: "#fff",
+                pointBorderWidth: 1,
+                pointHoverRadius: 5,
+                pointHoverBackgroundColor: tripPrimary,
+                pointHoverBorderColor: tripPrimary,
+                pointHoverBorderWidth: 2,
+                pointRadius: 1,
+                pointHitRadius: 10,
+                data: response.trip,
+                spanGaps: false,
+            },
+            {
+                label: "Electricity",
+                fill: false,
+                lineTension: 0.1,
+                backgroundColor: electricityPrimary,
+                borderColor: electricityPrimary,
+                borderCapStyle: 'butt',
+                borderDash: [],
+                borderDashOffset: 0.0,
+                borderJoinStyle: 'miter',
+                pointBorderColor: electricityPrimary,
+                pointBackgroundColor: "#fff",
+                pointBorderWidth: 1,
+                pointHoverRadius: 5,
+                pointHoverBackgroundColor: electricityPrimary,
+                pointHoverBorderColor: electricityPrimary,
+                pointHoverBorderWidth: 2,
+                pointRadius: 1,
+                pointHitRadius: 10,
+                data: response.kwh,
+                spanGaps: false,
+            },
+            {
+                label: "Natural Gas",
+                fill: false,
+                lineTension: 0.1,
+                backgroundColor: ngPrimary,
+                borderColor: ngPrimary,
+                borderCapStyle: 'butt',
+                borderDash: [],
+                borderDashOffset: 0.0,
+                borderJoinStyle: 'miter',
+                pointBorderColor: ngPrimary,
+                pointBackgroundColor: "#fff",
+                pointBorderWidth: 1,
+                pointHoverRadius: 5,
+                pointHoverBackgroundColor: ngPrimary,
+                pointHoverBorderColor: ngPrimary,
+                pointHoverBorderWidth: 2,
+                pointRadius: 1,
+                pointHitRadius: 10,
+                data: response.ng,
+                spanGaps: false,
             }
-        });
-        
+        ]
+    };
+    
+    myLineChart = new Chart(ctx_line, {
+        type: 'line',
+        data: data,
+        options: {
+            scales: {
+                yAxes: [{
+                    ticks: {
+                        beginAtZero:true
+                    },
+                    scaleLabel: {
+                            display: true,
+                            labelString: "CO2 lbs"
+                    }
+                }]
+            }
+        }
     });
 }
-updateCo2LineGraph();
+
+function updateCo2LineGraph() {
+    var yearData = {};
+    yearData.year = $("#trend-year").val();
+
+    $.get("/co2-trend.json", yearData, drawCo2LineGraph);
+}
 $("#trend-year").on("change", updateCo2LineGraph);
 
 // Weekday Bar Graph ###########################################################
 
 var weekdayCo2BarChart;
-function updateWeekdayCo2BarChart(response) {
+function drawWeekdayCo2BarChart(response) {
 
     // Make bar of percent of different CO2 source types
     var ctx_bar = $("#weekdayBarChart");
-    var yearData = {};
 
     if (weekdayCo2BarChart) {
         weekdayCo2BarChart.destroy();
     }
-    
-    yearData.year = $("#weekday-year").val();
-
-    $.get("/co2-day-of-week.json", yearData, function (response) {
-
-        var data = {
-            labels: ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday",
-                     "Saturday", "Sunday"],
-            datasets: [
-                {
-                    label: "Trips",
-                    backgroundColor: [
-                        tripPrimary,
-                        tripPrimary,
-                        tripPrimary,
-                        tripPrimary,
-                        tripPrimary,
-                        tripPrimary,
-                        tripPrimary
-                    ],
-                    borderColor: [
-                        tripPrimary,
-                        tripPrimary,
-                        tripPrimary,
-                        tripPrimary,
-                        tripPrimary,
-                        tripPrimary,
-                        tripPrimary,
-                        tripPrimary
-                    ],
-                    borderWidth: 1,
-                    data: response.trip,
-                },
-                {
-                    label: "Electricity",
-                    backgroundColor: [
-                        electricityPrimary,
-                        electricityPrimary,
-                        electricityPrimary,
-                        electricityPrimary,
-                        electricityPrimary,
-                        electricityPrimary,
-                        electricityPrimary
-                    ],
-                    borderColor: [
-                        electricityPrimary,
-                        electricityPrimary,
-                        electricityPrimary,
-                        electricityPrimary,
-                        electricityPrimary,
-                        electricityPrimary,
-                        electricityPrimary
-                    ],
-                    borderWidth: 1,
-                    data: response.kwh,
-                }
-            ]
-        };
-    
 
-        weekdayCo2BarChart = new Chart(ctx_bar, {
-            type: 'bar',
-            data: data,
-            options: {
-                response: true
+    var data = {
+        labels: ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday",
+                 "Saturday", "Sunday"],
+        datasets: [
+            {
+                label: "Trips",
+                backgroundColor: [
+                    tripPrimary,
+                    tripPrimary,
+                    tripPrimary,
+                    tripPrimary,
+                    tripPrimary,
+                    tripPrimary,
+                    tripPrimary
+                ],
+                borderColor: [
+                    tripPrimary,
+                    tripPrimary,
+                    tripPrimary,
+                    tripPrimary,
+                    tripPrimary,
+                    tripPrimary,
+                    tripPrimary,
+                    tripPrimary
+                ],
+                borderWidth: 1,
+                data: response.trip,
+            },
+            {
+                label: "Electricity",
+                backgroundColor: [
+                    electricityPrimary,
+                    electricityPrimary,
+                    electricityPrimary,
+                    electricityPrimary,
+                    electricityPrimary,
+                    electricityPrimary,
+                    electricityPrimary
+                ],
+                borderColor: [
+                    electricityPrimary,
+                    electricityPrimary,
+                    electricityPrimary,
+                    electricityPrimary,
+                    electricityPrimary,
+                    electricityPrimary,
+                    electricityPrimary
+                ],
+                borderWidth: 1,
+                data: response.kwh,
             }
-        });
+        ]
+    };
+
+
+    weekdayCo2BarChart = new Chart(ctx_bar, {
+        type: 'bar',
+        data: data,
+        options: {
+            response: true
+        }
     });
 }
 
-updateWeekdayCo2BarChart();
+function updateWeekdayCo2BarChart() {
+    var yearData = {};
+    yearData.year = $("#weekday-year").val();
+
+    $.get("/co2-day-of-week.json", yearData, drawWeekdayCo2BarChart);
+}
+
 $("#weekday-year").on("change", updateWeekdayCo2BarChart);
 
 
+// Dashboard ##################################################################
+
+// Draw every chart from a single request when the page loads
+function updateDashboard() {
+    var yearData = {};
+    yearData.year = $("#trend-year").val();
+
+    $.get("/dashboard.json", yearData, function (response) {
+        drawYearCo2BarChart(response.year_comparison);
+        drawCo2Donut(response.co2_per_datatype);
+        drawCo2LineGraph(response.co2_trend);
+        drawWeekdayCo2BarChart(response.co2_day_of_week);
+    });
+}
+updateDashboard();
+
+
 // Get Zipcode ################################################################
 
 $("#new-location-button").on("click", getZipcode);
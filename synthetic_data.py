@@ -0,0 +1,292 @@
+"""Synthetic users with realistic multi-year histories for performance work.
+
+    python synthetic_data.py [--users 10] [--years 3] [--seed 1]
+
+Every user gets 1 to 3 residences in zipcodes across the grid regions and 1
+or 2 cars from the catalog. Each day of their history has:
+
+    - kWh for each residence, highest in summer and winter
+    - therms for each residence, highest in winter
+    - a round trip commute on most weekdays, and errands on some weekends
+
+The reference tables are filled first if they are empty: the regions and
+zipcodes from seed-data, and the cars from seed-data/vehicles.csv, or a
+generated catalog when that file isn't there. The same seed always makes the
+same data.
+"""
+
+import argparse
+import logging
+import math
+import os
+import random
+from datetime import date, timedelta
+from passlib.hash import pbkdf2_sha256
+from bulk_load import BulkLoader
+from model import (db, Region, Zipcode, Car, TransitType, User, Residence,
+                   UserCar, TripLog, ElectricityLog, NGLog, DailyCO2Rollup,
+                   invalidate_co2_timelines, emission_factors_changed)
+import seed
+
+VEHICLES_FILE = "seed-data/vehicles.csv"
+
+# the history ends on the last day of the bundled utility data
+END_DAY = date(2017, 3, 31)
+
+# grams of CO2 from burning a gallon of gasoline
+GRAMS_CO2_GALLON = 8887
+
+# (make, [(model, combined mpg)]) of the generated catalog
+CATALOG_MODELS = [
+    ("Toyota", [("Prius", 50), ("Camry", 28), ("Corolla", 32),
+                ("4Runner 4WD", 18), ("Tacoma 2WD", 21)]),
+    ("Honda", [("Civic", 33), ("Accord", 27), ("CR-V AWD", 26),
+               ("Fit", 35)]),
+    ("Ford", [("F150 Pickup 4WD", 17), ("Focus FWD", 30),
+              ("Escape FWD", 25), ("Mustang", 20)]),
+    ("Chevrolet", [("Silverado C15 2WD", 18), ("Malibu", 29),
+                   ("Volt", 42), ("Tahoe C1500 2WD", 17)]),
+    ("Subaru", [("Outback AWD", 28), ("Forester AWD", 27),
+                ("Impreza AWD", 30)]),
+    ("Volkswagen", [("Jetta", 30), ("Golf", 29), ("Passat", 28)]),
+    ("BMW", [("328i", 27), ("X5 xDrive35i", 21)]),
+    ("Tesla", [("Model S AWD - 85 kWh", 0)]),
+    ]
+
+# (cylinders, transmission, mpg factor) variants of each model and year
+CATALOG_VARIANTS = [("4", "Automatic (S6)", 1.0),
+                    ("4", "Manual 6-spd", 1.03),
+                    ("6", "Automatic (S8)", 0.85)]
+
+CATALOG_YEARS = range(2000, 2018)
+
+
+def generate_cars():
+    """Yield the value tuples of a generated car catalog, in the column order
+    of seed.load_cars(). Electric cars have no tailpipe CO2."""
+
+    car_id = 0
+    for make, models in CATALOG_MODELS:
+        for model, mpg in models:
+            for year in CATALOG_YEARS:
+                for cylinders, transmission, mpg_factor in CATALOG_VARIANTS:
+                    car_id += 1
+
+                    if not mpg:
+                        yield (car_id, make, model, "Electricity", year, None,
+                               "All-Wheel Drive", "0", "", None, "",
+                               "Automatic (A1)", 0.0, 95, 100, 98)
+                        continue
+
+                    # cars got a little more efficient every year
+                    combo = round(mpg * mpg_factor *
+                                  (1 + (year - 2000) * 0.01), 1)
+
+                    yield (car_id, make, model, "Regular Gasoline", year,
+                           cylinders, "Front-Wheel Drive", "0", "",
+                           "2.0" if cylinders == "4" else "3.5", "",
+                           transmission, GRAMS_CO2_GALLON / combo,
+                           round(combo * 0.9, 1), round(combo * 1.15, 1),
+                           combo)
+
+
+def load_generated_cars():
+    """Load the generated car catalog into the database."""
+
+    print "\n Generated Cars \n"
+
+    loader = BulkLoader(Car.__table__,
+                        ["car_id", "make", "model", "fuel_type", "year",
+                         "cylinders", "drive", "eng_id", "eng_description",
+                         "displacement", "trans_description", "transmission",
+                         "grams_co2_mile", "mpg_street", "mpg_hw",
+                         "mpg_combo"])
+    loader.load(generate_cars())
+    db.session.commit()
+
+    Car.invalidate_factor_cache()
+    Car.invalidate_catalog()
+
+    # The daily trip CO2 was calculated with the old factors
+    emission_factors_changed(["trip"])
+    db.session.commit()
+
+
+def load_reference_data():
+    """Fill the regions, zipcodes, cars and transit types if they are
+    empty."""
+
+    if not Region.query.count():
+        seed.load_regions()
+
+    if not Zipcode.query.count():
+        seed.load_zipcodes()
+
+    if not Car.query.count():
+        if os.path.exists(VEHICLES_FILE):
+            seed.load_cars()
+        else:
+            load_generated_cars()
+
+    if not TransitType.query.count():
+        seed.load_transit_type()
+
+
+def add_users(count, rng, first_number=1):
+    """Add users with their residences and cars. Returns a list of (user,
+    residences, usercars), with their ids."""
+
+    zipcodes = [zipcode_id for zipcode_id, in db.session.query(
+        Zipcode.zipcode_id).filter(Zipcode.region_id.isnot(None))
+        .order_by(Zipcode.zipcode_id).all()]
+    cars = Car.query.filter(Car.grams_co2_mile.isnot(None)) \
+        .order_by(Car.car_id).all()
+
+    # hashing is slow on purpose, and every synthetic user has one password
+    password = pbkdf2_sha256.hash("password")
+
+    users = []
+    for number in range(first_number, first_number + count):
+        user = User(email=u"user%s@example.com" % number, password=password,
+                    name=u"User %s" % number)
+        db.session.add(user)
+        db.session.flush()
+
+        residences = []
+        for i in range(rng.choice([1, 1, 2, 2, 3])):
+            residences.append(Residence(
+                user_id=user.user_id, zipcode_id=rng.choice(zipcodes),
+                name_or_address=[u"Home", u"Cabin", u"Apartment"][i],
+                is_default=i == 0, number_of_residents=rng.randint(1, 5)))
+
+        usercars = []
+        for i in range(rng.choice([1, 2])):
+            car = rng.choice(cars)
+            usercars.append(UserCar(
+                user_id=user.user_id, make=car.make, model=car.model,
+                year=car.year, cylinders=car.cylinders,
+                transmission=car.transmission, is_default=i == 0))
+
+        db.session.add_all(residences + usercars)
+        db.session.flush()
+        users.append((user, residences, usercars))
+
+    return users
+
+
+def get_season(day, peak_day):
+    """1 on the peak day of the year, -1 six months away."""
+
+    return math.cos(2 * math.pi * (day.timetuple().tm_yday - peak_day) / 365.0)
+
+
+def generate_kwh(users, days, rng):
+    """Yield the value tuples of every residence's daily electricity, with
+    air conditioning in summer and lights and heating in winter."""
+
+    for user, residences, usercars in users:
+        for residence in residences:
+            kwh = rng.uniform(4, 8) * (1 + residence.number_of_residents * 0.4)
+
+            for day in days:
+                daily_kwh = kwh * (1 + 0.25 * abs(get_season(day, 200))) * \
+                    rng.uniform(0.8, 1.2)
+                yield residence.residence_id, round(daily_kwh, 2), day, day
+
+
+def generate_therms(users, days, rng):
+    """Yield the value tuples of every residence's daily natural gas, mostly
+    heating in winter and hot water the rest of the year."""
+
+    for user, residences, usercars in users:
+        for residence in residences:
+            therms = rng.uniform(0.5, 2.5)
+
+            for day in days:
+                daily_therms = therms * (1.1 + get_season(day, 15)) * \
+                    rng.uniform(0.8, 1.2)
+                yield residence.residence_id, round(daily_therms, 2), day, day
+
+
+def generate_trips(users, days, rng):
+    """Yield the value tuples of every user's trips, a round trip commute on
+    most weekdays in their default car and errands on some weekends."""
+
+    for user, residences, usercars in users:
+        commute = rng.uniform(3, 35)
+
+        for day in days:
+            if day.weekday() < 5:
+                if rng.random() < 0.9:  # vacations and days at home
+                    yield (user.user_id, usercars[0].usercar_id, 1, day,
+                           round(2 * commute * rng.uniform(0.95, 1.1), 1),
+                           rng.choice([1, 1, 1, 2]))
+            elif rng.random() < 0.5:
+                yield (user.user_id, rng.choice(usercars).usercar_id, 1, day,
+                       round(rng.uniform(2, 40), 1), rng.randint(1, 4))
+
+
+def generate(users=10, years=3, seed_number=1, end_day=END_DAY):
+    """Add users with years of daily history up to end_day, and their daily
+    CO2 rollup, and commit them. Returns the number of rows added to each
+    table."""
+
+    rng = random.Random(seed_number)
+
+    load_reference_data()
+
+    first_number = User.query.count() + 1
+    new_users = add_users(users, rng, first_number)
+
+    first_day = end_day - timedelta(days=int(365 * years) - 1)
+    days = [first_day + timedelta(days=i)
+            for i in range((end_day - first_day).days + 1)]
+
+    kwh_loader = BulkLoader(ElectricityLog.__table__,
+                            ["residence_id", "kwh", "start_date", "end_date"])
+    kwh_loader.load(generate_kwh(new_users, days, rng))
+
+    ng_loader = BulkLoader(NGLog.__table__,
+                           ["residence_id", "therms", "start_date",
+                            "end_date"])
+    ng_loader.load(generate_therms(new_users, days, rng))
+
+    trip_loader = BulkLoader(TripLog.__table__,
+                             ["user_id", "usercar_id", "transportation_type",
+                              "date", "miles", "number_of_passengers"])
+    trip_loader.load(generate_trips(new_users, days, rng))
+
+    # rebuilt a user at a time to keep the recalculation small
+    for user, residences, usercars in new_users:
+        DailyCO2Rollup.rebuild(user.user_id)
+
+    db.session.commit()
+    invalidate_co2_timelines()
+
+    return {"users": len(new_users),
+            "residences": sum(len(residences)
+                              for user, residences, usercars in new_users),
+            "usercars": sum(len(usercars)
+                            for user, residences, usercars in new_users),
+            "electricity_log": kwh_loader.loaded,
+            "ng_log": ng_loader.loaded,
+            "trip_log": trip_loader.loaded}
+
+
+if __name__ == "__main__":
+    from model import connect_to_db
+    from server import app
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--years", type=float, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    connect_to_db(app)
+    db.create_all()
+
+    # print the load report of each table, see bulk_load.py
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    print generate(args.users, args.years, args.seed)
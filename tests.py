@@ -1,8 +1,39 @@
 from unittest import TestCase
 from model import *
 from server import app
+import server
 from flask import session
+from sqlalchemy import event
+from cache import LRUCache, DiskCache, get_cache_stats
+from distance import (DistanceResolver, FixtureDistanceProvider,
+                      GoogleDistanceProvider, DistanceError,
+                      DistanceConfigError)
+from zipcode_lookup import (CityZipcodeIndex, ZipcodeResolver, ZipcodeError,
+                            normalize_city)
+from emissions import LogArrays
+from car_catalog import CarEmissionsIndex
+import request_stats
+import metrics
+from request_profiler import RequestProfiler
+from bulk_load import BulkLoader
+import bulk_load
+from interval_data import (read_green_button, load_daily_usage,
+                           group_usage_per_day)
+from StringIO import StringIO
+from gzip import GzipFile
+import seed
+import synthetic_data
+import benchmark
 import json
+import logging
+import random
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from functools import wraps
+import time
 
 
 class FlaskTestsDatabase(TestCase):
@@ -29,6 +60,296 @@ class FlaskTestsDatabase(TestCase):
         car = Car.query.filter_by(car_id=1).one()
         self.assertIsNotNone(car)
 
+    def test_car_factor_cache(self):
+        Car.invalidate_factor_cache()
+        misses = car_factor_cache.misses
+        hits = car_factor_cache.hits
+
+        factor = Car.get_avg_grams_co2_mile("Toyota", "4Runner 2WD", 2004)
+        self.assertEqual(factor, (493.722222222222 + 555.4375) / 2)
+        Car.get_avg_grams_co2_mile("Toyota", "4Runner 2WD", "2004", "", "")
+        self.assertEqual(car_factor_cache.misses, misses + 1)
+        self.assertEqual(car_factor_cache.hits, hits + 1)
+
+        # changing the catalog invalidates cached factors
+        db.session.add(Car(car_id=6, make="Toyota", model="4Runner 2WD",
+                           year=2004, grams_co2_mile=400))
+        db.session.commit()
+        self.assertEqual(len(car_factor_cache), 0)
+
+    def test_zipcode_factor_index(self):
+        self.assertEqual(Zipcode.get_lb_co2e_mega_wh("94133"), 621.9)
+        self.assertEqual(Zipcode.get_lb_co2e_mega_wh(94133), 621.9)
+        self.assertRaises(NoResultFound, Zipcode.get_lb_co2e_mega_wh, "00000")
+        self.assertEqual(ElectricityLog.sum_kwh_co2_other_location(
+            1, "94133", "1/1/2017", "12/31/2017"), 154.23)
+
+        # changing a region reloads the index
+        region = Region.query.get("CAMX")
+        region.lb_co2e_mega_wh = 500
+        db.session.commit()
+        self.assertEqual(Zipcode.get_lb_co2e_mega_wh("94133"), 500)
+
+    def test_trip_co2_per_month_leap_year(self):
+        TripLog.create(1, 1, "2016-02-29", 100)
+
+        co2_per_month = TripLog.sum_trip_co2_per_month(1, 2016)
+        self.assertEqual(len(co2_per_month), 12)
+        self.assertEqual(co2_per_month[1], 42.5)
+        self.assertEqual(sum(co2_per_month), 42.5)
+
+    def test_co2_per_month_matches_sums(self):
+        self.assertEqual(TripLog.sum_trip_co2_per_month(1, 2017)[:2],
+                         [TripLog.sum_trip_co2(1, "1/1/2017", "1/31/2017"),
+                          TripLog.sum_trip_co2(1, "2/1/2017", "2/28/2017")])
+        self.assertEqual(ElectricityLog.sum_kwh_co2_per_month(1, 2017)[0],
+                         ElectricityLog.sum_kwh_co2(1, "1/1/2017", "1/31/2017"))
+        self.assertEqual(NGLog.sum_ng_co2_per_month(1, 2017)[0],
+                         NGLog.sum_ng_co2(1, "1/1/2017", "1/31/2017"))
+
+    def test_co2_per_yr_matches_sums(self):
+        TripLog.create(1, 1, "2016-02-29", 100)
+
+        self.assertEqual(TripLog.get_trip_years(1), [2016, 2017])
+        trip_co2_per_yr = TripLog.get_co2_per_yr(1)
+        self.assertEqual(trip_co2_per_yr[2016]["total"],
+                         TripLog.sum_trip_co2(1, "1/1/2016", "12/31/2016"))
+        self.assertEqual(trip_co2_per_yr[2017]["total"],
+                         TripLog.sum_trip_co2(1, "1/1/2017", "12/31/2017"))
+        self.assertEqual(ElectricityLog.get_co2_per_yr(1)[2017]["total"],
+                         ElectricityLog.sum_kwh_co2(1))
+        self.assertEqual(NGLog.get_co2_per_yr(1)[2017]["total"],
+                         NGLog.sum_ng_co2(1))
+
+
+class LRUCacheTest(TestCase):
+    """Test the in-process LRU cache."""
+
+    def test_eviction(self):
+        cache = LRUCache("test", maxsize=2)
+        cache.get("a", lambda: 1)
+        cache.get("b", lambda: 2)
+        cache.get("a", lambda: 1)
+        cache.get("c", lambda: 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get("b", lambda: 20), 20)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 4)
+
+    def test_invalidate(self):
+        cache = LRUCache("test", maxsize=2)
+        cache.get("a", lambda: 1)
+        cache.invalidate("a")
+        self.assertEqual(cache.get("a", lambda: 10), 10)
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidated_while_loading(self):
+        cache = LRUCache("test", maxsize=2)
+
+        def load_before_change():
+            cache.invalidate("a")  # another thread's change lands meanwhile
+            return 1
+
+        self.assertEqual(cache.get("a", load_before_change), 1)
+        self.assertEqual(cache.get("a", lambda: 2), 2)
+        self.assertEqual(cache.get("a", lambda: 3), 2)
+
+    def test_duplicate_names(self):
+        first = LRUCache("test_duplicate", maxsize=2)
+        second = LazyIndex("test_duplicate", dict)
+        first.get("a", lambda: 1)
+
+        # both caches are reported, each under its own name
+        self.assertEqual(second.name, "test_duplicate_2")
+        cache_stats = get_cache_stats()
+        self.assertEqual(cache_stats["test_duplicate"]["misses"], 1)
+        self.assertEqual(cache_stats["test_duplicate_2"]["misses"], 0)
+
+
+class DistanceTest(TestCase):
+    """Test the cached distance lookups with the fixture provider."""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.provider = FixtureDistanceProvider(
+            {("San Francisco, CA", "Oakland, CA"): 19312})
+        self.cache = DiskCache("test_distances",
+                               os.path.join(self.cache_dir, "cache.sqlite"))
+        self.resolver = DistanceResolver(self.provider, self.cache)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_cached_lookups(self):
+        self.assertEqual(self.resolver.get_miles("San Francisco, CA",
+                                                 "Oakland, CA"), 12.0)
+        self.assertEqual(self.resolver.get_miles(" san francisco,CA ",
+                                                 "oakland,  ca"), 12.0)
+        self.assertEqual(self.provider.requests, 1)
+
+        # the cache is on disk, so a new resolver reuses it
+        resolver = DistanceResolver(self.provider, DiskCache(
+            "test_distances", self.cache.path))
+        resolver.get_miles("San Francisco, CA", "Oakland, CA")
+        self.assertEqual(self.provider.requests, 1)
+
+        self.assertRaises(DistanceError, self.resolver.get_miles,
+                          "San Francisco, CA", "Honolulu, HI")
+
+    def test_ttl_and_eviction(self):
+        cache = DiskCache("test_ttl", self.cache.path, maxsize=2, ttl=0)
+        cache.get("a", lambda: 1)
+        self.assertEqual(cache.get("a", lambda: 2), 2)
+        self.assertEqual(cache.hits, 0)
+
+        cache = DiskCache("test_eviction", self.cache.path, maxsize=2)
+        cache.invalidate()
+        for key in ["a", "b", "c"]:
+            cache.get(key, lambda: key)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get("a", lambda: "reloaded"), "reloaded")
+
+    def test_in_flight_lookups_collapse(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_lookup(origin, destination, mode):
+            started.set()
+            release.wait()
+            return 19312
+
+        calls = []
+
+        def count_calls(origin, destination, mode):
+            calls.append(origin)
+            return slow_lookup(origin, destination, mode)
+
+        self.provider.get_meters = count_calls
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            self.resolver.get_miles("San Francisco, CA", "Oakland, CA")))
+            for i in range(3)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        # the other lookups waited for the first one or hit the cache
+        self.assertEqual(results, [12.0] * 3)
+        self.assertEqual(len(calls), 1)
+
+    def test_route(self):
+        resolver = server.distance_resolver
+        server.distance_resolver = self.resolver
+        try:
+            client = app.test_client()
+            resp = client.get("/get-distance?origin=San Francisco, CA"
+                              "&destination=Oakland, CA")
+            self.assertEqual(resp.data, "12.0")
+            resp = client.get("/get-distance?origin=San Francisco, CA"
+                              "&destination=Honolulu, HI")
+            self.assertEqual(resp.status_code, 404)
+        finally:
+            server.distance_resolver = resolver
+
+    def test_missing_api_key(self):
+        api_key = os.environ.pop("GOOGLE_API_KEY", None)
+        resolver = server.distance_resolver
+        server.distance_resolver = DistanceResolver(GoogleDistanceProvider(),
+                                                    self.cache)
+        try:
+            # no request is sent, and it isn't mistaken for a bad route
+            self.assertRaises(DistanceConfigError,
+                              server.distance_resolver.get_miles,
+                              "San Francisco, CA", "Oakland, CA")
+            self.assertEqual(server.distance_resolver.provider.requests, 0)
+
+            resp = app.test_client().get("/get-distance?origin=San Francisco,"
+                                         " CA&destination=Oakland, CA")
+            self.assertEqual(resp.status_code, 503)
+        finally:
+            server.distance_resolver = resolver
+            if api_key is not None:
+                os.environ["GOOGLE_API_KEY"] = api_key
+
+
+class ZipcodeLookupTest(TestCase):
+    """Test the offline city to zipcode index and the cached fallback."""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.index = LazyIndex("test_city_zipcodes",
+                               CityZipcodeIndex.from_files)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_bundled_index(self):
+        index = self.index.data
+        self.assertEqual(index.get_zipcodes("San Francisco", "CA")[0],
+                         "94102")
+        self.assertIn("94133", index.get_zipcodes(" san  francisco ", "ca"))
+        self.assertEqual(index.get_region_id("94133"), "CAMX")
+        self.assertEqual(index.get_zipcodes("St. Louis", "MO"),
+                         index.get_zipcodes("Saint Louis", "MO"))
+        self.assertEqual(index.get_zipcodes("Atlantis", "CA"), [])
+        self.assertEqual(normalize_city("Ft. Worth"), "fort worth")
+
+    def test_fallback(self):
+        fallback = FixtureZipcodeProvider({"Atlantis": ["99999"]})
+        cache = DiskCache("test_city_zipcodes",
+                          os.path.join(self.cache_dir, "cache.sqlite"))
+        resolver = ZipcodeResolver(self.index, fallback, cache)
+
+        # the index answers cities it knows without the fallback
+        self.assertEqual(resolver.get_zipcode("Oakland", "CA"), "94601")
+        self.assertEqual(resolver.get_zipcode("Atlantis", "CA"), "99999")
+        self.assertEqual(resolver.get_zipcode("atlantis", "ca"), "99999")
+        self.assertEqual(fallback.requests, 1)
+
+        self.assertEqual(resolver.get_candidates("Atlantis", "CA"),
+                         [{"zipcode": "99999", "region_id": None}])
+        self.assertRaises(ZipcodeError, resolver.get_zipcode, "Lemuria", "CA")
+        self.assertRaises(ZipcodeError, ZipcodeResolver(self.index).get_zipcode,
+                          "Atlantis", "CA")
+
+    def test_routes(self):
+        resolver = server.zipcode_resolver
+        server.zipcode_resolver = ZipcodeResolver(self.index)
+        try:
+            client = app.test_client()
+            resp = client.get("/get-zipcode?city=San Francisco&state=CA")
+            self.assertEqual(resp.data, "94102")
+            resp = client.get("/get-zipcode?city=Atlantis&state=CA")
+            self.assertEqual(resp.status_code, 404)
+
+            resp = client.get("/zipcodes.json?city=San Francisco&state=CA")
+            zipcodes = json.loads(resp.data)["zipcodes"]
+            self.assertIn({"zipcode": "94133", "region_id": "CAMX"},
+                          zipcodes)
+        finally:
+            server.zipcode_resolver = resolver
+
+
+class FixtureZipcodeProvider(object):
+    """Stands in for zipcodeapi with known zipcodes of cities."""
+
+    def __init__(self, zipcodes):
+        self.zipcodes = zipcodes
+        self.requests = 0
+
+    def get_zipcodes(self, city, state):
+        self.requests += 1
+        if city.title() not in self.zipcodes:
+            raise ZipcodeError("no zipcodes for %s" % city)
+        return self.zipcodes[city.title()]
+
 
 class LoggedOutIntegrationTest(TestCase):
     """Test each route when there is no user logged in."""
@@ -117,6 +438,207 @@ class BasicIntegrationTest(TestCase):
         self.assertIn("Prius", resp.data)
         self.assertIn("42.5", resp.data)
 
+    def test_log_pages(self):
+        # same day trips are ordered by id, so pages never skip or repeat
+        db.session.add_all([TripLog(user_id=1, usercar_id=2,
+                                    transportation_type=1, date="2016-06-01",
+                                    miles=miles, number_of_passengers=1)
+                            for miles in range(1, 6)])
+        db.session.commit()
+
+        trips = []
+        after = ""
+        while after is not None:
+            resp = self.client.get("/trip-log.json?page_size=2&after=" + after)
+            page = json.loads(resp.data)
+            self.assertLessEqual(len(page["logs"]), 2)
+            trips.extend(page["logs"])
+            after = page["next"]
+
+        self.assertEqual([trip["miles"] for trip in trips],
+                         [310, 100, 5, 4, 3, 2, 1])
+        self.assertEqual(trips[1]["car"], "Toyota Prius 2004")
+        self.assertEqual(trips[1]["co2"], 42.5)
+
+        resp = self.client.get("/trip-log.json?year=2016&usercar_id=2")
+        self.assertEqual(len(json.loads(resp.data)["logs"]), 5)
+
+        resp = self.client.get("/trip-log?page_size=3&year=2016")
+        self.assertIn("after=2016-06-01.", resp.data)
+        self.assertNotIn("Prius 2004</td>", resp.data)
+
+        resp = self.client.get("/trip-log.json?after=yesterday")
+        self.assertEqual(400, resp.status_code)
+
+    def test_residence_log_pages(self):
+        resp = self.client.get("/kwh-log.json?residence_id=2")
+        logs = json.loads(resp.data)["logs"]
+        self.assertEqual([(log["kwh"], log["residence"]) for log in logs],
+                         [(60, "Beach House")])
+
+        resp = self.client.get("/kwh-log?year=2016")
+        self.assertIn("No electricity data for these filters", resp.data)
+
+        resp = self.client.get("/ng-log.json?year=2017&page_size=1")
+        page = json.loads(resp.data)
+        self.assertEqual([log["therms"] for log in page["logs"]], [30])
+        self.assertIsNone(page["next"])
+
+    def test_all_locations(self):
+        resp = self.client.get("/co2-all-locations.json?year=2017")
+        sweep = json.loads(resp.data)
+
+        self.assertEqual(sweep["monthly_kwh"][:2], [248, 0])
+        self.assertEqual(sweep["current_annual_co2"], 154.23)
+        self.assertEqual([(region["rank"], region["region_id"],
+                           region["annual_co2"], region["percent_change"])
+                          for region in sweep["regions"]],
+                         [(1, "CAMX", 154.23, 0), (2, "USA", 285.27, 85)])
+        self.assertEqual(sweep["regions"][0]["monthly_co2"],
+                         sweep["current_monthly_co2"])
+
+    def test_other_cars(self):
+        prius = {"make": "Toyota", "model": "Prius", "year": 2004}
+        runner = {"make": "Toyota", "model": "4Runner 4WD", "year": 2004,
+                  "cylinders": "6", "transmission": "Automatic 4-spd"}
+
+        def compare(**data):
+            resp = self.client.post("/co2-other-cars.json",
+                                    data=json.dumps(data),
+                                    content_type="application/json")
+            return resp.status_code, json.loads(resp.data)
+
+        status, result = compare(tripYear=2017, userCarId=1, candidates=[
+            prius, runner, {"make": "Toyota", "model": "Tardis", "year": 1963}])
+        self.assertEqual(result["monthly_miles"][:3], [100, 0, 0])
+        self.assertEqual(result["current_yearly_co2"], 42.5)
+
+        prius_result, runner_result, unknown = result["candidates"]
+        self.assertEqual(prius_result["yearly_co2"], 42.5)
+        self.assertEqual(prius_result["percent_change"], 0)
+        self.assertGreater(runner_result["percent_change"], 0)
+        self.assertEqual(unknown["error"], "Car not found")
+
+        # every car of the user
+        status, result = compare(tripYear=2017, candidates=[prius])
+        self.assertEqual(result["monthly_miles"][:3], [100, 310, 0])
+        self.assertEqual(result["candidates"][0]["yearly_co2"], 174.26)
+        self.assertEqual(result["candidates"][0]["monthly_co2"][:2],
+                         [42.5, 131.76])
+
+        # the cached miles follow new trips
+        TripLog.create(1, 1, "2017-03-01", 10)
+        status, result = compare(tripYear=2017, userCarId=1,
+                                 candidates=[prius])
+        self.assertEqual(result["monthly_miles"][:3], [100, 0, 10])
+
+        self.assertEqual(compare(tripYear=2017, candidates=[])[0], 400)
+        self.assertEqual(compare(tripYear=2017, userCarId=9,
+                                 candidates=[prius])[0], 400)
+
+    def test_trips_without_a_car(self):
+        db.session.add(TripLog(user_id=1, usercar_id=None,
+                               transportation_type=1, date="2017-03-01",
+                               miles=40, number_of_passengers=1))
+        db.session.commit()
+
+        resp = self.client.get("/trip-log.json?year=2017&page_size=1")
+        trip = json.loads(resp.data)["logs"][0]
+        self.assertEqual((trip["miles"], trip["car"], trip["co2"]),
+                         (40, None, 0))
+
+        # the trip isn't driven in any of the cars, so it isn't compared
+        resp = self.client.post("/co2-other-cars.json", data=json.dumps(
+            {"tripYear": 2017, "candidates": [
+                {"make": "Toyota", "model": "Prius", "year": 2004}]}),
+            content_type="application/json")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data)["monthly_miles"][:3],
+                         [100, 310, 0])
+
+    def test_sums_with_a_trip_without_a_car(self):
+        db.session.add(TripLog(user_id=1, usercar_id=None,
+                               transportation_type=1, date="2017-01-01",
+                               miles=40, number_of_passengers=1))
+        db.session.commit()
+
+        # the trip counts no car CO2 in every total
+        self.assertEqual(TripLog.sum_trip_co2(1), 399.03)
+        self.assertEqual(TripLog.sum_trip_co2(1, from_timeline=False),
+                         399.03)
+        self.assertEqual(TripLog.sum_trip_co2_per_month(1, 2017)[0], 42.5)
+        self.assertEqual(TripLog.get_co2_per_yr(1)[2017]["total"], 399.03)
+        self.assertEqual(TripLog.calculate_total_co2_per_day_of_week(1)[6],
+                         43)
+        self.assertEqual(TripLog.get_trip_summary(1)[2017]["total"], 399.03)
+        self.assertEqual(TripLog.sum_trip_co2_other_car(
+            1, "Toyota", "Prius", 2004, None, None),
+            TripLog.sum_trip_co2_other_car(
+                1, "Toyota", "Prius", 2004, None, None, usercar_id=1) +
+            TripLog.sum_trip_co2_other_car(
+                1, "Toyota", "Prius", 2004, None, None, usercar_id=2))
+
+        resp = self.client.get("/dashboard.json?year=2017")
+        self.assertEqual(resp.status_code, 200)
+        dashboard = json.loads(resp.data)
+        self.assertEqual(dashboard["yearly_totals"]["2017"]["total"], 903.93)
+
+    def test_car_recommendations(self):
+        resp = self.client.get("/cars/recommendations.json?k=2")
+        result = json.loads(resp.data)
+        self.assertEqual(result["year"], 2017)
+        self.assertEqual(result["miles"], 410)
+        self.assertEqual([car["car_id"] for car in result["cars"]], [1, 2])
+
+        prius = result["cars"][0]
+        self.assertEqual(prius["yearly_co2"], 174.26)
+        self.assertEqual(prius["savings"],
+                         round(result["current_yearly_co2"] - 174.26, 2))
+
+        resp = self.client.get("/cars/recommendations.json?tripYear=2017"
+                               "&drive=Rear-Wheel Drive&make=Toyota")
+        self.assertEqual([car["car_id"] for car in
+                          json.loads(resp.data)["cars"]], [2, 3])
+
+        resp = self.client.get("/cars/recommendations.json?max_year=2003")
+        self.assertEqual(json.loads(resp.data)["cars"], [])
+
+    def test_query_stats_headers(self):
+        request_stats.reset_route_stats()
+
+        with QueryCounter() as queries:
+            resp = self.client.get("/kwh-log")
+        self.assertEqual(resp.headers["X-Query-Count"], str(queries.count))
+        self.assertIn("db;dur=", resp.headers["Server-Timing"])
+        self.assertNotIn("X-Query-Budget-Exceeded", resp.headers)
+
+        app.config["QUERY_BUDGETS"]["view_kwh_log"] = 1
+        try:
+            resp = self.client.get("/kwh-log")
+        finally:
+            del app.config["QUERY_BUDGETS"]["view_kwh_log"]
+        self.assertEqual(resp.headers["X-Query-Budget-Exceeded"], "1")
+
+        stats = request_stats.get_route_stats()
+        self.assertEqual([(route["route"], route["requests"],
+                           route["over_budget"]) for route in stats],
+                         [("view_kwh_log", 2, 1)])
+        self.assertEqual(stats[0]["max_queries"], queries.count)
+
+    def test_query_stats_failed_query(self):
+        stats = request_stats.start_request()
+        try:
+            info = db.session.connection().info
+            self.assertRaises(Exception, db.session.execute,
+                              "SELECT * FROM no_such_table")
+            db.session.rollback()
+
+            # the failed statement's timer doesn't leak to the next one
+            self.assertEqual(info.get("query_start"), [])
+            self.assertEqual(stats.queries, 1)
+        finally:
+            request_stats.finish_request("test")
+
     def test_cardata_page(self):
         resp = self.client.get("/car-data")
         self.assertEqual(200, resp.status_code)
@@ -125,6 +647,156 @@ class BasicIntegrationTest(TestCase):
         cars = json.loads(resp.data)
         self.assertEqual(len(cars), 5)
 
+        resp = self.client.get("/car-data?make=Toyota&model=4Runner 4WD"
+                               "&year=2004&cylinders=6")
+        self.assertEqual(json.loads(resp.data),
+                         [{"make": "Toyota", "model": "4Runner 4WD",
+                           "year": 2004, "cylinders": "6",
+                           "transmission": "Automatic 4-spd"}])
+
+    def test_car_catalog(self):
+        resp = self.client.get("/cars/catalog.json")
+        self.assertEqual(200, resp.status_code)
+        catalog = json.loads(resp.data)
+        self.assertEqual(sorted(catalog["Toyota"]),
+                         ["4Runner 2WD", "4Runner 4WD", "Prius"])
+
+        # an unchanged catalog isn't sent again
+        etag = resp.headers["ETag"]
+        resp = self.client.get("/cars/catalog.json",
+                               headers={"If-None-Match": etag})
+        self.assertEqual(304, resp.status_code)
+
+        resp = self.client.get("/cars/catalog.json?make=Toyota&model=Prius")
+        self.assertEqual(json.loads(resp.data),
+                         {"2004": {"4": ["Automatic (variable gear ratios)"]}})
+        etag = resp.headers["ETag"]
+        resp = self.client.get("/cars/catalog.json?make=Toyota&model=Prius",
+                               headers={"If-None-Match": etag})
+        self.assertEqual(304, resp.status_code)
+
+        resp = self.client.get("/cars/catalog.json?make=Tesla")
+        self.assertEqual(404, resp.status_code)
+
+        # adding a car rebuilds the tree with a new ETag
+        db.session.add(Car(car_id=6, make="Honda", model="Fit", year=2015,
+                           cylinders=4, transmission="Manual 5-spd"))
+        db.session.commit()
+        self.assertEqual(Car.get_unique_makes(), ["Honda", "Toyota"])
+        resp = self.client.get("/cars/catalog.json?make=Toyota&model=Prius",
+                               headers={"If-None-Match": etag})
+        self.assertEqual(200, resp.status_code)
+
+    def test_co2_trend(self):
+        resp = self.client.get("/co2-trend.json?year=2017")
+        self.assertEqual(200, resp.status_code)
+        trend = json.loads(resp.data)
+        self.assertEqual(len(trend["trip"]), 12)
+        self.assertEqual(trend["trip"][0], 42.5)
+        self.assertEqual(trend["kwh"][0], 154.23)
+        self.assertEqual(trend["ng"][1], 0)
+
+    def test_co2_other_location(self):
+        db.session.add(Zipcode(zipcode_id="10001", region_id="USA"))
+        db.session.commit()
+
+        resp = self.client.get("/co2-other-location.json?year=2017"
+                               "&zipcode=10001")
+        self.assertEqual(200, resp.status_code)
+        comparison = json.loads(resp.data)
+
+        # the same totals as summing each month on its own
+        months = [("1/1/2017", "1/31/2017"), ("2/1/2017", "2/28/2017"),
+                  ("3/1/2017", "3/31/2017")]
+        self.assertEqual(comparison["current_monthly_co2"][:3],
+                         [ElectricityLog.sum_kwh_co2(1, start, end)
+                          for start, end in months])
+        self.assertEqual(comparison["new_monthly_co2"][:3],
+                         [ElectricityLog.sum_kwh_co2_other_location(
+                             1, "10001", start, end)
+                          for start, end in months])
+        self.assertEqual(comparison["new_yearly_co2"],
+                         ElectricityLog.sum_kwh_co2_other_location(1, "10001"))
+
+    def test_chart_etags(self):
+        resp = self.client.get("/co2-trend.json?year=2017")
+        etag = resp.headers["ETag"]
+
+        resp = self.client.get("/co2-trend.json?year=2017",
+                               headers={"If-None-Match": etag})
+        self.assertEqual(304, resp.status_code)
+        self.assertEqual(resp.data, "")
+
+        # other parameters are a different chart
+        resp = self.client.get("/co2-trend.json?year=2016",
+                               headers={"If-None-Match": etag})
+        self.assertEqual(200, resp.status_code)
+
+        # new data changes the version
+        self.client.post("/add-kwh", data=dict(start_date="2017-03-01",
+                                               end_date="2017-03-31",
+                                               kwh=100, residence="Home"))
+        resp = self.client.get("/co2-trend.json?year=2017",
+                               headers={"If-None-Match": etag})
+        self.assertEqual(200, resp.status_code)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        self.assertEqual(json.loads(resp.data)["kwh"][2], 62.19)
+
+    def test_chart_etags_after_factor_reload(self):
+        for url in ["/co2-all-locations.json?year=2017",
+                    "/cars/recommendations.json?tripYear=2017"]:
+            etag = self.client.get(url).headers["ETag"]
+
+            # reloading the regions, zipcodes or cars reprices every chart
+            emission_factors_changed(["kwh"])
+            db.session.commit()
+
+            resp = self.client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(200, resp.status_code, url)
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_gzip(self):
+        min_bytes = server.GZIP_MIN_BYTES
+        server.GZIP_MIN_BYTES = 10
+        try:
+            resp = self.client.get("/co2-trend.json?year=2017",
+                                   headers={"Accept-Encoding": "gzip"})
+        finally:
+            server.GZIP_MIN_BYTES = min_bytes
+
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        trend = json.loads(GzipFile(fileobj=StringIO(resp.data)).read())
+        self.assertEqual(trend["trip"][0], 42.5)
+        gzip_etag = resp.headers["ETag"]
+
+        resp = self.client.get("/co2-trend.json?year=2017")
+        self.assertNotIn("Content-Encoding", resp.headers)
+
+        # the two bodies differ, so their strong ETags do too
+        self.assertNotEqual(resp.headers["ETag"], gzip_etag)
+        resp = self.client.get("/co2-trend.json?year=2017",
+                               headers={"Accept-Encoding": "gzip",
+                                        "If-None-Match": gzip_etag})
+        self.assertEqual(304, resp.status_code)
+        self.assertEqual(resp.headers["ETag"], gzip_etag)
+
+    def test_dashboard(self):
+        resp = self.client.get("/dashboard.json?year=2017")
+        self.assertEqual(200, resp.status_code)
+        self.assertIn("X-Response-Time", resp.headers)
+        dashboard = json.loads(resp.data)
+
+        # every chart gets the same data as its own endpoint
+        charts = {"year_comparison": "/year-comparison-json",
+                  "co2_per_datatype": "/co2-per-datatype.json?year=2017",
+                  "co2_trend": "/co2-trend.json?year=2017",
+                  "co2_day_of_week": "/co2-day-of-week.json?year=2017"}
+        for key, url in charts.items():
+            self.assertEqual(dashboard[key],
+                             json.loads(self.client.get(url).data))
+
+        self.assertEqual(dashboard["yearly_totals"]["2017"]["total"], 903.93)
+
 
 class AddToProfile(TestCase):
     """Integration tests to make sure each route is loading with the test data
@@ -168,6 +840,1352 @@ class AddToProfile(TestCase):
         self.assertIn("Treehouse", rv.data)
 
 
+class DailyCO2RollupTest(TestCase):
+    """Test that the daily CO2 rollup is kept in step with the raw logs."""
+
+    def setUp(self):
+        tc = app.test_client()
+        self.client = tc
+        app.config['TESTING'] = True
+        app.config['SECRET_KEY'] = 'ABC'
+        connect_to_db(app, "postgresql:///test_carbon_calc")
+
+        # Create tables and add sample data
+        db.create_all()
+        initialize_test_data()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = 1
+
+    def tearDown(self):
+        """Do at end of every test."""
+
+        db.session.close()
+        db.drop_all()
+
+    def assertRollupMatchesLogs(self):
+        self.assertEqual(DailyCO2Rollup.check_consistency(), [])
+        self.assertEqual(DailyCO2Rollup.sum_co2(1, "trip"),
+                         TripLog.sum_trip_co2(1))
+        self.assertEqual(DailyCO2Rollup.sum_co2(1, "kwh"),
+                         ElectricityLog.sum_kwh_co2(1))
+        self.assertEqual(DailyCO2Rollup.sum_co2(1, "ng"),
+                         NGLog.sum_ng_co2(1))
+
+    def test_initial_rollup(self):
+        self.assertRollupMatchesLogs()
+        self.assertEqual(NGLog.get_ng_summary(1)["Total"]["total"],
+                         NGLog.sum_ng_co2(1))
+
+    def test_trips_without_a_car(self):
+        TripLog.create(1, None, date(2017, 1, 1), 40)
+        TripLog.create(1, None, date(2017, 3, 1), 40)
+        self.assertRollupMatchesLogs()
+
+        # the summary read from the rollup agrees with the live sums
+        summary = TripLog.get_trip_summary(1)
+        self.assertEqual(summary[2017]["total"],
+                         TripLog.sum_trip_co2(1, "1/1/2017", "12/31/2017"))
+        self.assertEqual(TripLog.get_co2_per_yr(1)[2017]["total"],
+                         summary[2017]["total"])
+
+    def test_add_and_edit_logs(self):
+        self.client.post("/add-kwh", data=dict(start_date="2017-03-01",
+                                               end_date="2017-03-31",
+                                               kwh=100, residence="Home"))
+        self.client.post("/add-ng", data=dict(start_date="2017-01-01",
+                                              end_date="2017-01-31",
+                                              therms=5, residence="Home"))
+        self.client.post("/add-trip", data=dict(date="2017-03-02", miles=20,
+                                                car=1))
+        self.assertRollupMatchesLogs()
+
+        # move a trip to another car and day
+        self.client.post("/edit-trip", data=dict(trip_id=1, date="2017-03-05",
+                                                 miles=50, car=2))
+        self.client.post("/edit-kwh", data=dict(elect_id=2,
+                                                start_date="2017-02-15",
+                                                end_date="2017-03-15",
+                                                kwh=70, residence="Home"))
+        self.assertRollupMatchesLogs()
+        self.assertEqual(DailyCO2Rollup.query.filter_by(
+            source="trip", day=date(2017, 1, 1)).count(), 0)
+
+    def test_check_and_rebuild(self):
+        NGLog.query.filter_by(ng_id=1).update({"therms": 40})
+        db.session.commit()
+
+        mismatches = DailyCO2Rollup.check_consistency(1)
+        self.assertEqual(len(mismatches), 1)
+        self.assertEqual(mismatches[0]["source"], "ng")
+
+        DailyCO2Rollup.rebuild(1)
+        db.session.commit()
+        self.assertRollupMatchesLogs()
+
+    def test_update_range(self):
+        TripLog.query.update({"miles": TripLog.miles * 2},
+                             synchronize_session=False)
+        db.session.commit()
+
+        # only the days in the range are recalculated
+        DailyCO2Rollup.update_range(1, date(2017, 1, 15), date(2017, 2, 15),
+                                    ["trip"])
+        db.session.commit()
+
+        mismatches = DailyCO2Rollup.check_consistency(1)
+        self.assertEqual([row["day"] for row in mismatches],
+                         [date(2017, 1, 1)])
+
+        DailyCO2Rollup.update_range(1, date(2017, 1, 1), date(2017, 1, 1))
+        db.session.commit()
+        self.assertRollupMatchesLogs()
+
+    def test_emission_factors_changed(self):
+        Region.query.update({"lb_co2e_mega_wh": Region.lb_co2e_mega_wh * 2},
+                            synchronize_session=False)
+        db.session.commit()
+        Zipcode.invalidate_factor_index()
+        self.assertEqual(len(DailyCO2Rollup.check_consistency(1)), 2)
+
+        emission_factors_changed(["kwh"])
+        db.session.commit()
+        self.assertRollupMatchesLogs()
+
+
+class QueryCounter(object):
+    """Count the SQL statements sent to the database inside a with block. If
+    cold is True it starts like a new request for a user whose logs just
+    changed, without cached CO2 timelines, car factors or loaded instances."""
+
+    def __init__(self, cold=False):
+        self.cold = cold
+        self.count = 0
+        self.statements = []
+
+    def __enter__(self):
+        if self.cold:
+            invalidate_co2_timelines()
+            Car.invalidate_factor_cache()
+            db.session.expunge_all()
+
+        # the session may still be bound to the engine of an earlier test
+        self.engine = db.session.get_bind()
+        event.listen(self.engine, "before_cursor_execute", self.add_query)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, "before_cursor_execute", self.add_query)
+
+    def add_query(self, conn, cursor, statement, *args):
+        self.count += 1
+        self.statements.append(statement)
+
+
+class QueryBudget(QueryCounter):
+    """Fail if more than budget SQL statements are sent inside a with block,
+    or by a function it decorates:
+
+        with QueryBudget(3, "trip summary"):
+            TripLog.get_trip_summary(1)
+
+        @QueryBudget(10)
+        def test_profile(self):
+            ...
+    """
+
+    def __init__(self, budget, label=None, cold=False):
+        super(QueryBudget, self).__init__(cold)
+        self.budget = budget
+        self.label = label
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        super(QueryBudget, self).__exit__(exc_type, exc_value, traceback)
+
+        if exc_type is None and self.count > self.budget:
+            raise AssertionError("%s took %s queries, its budget is %s:\n%s" %
+                                 (self.label or "block", self.count,
+                                  self.budget, "\n".join(
+                                      " ".join(statement.split())[:200]
+                                      for statement in self.statements)))
+
+    def __call__(self, function):
+        @wraps(function)
+        def function_with_budget(*args, **kwargs):
+            with QueryBudget(self.budget, self.label or function.__name__,
+                             self.cold):
+                return function(*args, **kwargs)
+
+        return function_with_budget
+
+
+def add_history(days, first_day=date(2016, 1, 1)):
+    """Add days of daily trips and electricity logs, alternating between user
+    1's cars and residences, and a natural gas log every 30 days, so per-row
+    queries stand out in the query budgets."""
+
+    logs = []
+    for day in range(days):
+        log_date = first_day + timedelta(days=day)
+        logs.append(TripLog(user_id=1, usercar_id=day % 2 + 1,
+                            transportation_type=1, date=log_date,
+                            miles=day % 40 + 1, number_of_passengers=1))
+        logs.append(ElectricityLog(residence_id=day % 2 + 1, kwh=day % 12 + 4,
+                                   start_date=log_date, end_date=log_date))
+        if day % 30 == 0:
+            logs.append(NGLog(residence_id=1, therms=day % 7 + 1,
+                              start_date=log_date,
+                              end_date=log_date + timedelta(days=29)))
+
+    db.session.add_all(logs)
+    DailyCO2Rollup.rebuild(1)
+    db.session.commit()
+
+
+class ElectricityQueryBudgetTest(TestCase):
+    """Test that the electricity CO2 takes the same number of queries however
+    many logs and residences there are."""
+
+    def setUp(self):
+        self.client = app.test_client()
+        app.config['TESTING'] = True
+        app.config['SECRET_KEY'] = 'ABC'
+        connect_to_db(app, "postgresql:///test_carbon_calc")
+
+        # Create tables and add sample data
+        db.create_all()
+        initialize_test_data()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = 1
+
+    def tearDown(self):
+        """Do at end of every test."""
+
+        db.session.close()
+        db.drop_all()
+
+    def add_residence_logs(self, count):
+        residence = Residence(user_id=1, zipcode_id="94133",
+                              name_or_address=u"Cabin", is_default=False,
+                              number_of_residents=1)
+        db.session.add(residence)
+        db.session.flush()
+        db.session.add_all([ElectricityLog(residence_id=residence.residence_id,
+                                           start_date=date(2017, 3, day),
+                                           end_date=date(2017, 3, day), kwh=10)
+                            for day in range(1, count + 1)])
+        db.session.commit()
+
+    def get_query_counts(self):
+        calculations = [
+            lambda: ElectricityLog.sum_kwh_co2(1, from_timeline=False),
+            lambda: ElectricityLog.sum_kwh_co2(1, residence_id=1),
+            lambda: ElectricityLog.calculate_total_co2_per_day_of_week(1),
+            lambda: ElectricityLog.get_electricity_summary(1),
+            lambda: self.client.get("/co2-day-of-week.json?year=2017"),
+            lambda: self.client.get("/kwh-log"),
+            ]
+
+        counts = []
+        for calculate in calculations:
+            with QueryCounter(cold=True) as queries:
+                calculate()
+            counts.append(queries.count)
+
+        return counts
+
+    def test_query_budget(self):
+        # load the zipcode factors before counting
+        Zipcode.get_lb_co2e_mega_wh("94133")
+
+        counts = self.get_query_counts()
+        self.assertEqual(counts[:3], [1, 1, 1])
+        self.assertLessEqual(counts[3], 3)
+        # the trip half of the chart loads the cars' factors as well
+        self.assertLessEqual(counts[4], 6)
+        self.assertLessEqual(counts[5], 6)
+
+        self.add_residence_logs(28)
+        self.assertEqual(self.get_query_counts(), counts)
+        self.assertEqual(ElectricityLog.sum_kwh_co2(1, from_timeline=False),
+                         ElectricityLog.get_log_arrays(1).total())
+
+
+class VectorizedEmissionsTest(TestCase):
+    """Test that the vectorized CO2 calculations match the scalar ones."""
+
+    def setUp(self):
+        connect_to_db(app, "postgresql:///test_carbon_calc")
+
+        # Create tables and add sample data
+        db.create_all()
+        initialize_test_data()
+
+    def tearDown(self):
+        """Do at end of every test."""
+
+        db.session.close()
+        db.drop_all()
+
+    def test_sums(self):
+        for start_date, end_date in [("1/1/1900", "1/1/2036"),
+                                     ("1/1/2017", "1/31/2017"),
+                                     ("2/1/2017", "12/31/2017")]:
+            self.assertEqual(
+                TripLog.get_log_arrays(1, start_date, end_date).total(),
+                TripLog.sum_trip_co2(1, start_date, end_date,
+                                     from_timeline=False))
+            self.assertEqual(
+                ElectricityLog.get_log_arrays(1, start_date, end_date).total(),
+                ElectricityLog.sum_kwh_co2(1, start_date, end_date,
+                                           from_timeline=False))
+            self.assertEqual(
+                NGLog.get_log_arrays(1, start_date, end_date).total(),
+                NGLog.sum_ng_co2(1, start_date, end_date,
+                                 from_timeline=False))
+
+    def test_timeline_sums(self):
+        for start_date, end_date in [("1/1/1900", "1/1/2036"),
+                                     ("1/1/2017", "1/31/2017"),
+                                     ("1/2/2017", "1/30/2017"),
+                                     ("2/1/2017", "12/31/2017"),
+                                     ("12/31/2017", "1/1/2017")]:
+            self.assertEqual(
+                TripLog.sum_trip_co2(1, start_date, end_date),
+                TripLog.sum_trip_co2(1, start_date, end_date,
+                                     from_timeline=False))
+            self.assertEqual(
+                ElectricityLog.sum_kwh_co2(1, start_date, end_date),
+                ElectricityLog.sum_kwh_co2(1, start_date, end_date,
+                                           from_timeline=False))
+            self.assertEqual(
+                NGLog.sum_ng_co2(1, start_date, end_date),
+                NGLog.sum_ng_co2(1, start_date, end_date,
+                                 from_timeline=False))
+
+    def test_timeline_rebuilt_after_changes(self):
+        self.assertEqual(TripLog.sum_trip_co2(1, "1/1/2017", "1/31/2017"),
+                         42.5)
+
+        TripLog.create(1, 1, date(2017, 1, 15), 100)
+        self.assertEqual(TripLog.sum_trip_co2(1, "1/1/2017", "1/31/2017"),
+                         85.01)
+
+        # repeated sums reuse the cached timeline
+        timeline = TripLog.get_co2_timeline(1)
+        self.assertIs(TripLog.get_co2_timeline(1), timeline)
+
+        # electricity written with COPY bumps the data version, so the
+        # timeline cached before it is rebuilt
+        kwh_co2 = ElectricityLog.sum_kwh_co2(1)
+        load_daily_usage("kwh", 1, [(date(2017, 3, 1), 100)])
+        self.assertEqual(ElectricityLog.sum_kwh_co2(1),
+                         round(kwh_co2 + 100 * 0.6219, 2))
+        db.session.commit()
+        self.assertEqual(ElectricityLog.sum_kwh_co2(1),
+                         round(kwh_co2 + 100 * 0.6219, 2))
+
+    def test_timeline_rebuilt_after_other_workers_change(self):
+        kwh_co2 = ElectricityLog.sum_kwh_co2(1)
+
+        # another worker's change bypasses this process's session hooks
+        with db.engine.begin() as connection:
+            connection.execute(ElectricityLog.__table__.insert(),
+                               residence_id=1, kwh=100,
+                               start_date=date(2017, 3, 1),
+                               end_date=date(2017, 3, 1))
+            connection.execute(User.__table__.update()
+                               .where(User.user_id == 1)
+                               .values(data_version=User.data_version + 1))
+        db.session.commit()
+
+        self.assertEqual(ElectricityLog.sum_kwh_co2(1),
+                         round(kwh_co2 + 100 * 0.6219, 2))
+
+    def test_timeline_dropped_on_rollback(self):
+        kwh_co2 = ElectricityLog.sum_kwh_co2(1)
+
+        # the timeline is cached from rows that are rolled back
+        db.session.add(ElectricityLog(residence_id=1, kwh=100,
+                                      start_date=date(2017, 3, 1),
+                                      end_date=date(2017, 3, 1)))
+        db.session.flush()
+        ElectricityLog.sum_kwh_co2(1)
+        db.session.rollback()
+
+        self.assertEqual(ElectricityLog.sum_kwh_co2(1), kwh_co2)
+
+    def test_bulk_add_finds_users_at_once(self):
+        ElectricityLog.sum_kwh_co2(1)
+
+        db.session.add_all([ElectricityLog(residence_id=1, kwh=1,
+                                           start_date=date(2017, 3, day),
+                                           end_date=date(2017, 3, day))
+                            for day in range(1, 21)])
+        with QueryCounter() as counter:
+            db.session.commit()
+
+        # 20 inserts and a single lookup of the residences' users
+        self.assertEqual(counter.count, 21)
+        self.assertEqual(co2_timeline_cache.stats()["size"], 0)
+
+    def test_aggregates(self):
+        trip_arrays = TripLog.get_log_arrays(1)
+        kwh_arrays = ElectricityLog.get_log_arrays(1)
+        ng_arrays = NGLog.get_log_arrays(1)
+
+        self.assertEqual(trip_arrays.per_year(),
+                         DailyCO2Rollup.sum_co2_per_yr(1, "trip"))
+        self.assertEqual(kwh_arrays.per_year(),
+                         DailyCO2Rollup.sum_co2_per_yr(1, "kwh"))
+        self.assertEqual(ng_arrays.per_year(),
+                         DailyCO2Rollup.sum_co2_per_yr(1, "ng"))
+
+        self.assertEqual(trip_arrays.per_month(2017),
+                         TripLog.sum_trip_co2_per_month(1, 2017))
+        self.assertEqual(kwh_arrays.per_month(2017),
+                         ElectricityLog.sum_kwh_co2_per_month(1, 2017))
+        self.assertEqual(ng_arrays.per_month(2017),
+                         NGLog.sum_ng_co2_per_month(1, 2017))
+
+        self.assertEqual(trip_arrays.per_day_of_week(),
+                         TripLog.calculate_total_co2_per_day_of_week(1))
+        self.assertEqual(kwh_arrays.per_day_of_week(),
+                         ElectricityLog.calculate_total_co2_per_day_of_week(1))
+
+
+class LogArraysTest(TestCase):
+    """Test the vectorized kernel against a Python loop on random logs."""
+
+    def test_random_logs(self):
+        random.seed(0)
+        factors = {1: 0.425, 2: 1.15, 3: 0.6219}
+        rows = [(date(2014, 1, 1) + timedelta(days=random.randint(0, 1460)),
+                 round(random.uniform(0, 500), 1),
+                 random.randint(1, 3))
+                for i in range(5000)]
+
+        arrays = LogArrays.from_rows(rows, factors.get)
+
+        total = 0
+        co2_per_year = {}
+        co2_per_month = [0] * 12
+        co2_by_day_of_week = {0: 0, 1: 0, 2: 0, 3: 0, 4: 0, 5: 0, 6: 0}
+        for day, quantity, key in rows:
+            co2 = quantity * factors[key]
+            total += co2
+            co2_per_year[day.year] = co2_per_year.get(day.year, 0) + co2
+            if day.year == 2016:
+                co2_per_month[day.month - 1] += co2
+            co2_by_day_of_week[day.weekday()] += round(co2, 0)
+
+        self.assertAlmostEqual(arrays.total(), total, places=2)
+        for year, co2 in arrays.per_year().items():
+            self.assertAlmostEqual(co2, co2_per_year[year], places=2)
+        for co2, expected in zip(arrays.per_month(2016), co2_per_month):
+            self.assertAlmostEqual(co2, expected, places=2)
+        self.assertEqual(arrays.per_day_of_week(), co2_by_day_of_week)
+
+    def test_no_logs(self):
+        arrays = LogArrays.from_rows([], {}.get)
+        self.assertEqual(arrays.total(), 0)
+        self.assertEqual(arrays.per_year(), {})
+        self.assertEqual(arrays.per_month(2017), [0] * 12)
+
+
+class CarEmissionsIndexTest(TestCase):
+    """Test the top k search over the catalog ranked by CO2."""
+
+    def setUp(self):
+        random.seed(7)
+        makes = ["Make %s" % i for i in range(120)]
+        fuel_types = ["Regular Gasoline", "Premium Gasoline", "Diesel",
+                      "Electricity"]
+        drives = ["Front-Wheel Drive", "Rear-Wheel Drive",
+                  "4-Wheel or All-Wheel Drive"]
+
+        self.cars = [(car_id, random.choice(makes), "Model",
+                      random.randint(1984, 2018), "4", "Automatic",
+                      random.choice(fuel_types), random.choice(drives),
+                      random.choice([None, -1, 0,
+                                     random.uniform(0, 900)]),
+                      None)
+                     for car_id in range(40000)]
+        self.index = CarEmissionsIndex(self.cars)
+
+    def find_lowest(self, k, make=None, fuel_type=None, drive=None,
+                    min_year=None, max_year=None, include_zero=False):
+        matches = [car for car in self.cars
+                   if car[8] is not None and car[8] >= 0 and
+                   (include_zero or car[8] != 0) and
+                   (not make or car[1] == make) and
+                   (not fuel_type or car[6] == fuel_type) and
+                   (not drive or car[7] == drive) and
+                   (not min_year or car[3] >= min_year) and
+                   (not max_year or car[3] <= max_year)]
+        matches.sort(key=lambda car: (car[8], car[0]))
+        return [car[0] for car in matches[:k]]
+
+    def test_find_lowest(self):
+        for filters in [{},
+                        {"make": "Make 3"},
+                        {"fuel_type": "Diesel", "drive": "Rear-Wheel Drive"},
+                        {"make": "Make 8", "fuel_type": "Electricity",
+                         "min_year": 2000, "max_year": 2010},
+                        {"min_year": 2017},
+                        {"make": "Make 999"},
+                        {"include_zero": True},
+                        {"fuel_type": "Electricity", "include_zero": True}]:
+            start = time.time()
+            cars = self.index.find_lowest(10, **filters)
+            self.assertLess(time.time() - start, 0.1)
+            self.assertEqual([car["car_id"] for car in cars],
+                             self.find_lowest(10, **filters))
+
+        self.assertIn("Diesel", self.index.get_values("fuel_type"))
+
+        # cars rated at 0 grams only lead the ranking when asked for
+        self.assertGreater(self.index.find_lowest(1)[0]["grams_co2_mile"], 0)
+        self.assertEqual(self.index.find_lowest(
+            1, include_zero=True)[0]["grams_co2_mile"], 0)
+
+
+class BulkLoaderTest(TestCase):
+    """Test streaming seed data into the database."""
+
+    def setUp(self):
+        connect_to_db(app, "postgresql:///test_carbon_calc")
+        db.create_all()
+
+    def tearDown(self):
+        """Do at end of every test."""
+
+        db.session.close()
+        db.drop_all()
+
+    def load_regions(self, use_copy):
+        loader = BulkLoader(Region.__table__,
+                            ["region_id", "name", "lb_co2e_mega_wh"],
+                            chunk_size=2, use_copy=use_copy)
+        rows = [("CAMX", "WECC California", 621.9),
+                ("NEWE", "NPCC\tNew England\\", 567.3),
+                ("BAD", "Missing factor"),
+                ("RFCE", "RFC East", 689.2)]
+        loader.load(rows)
+        db.session.commit()
+
+        return loader
+
+    def test_copy(self):
+        loader = self.load_regions(use_copy=True)
+        self.assertEqual(loader.loaded, 3)
+        self.assertEqual(loader.rejected, 1)
+        self.assertEqual(Region.query.get("NEWE").name,
+                         "NPCC\tNew England\\")
+        self.assertIsNone(Region.query.get("BAD"))
+
+    def test_executemany(self):
+        loader = self.load_regions(use_copy=False)
+        self.assertEqual(loader.loaded, 3)
+        self.assertEqual(Region.query.get("CAMX").lb_co2e_mega_wh, 621.9)
+
+    def test_report_is_logged(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        bulk_load.log.addHandler(handler)
+        bulk_load.log.setLevel(logging.INFO)
+
+        try:
+            self.load_regions(use_copy=True)
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+            bulk_load.log.removeHandler(handler)
+            bulk_load.log.setLevel(logging.NOTSET)
+
+        # nothing is printed, e.g. in the middle of a web request
+        self.assertEqual(printed, "")
+        self.assertIn("Loaded 3 rows into regions", messages[0])
+        self.assertIn("  rejected row 3: expected 3 values, got 2", messages)
+
+    def test_seed_zipcodes(self):
+        seed.load_regions()
+        seed.load_zipcodes()
+
+        with open("seed-data/zipcode-regions.csv") as zipcodes_file:
+            zipcode_count = sum(1 for line in zipcodes_file)
+
+        self.assertEqual(Zipcode.query.count(), zipcode_count)
+        self.assertEqual(Zipcode.get_lb_co2e_mega_wh("94133"),
+                         Region.query.get("CAMX").lb_co2e_mega_wh)
+
+
+USAGE_CSV = """Name,Phillipe
+Address,1 Main St
+Account Number,1234
+
+TYPE,DATE,START TIME,END TIME,USAGE,UNITS,COST,NOTES
+Electric usage,2017-03-01,00:00,11:59,4.5,kWh,$0.90,
+Electric usage,2017-03-01,12:00,23:59,5.5,kWh,$1.10,
+Electric usage,2017-03-02,00:00,23:59,12,kWh,$2.40,
+Electric usage,2017-03-03,00:00,23:59,not a number,kWh,,
+"""
+
+GREEN_BUTTON_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom" xmlns:espi="http://naesb.org/espi">
+  <entry><content><espi:LocalTimeParameters>
+    <espi:tzOffset>-28800</espi:tzOffset>
+  </espi:LocalTimeParameters></content></entry>
+  <entry><content><espi:ReadingType>
+    <espi:powerOfTenMultiplier>0</espi:powerOfTenMultiplier>
+    <espi:uom>72</espi:uom>
+  </espi:ReadingType></content></entry>
+  <entry><content><espi:IntervalBlock>
+    <espi:IntervalReading>
+      <espi:timePeriod><espi:duration>3600</espi:duration>
+        <espi:start>1488355200</espi:start></espi:timePeriod>
+      <espi:value>1500</espi:value>
+    </espi:IntervalReading>
+    <espi:IntervalReading>
+      <espi:timePeriod><espi:duration>3600</espi:duration>
+        <espi:start>1488441600</espi:start></espi:timePeriod>
+      <espi:value>2500</espi:value>
+    </espi:IntervalReading>
+  </espi:IntervalBlock></content></entry>
+</feed>
+"""
+
+
+class IntervalUploadTest(TestCase):
+    """Test uploading utility interval data."""
+
+    def setUp(self):
+        tc = app.test_client()
+        self.client = tc
+        app.config['TESTING'] = True
+        app.config['SECRET_KEY'] = 'ABC'
+        connect_to_db(app, "postgresql:///test_carbon_calc")
+
+        # Create tables and add sample data
+        db.create_all()
+        initialize_test_data()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = 1
+
+    def tearDown(self):
+        """Do at end of every test."""
+
+        db.session.close()
+        db.drop_all()
+
+    def upload(self, contents, filename="usage.csv"):
+        return self.client.post("/upload-usage", data=dict(
+            usage_type="kwh",
+            residence="Home",
+            usage_file=(StringIO(contents), filename)
+            ), follow_redirects=True)
+
+    def daily_kwh(self):
+        logs = ElectricityLog.query.filter(
+            ElectricityLog.start_date >= "2017-03-01").order_by(
+            ElectricityLog.start_date).all()
+        return [(log.start_date.day, log.kwh) for log in logs]
+
+    def test_upload_csv(self):
+        resp = self.upload(USAGE_CSV)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(self.daily_kwh(), [(1, 10), (2, 12)])
+        self.assertEqual(DailyCO2Rollup.check_consistency(), [])
+
+    def test_reupload_is_idempotent(self):
+        self.upload(USAGE_CSV)
+        self.upload(USAGE_CSV.replace("4.5", "6.5"))
+        self.assertEqual(self.daily_kwh(), [(1, 12), (2, 12)])
+        self.assertEqual(ElectricityLog.query.count(), 4)
+
+    def test_split_days_are_totalled(self):
+        # the intervals of March 1st are on both sides of March 2nd
+        lines = USAGE_CSV.splitlines()
+        unsorted_csv = "\n".join(lines[:5] + [lines[6], lines[5]] + lines[7:])
+
+        for upload in range(2):
+            self.upload(unsorted_csv)
+            self.assertEqual(self.daily_kwh(), [(1, 10), (2, 12)])
+            self.assertEqual(ElectricityLog.query.count(), 4)
+            self.assertEqual(DailyCO2Rollup.check_consistency(), [])
+
+    def test_days_are_streamed(self):
+        intervals = [("2017-03-01", 4.5), ("2017-03-02", 12),
+                     ("not a date", 1), ("2017-03-01", 5.5)]
+
+        # every run of a day is written as it is read, in chunks of one
+        groups = group_usage_per_day(iter(intervals))
+        self.assertEqual(next(groups), (date(2017, 3, 1), 4.5))
+
+        for upload in range(2):
+            loader = load_daily_usage("kwh", 1, intervals, chunk_size=1)
+            db.session.commit()
+            self.assertEqual((loader.loaded, loader.rejected), (3, 1))
+            self.assertEqual(self.daily_kwh(), [(1, 10), (2, 12)])
+            self.assertEqual(DailyCO2Rollup.check_consistency(), [])
+
+    def test_upload_green_button(self):
+        self.upload(GREEN_BUTTON_XML, "usage.xml")
+        self.assertEqual(self.daily_kwh(), [(1, 1.5), (2, 2.5)])
+
+    def test_read_green_button(self):
+        readings = list(read_green_button(StringIO(GREEN_BUTTON_XML)))
+        self.assertEqual(readings, [(date(2017, 3, 1), 1.5),
+                                    (date(2017, 3, 2), 2.5)])
+
+
+
+TRIPS_CSV = """date,usercar_id,miles,origin,destination,roundtrip
+2017-03-01,1,10,,,
+03/02/2017,2,,"San Francisco, CA","Oakland, CA",yes
+2017-03-03,,,"san francisco,CA","oakland,  ca",
+2017-03-04,1,,San Francisco CA,Honolulu HI,
+2017-03-05,3,5,,,
+not a date,1,5,,,
+2017-03-06,1,,,,
+"""
+
+
+class TripImportTest(TestCase):
+    """Test the bulk trip import."""
+
+    def setUp(self):
+        tc = app.test_client()
+        self.client = tc
+        app.config['TESTING'] = True
+        app.config['SECRET_KEY'] = 'ABC'
+        connect_to_db(app, "postgresql:///test_carbon_calc")
+
+        # Create tables and add sample data
+        db.create_all()
+        initialize_test_data()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = 1
+
+        self.cache_dir = tempfile.mkdtemp()
+        self.provider = FixtureDistanceProvider(
+            {("San Francisco, CA", "Oakland, CA"): 19312})
+        self.resolver = server.distance_resolver
+        server.distance_resolver = DistanceResolver(
+            self.provider,
+            DiskCache("test_trip_distances",
+                      os.path.join(self.cache_dir, "cache.sqlite")))
+
+    def tearDown(self):
+        """Do at end of every test."""
+
+        server.distance_resolver = self.resolver
+        shutil.rmtree(self.cache_dir)
+        db.session.close()
+        db.drop_all()
+
+    def imported_trips(self):
+        trips = TripLog.query.filter(TripLog.date >= "2017-03-01").order_by(
+            TripLog.date).all()
+        return [(trip.date.day, trip.usercar_id, trip.miles) for trip in trips]
+
+    def test_import_csv(self):
+        resp = self.client.post("/import-trips", data=dict(
+            trip_file=(StringIO(TRIPS_CSV), "trips.csv")))
+        result = json.loads(resp.data)
+
+        self.assertEqual(result["imported"], 3)
+        self.assertEqual(result["rejected"], 4)
+        self.assertEqual([error.split(":")[0] for error in result["errors"]],
+                         ["row 4", "row 5", "row 6", "row 7"])
+        self.assertEqual(self.imported_trips(),
+                         [(1, 1, 10), (2, 2, 24.0), (3, 1, 12.0)])
+
+        # the same route typed twice is only looked up once
+        self.assertEqual(self.provider.requests, 2)
+        self.assertEqual(DailyCO2Rollup.check_consistency(), [])
+
+    def test_import_json(self):
+        resp = self.client.post("/import-trips", data=json.dumps({"trips": [
+            {"date": "2017-03-01", "miles": 4.5, "roundtrip": True},
+            {"date": "2017-03-02", "usercar_id": 2, "miles": "-1"},
+            "not a trip"]}), content_type="application/json")
+        result = json.loads(resp.data)
+
+        self.assertEqual((result["imported"], result["rejected"]), (1, 2))
+        self.assertEqual(self.imported_trips(), [(1, 1, 9.0)])
+
+        resp = self.client.post("/import-trips", data="{not json",
+                                content_type="application/json")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_logged_out(self):
+        with self.client.session_transaction() as sess:
+            del sess['user_id']
+
+        resp = self.client.post("/import-trips", data="[]",
+                                content_type="application/json")
+        self.assertEqual(resp.status_code, 401)
+
+
+class QueryBudgetTest(TestCase):
+    """Test that every route and every CO2 aggregate stays within its query
+    budget on a year and a half of daily logs, where a query per log would
+    blow through any of them."""
+
+    HISTORY_DAYS = 500
+
+    # (method, url, data, budget) of the routes that only read
+    READ_BUDGETS = [
+        ("GET", "/", None, 10),
+        ("GET", "/profile", None, 4),
+        ("GET", "/cars/makes.json", None, 1),
+        ("GET", "/car-data?make=Toyota&model=Prius", None, 1),
+        ("GET", "/cars/catalog.json?make=Toyota", None, 1),
+        ("GET", "/kwh-log", None, 7),
+        ("GET", "/kwh-log.json?year=2016", None, 2),
+        ("GET", "/ng-log", None, 7),
+        ("GET", "/ng-log.json", None, 2),
+        ("GET", "/trip-log", None, 11),
+        ("GET", "/trip-log.json?usercar_id=2", None, 5),
+        ("GET", "/get-distance?origin=San Francisco, CA&destination=Oakland, CA",
+         None, 0),
+        ("GET", "/get-zipcode?city=San Francisco&state=CA", None, 0),
+        ("GET", "/zipcodes.json?city=San Francisco&state=CA", None, 0),
+        ("GET", "/year-comparison-json", None, 8),
+        ("GET", "/co2-per-datatype.json?year=2016", None, 8),
+        ("GET", "/co2-trend.json?year=2016", None, 8),
+        ("GET", "/co2-day-of-week.json?year=2016", None, 7),
+        ("GET", "/dashboard.json?year=2016", None, 7),
+        ("GET", "/co2-other-location.json?year=2016&zipcode=94133", None, 4),
+        ("GET", "/co2-all-locations.json?year=2016", None, 5),
+        ("GET", "/co2-other-car.json?tripYear=2016&userCarId=2&make=Toyota"
+         "&model=Prius&carYear=2004&cylinders=&transmission=", None, 7),
+        ("POST", "/co2-other-cars.json", json.dumps(
+            {"tripYear": 2016,
+             "candidates": [{"make": "Toyota", "model": "Prius",
+                             "year": 2004}]}), 6),
+        ("GET", "/cars/recommendations.json?tripYear=2016", None, 7),
+        ]
+
+    # (method, url, form, budget) of the routes that change data
+    WRITE_BUDGETS = [
+        ("POST", "/add-kwh", {"start_date": "2017-03-01",
+                              "end_date": "2017-03-31", "kwh": 100,
+                              "residence": "Home"}, 16),
+        ("POST", "/edit-kwh", {"elect_id": 2, "start_date": "2017-02-15",
+                               "end_date": "2017-03-15", "kwh": 70,
+                               "residence": "Home"}, 16),
+        ("POST", "/add-ng", {"start_date": "2017-03-01",
+                             "end_date": "2017-03-31", "therms": 5,
+                             "residence": "Home"}, 16),
+        ("POST", "/edit-ng", {"ng_id": 1, "start_date": "2017-01-01",
+                              "end_date": "2017-01-31", "therms": 9,
+                              "residence": "Home"}, 16),
+        ("POST", "/add-trip", {"date": "2017-03-02", "miles": 20, "car": 1},
+         16),
+        ("POST", "/edit-trip", {"trip_id": 1, "date": "2017-03-05",
+                                "miles": 50, "car": 2}, 16),
+        ("POST", "/upload-usage", lambda: {
+            "usage_type": "kwh", "residence": "Home",
+            "usage_file": (StringIO(USAGE_CSV), "usage.csv")}, 16),
+        ("POST", "/import-trips", lambda: {
+            "trip_file": (StringIO(TRIPS_CSV), "trips.csv")}, 16),
+        ("POST", "/add-residence", {"residence_name": "Treehouse",
+                                    "zipcode": 94133, "residents": 2,
+                                    "default": True}, 6),
+        ("POST", "/edit-residence", {"residence_id": 2,
+                                     "residence_name": "Beach House",
+                                     "zipcode": 94133, "residents": 3}, 6),
+        ("POST", "/add-car", {"make": "Toyota", "model": "Prius",
+                              "year": 2004, "cylinders": "",
+                              "transmission": ""}, 6),
+        ("GET", "/logout", None, 0),
+        ("POST", "/process-signup", {"email": "dog@email.com",
+                                     "password": "password",
+                                     "name": "Fido"}, 3),
+        ("POST", "/process-login", {"email": "dog@email.com",
+                                    "password": "password"}, 2),
+        ]
+
+    # (label, calculation, budget) of the aggregates
+    AGGREGATE_BUDGETS = [
+        ("TripLog.sum_trip_co2", lambda: TripLog.sum_trip_co2(1), 5),
+        ("TripLog.sum_trip_co2 per car",
+         lambda: TripLog.sum_trip_co2(1, "1/1/2016", "12/31/2016", 2), 4),
+        ("TripLog.sum_trip_co2 from logs",
+         lambda: TripLog.sum_trip_co2(1, from_timeline=False), 4),
+        ("TripLog.sum_trip_co2_per_month",
+         lambda: TripLog.sum_trip_co2_per_month(1, 2016), 4),
+        ("TripLog.get_co2_per_yr", lambda: TripLog.get_co2_per_yr(1), 4),
+        ("TripLog.sum_trip_co2_other_car",
+         lambda: TripLog.sum_trip_co2_other_car(1, "Toyota", "Prius", 2004,
+                                                None, None), 2),
+        ("TripLog.get_trip_years", lambda: TripLog.get_trip_years(1), 1),
+        ("TripLog.calculate_total_co2_per_day_of_week",
+         lambda: TripLog.calculate_total_co2_per_day_of_week(1), 4),
+        ("TripLog.get_trip_summary", lambda: TripLog.get_trip_summary(1), 6),
+        ("TripLog.get_monthly_miles", lambda: TripLog.get_monthly_miles(1), 2),
+        ("TripLog.get_page",
+         lambda: [trip.usercar.usercar_id for trip in TripLog.get_page(1)[0]],
+         1),
+        ("UserCar.get_avg_grams_co2_mile_factors",
+         lambda: UserCar.get_avg_grams_co2_mile_factors(1), 3),
+        ("ElectricityLog.sum_kwh_co2",
+         lambda: ElectricityLog.sum_kwh_co2(1), 2),
+        ("ElectricityLog.sum_kwh_co2 from logs",
+         lambda: ElectricityLog.sum_kwh_co2(1, from_timeline=False), 1),
+        ("ElectricityLog.sum_kwh_co2_per_month",
+         lambda: ElectricityLog.sum_kwh_co2_per_month(1, 2016), 1),
+        ("ElectricityLog.sum_kwh_per_month",
+         lambda: ElectricityLog.sum_kwh_per_month(1, 2016), 1),
+        ("ElectricityLog.get_co2_per_yr",
+         lambda: ElectricityLog.get_co2_per_yr(1), 1),
+        ("ElectricityLog.sum_kwh_co2_other_location",
+         lambda: ElectricityLog.sum_kwh_co2_other_location(1, "94133"), 2),
+        ("ElectricityLog.get_kwh_years",
+         lambda: ElectricityLog.get_kwh_years(1), 1),
+        ("ElectricityLog.calculate_total_co2_per_day_of_week",
+         lambda: ElectricityLog.calculate_total_co2_per_day_of_week(1), 1),
+        ("ElectricityLog.get_electricity_summary",
+         lambda: ElectricityLog.get_electricity_summary(1), 3),
+        ("ElectricityLog.get_page",
+         lambda: [log.co2_calc() for log in ElectricityLog.get_page(1)[0]],
+         1),
+        ("NGLog.sum_ng_co2", lambda: NGLog.sum_ng_co2(1), 2),
+        ("NGLog.sum_ng_co2 from logs",
+         lambda: NGLog.sum_ng_co2(1, from_timeline=False), 1),
+        ("NGLog.sum_ng_co2_per_month",
+         lambda: NGLog.sum_ng_co2_per_month(1, 2016), 1),
+        ("NGLog.get_co2_per_yr", lambda: NGLog.get_co2_per_yr(1), 1),
+        ("NGLog.get_ng_years", lambda: NGLog.get_ng_years(1), 1),
+        ("NGLog.get_ng_summary", lambda: NGLog.get_ng_summary(1), 3),
+        ("NGLog.get_page",
+         lambda: [log.co2_calc() for log in NGLog.get_page(1)[0]], 1),
+        ("DailyCO2Rollup.sum_co2",
+         lambda: DailyCO2Rollup.sum_co2(1, "trip"), 1),
+        ("DailyCO2Rollup.sum_co2_per_yr",
+         lambda: DailyCO2Rollup.sum_co2_per_yr(1, "kwh"), 1),
+        ("Region.get_factors", lambda: Region.get_factors(), 1),
+        ]
+
+    def setUp(self):
+        self.client = app.test_client()
+        app.config['TESTING'] = True
+        app.config['SECRET_KEY'] = 'ABC'
+        connect_to_db(app, "postgresql:///test_carbon_calc")
+
+        # Create tables and add sample data
+        db.create_all()
+        initialize_test_data()
+        add_history(self.HISTORY_DAYS)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = 1
+
+        self.resolver = server.distance_resolver
+        server.distance_resolver = DistanceResolver(
+            FixtureDistanceProvider(
+                {("San Francisco, CA", "Oakland, CA"): 19312}),
+            LRUCache("test_budget_distances", 10))
+
+        # the catalog and grid factors are loaded once per process
+        Car.get_catalog()
+        Car.get_emissions_index()
+        Zipcode.get_lb_co2e_mega_wh("94133")
+
+    def tearDown(self):
+        """Do at end of every test."""
+
+        server.distance_resolver = self.resolver
+        db.session.close()
+        db.drop_all()
+
+    def request(self, method, url, data):
+        if callable(data):
+            data = data()
+
+        if method == "GET":
+            return self.client.get(url)
+        elif isinstance(data, basestring):
+            return self.client.post(url, data=data,
+                                    content_type="application/json")
+        else:
+            return self.client.post(url, data=data)
+
+    def test_read_budgets(self):
+        for method, url, data, budget in self.READ_BUDGETS:
+            with QueryBudget(budget, "%s %s" % (method, url), cold=True):
+                resp = self.request(method, url, data)
+            self.assertEqual(resp.status_code, 200, url)
+
+    def test_write_budgets(self):
+        # the test user was added with its id, so move the id sequence past it
+        db.session.execute("SELECT setval('users_user_id_seq', "
+                           "(SELECT MAX(user_id) FROM users))")
+
+        for method, url, data, budget in self.WRITE_BUDGETS:
+            with QueryBudget(budget, "%s %s" % (method, url), cold=True):
+                resp = self.request(method, url, data)
+            self.assertLess(resp.status_code, 400, url)
+
+    def test_aggregate_budgets(self):
+        for label, calculate, budget in self.AGGREGATE_BUDGETS:
+            with QueryBudget(budget, label, cold=True):
+                calculate()
+
+    @QueryBudget(12)
+    def test_summary_budget(self):
+        # the three log pages' summaries together
+        TripLog.get_trip_summary(1)
+        ElectricityLog.get_electricity_summary(1)
+        NGLog.get_ng_summary(1)
+
+    def test_budget_failure(self):
+        with self.assertRaises(AssertionError) as failure:
+            with QueryBudget(1, "trip summary", cold=True):
+                TripLog.get_trip_summary(1)
+
+        self.assertIn("trip summary took", str(failure.exception))
+        self.assertIn("FROM trip_log", str(failure.exception))
+
+
+class RequestProfilerTest(TestCase):
+    """Test the opt-in request profiles."""
+
+    def setUp(self):
+        self.client = app.test_client()
+        app.config['TESTING'] = True
+        app.config['SECRET_KEY'] = 'ABC'
+        connect_to_db(app, "postgresql:///test_carbon_calc")
+
+        # Create tables and add sample data
+        db.create_all()
+        initialize_test_data()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = 1
+
+        self.profile_dir = tempfile.mkdtemp()
+        self.profiler = server.request_profiler
+        server.request_profiler = RequestProfiler(
+            os.path.join(self.profile_dir, "profiles"), token="secret",
+            keep=3)
+
+    def tearDown(self):
+        """Do at end of every test."""
+
+        server.request_profiler = self.profiler
+        app.config["ADMIN_USER_IDS"] = set()
+        shutil.rmtree(self.profile_dir)
+        db.session.close()
+        db.drop_all()
+
+    def test_off_by_default(self):
+        resp = self.client.get("/dashboard.json?year=2017")
+        self.assertNotIn("X-Profile-Capture", resp.headers)
+        resp = self.client.get("/dashboard.json?year=2017",
+                               headers={"X-Profile": "guess"})
+        self.assertNotIn("X-Profile-Capture", resp.headers)
+        self.assertEqual(server.request_profiler.get_names(), [])
+
+        # a profiler without a token ignores the header
+        server.request_profiler.token = None
+        self.assertFalse(server.request_profiler.should_profile(None))
+        self.assertFalse(server.request_profiler.should_profile(""))
+
+    def test_capture(self):
+        resp = self.client.get("/dashboard.json?year=2017",
+                               headers={"X-Profile": "secret"})
+        name = resp.headers["X-Profile-Capture"]
+        self.assertIn("_get_dashboard_data_u1_", name)
+        self.assertEqual(server.request_profiler.get_names(), [name])
+
+        capture = server.request_profiler.get_captures()[0]
+        self.assertEqual((capture["route"], capture["user_id"]),
+                         ("get_dashboard_data", "1"))
+        self.assertIn("get_dashboard_data", " ".join(
+            function["function"] for function in capture["functions"]))
+
+        # sampled requests, only the newest are kept
+        server.request_profiler.sample_rate = 1
+        for year in [2014, 2015, 2016]:
+            self.client.get("/co2-trend.json?year=%s" % year)
+        self.assertEqual(len(server.request_profiler.get_names()), 3)
+        self.assertNotIn(name, server.request_profiler.get_names())
+
+    def test_admin_page(self):
+        resp = self.client.get("/dashboard.json?year=2017",
+                               headers={"X-Profile": "secret"})
+        name = resp.headers["X-Profile-Capture"]
+
+        self.assertEqual(self.client.get("/request-profiles").status_code, 404)
+        self.assertEqual(self.client.get("/request-profiles/" + name)
+                         .status_code, 404)
+
+        app.config["ADMIN_USER_IDS"] = set([1])
+        resp = self.client.get("/request-profiles")
+        self.assertIn("get_dashboard_data", resp.data)
+        self.assertIn("1 captured of 4 requests", resp.data)
+
+        resp = self.client.get("/request-profiles/" + name)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.client.get("/request-profiles/nothing.prof")
+                         .status_code, 404)
+
+    def test_failed_request(self):
+        with self.assertRaises(ValueError):
+            self.client.get("/co2-other-car.json?tripYear=year",
+                            headers={"X-Profile": "secret"})
+
+        # the profile was stopped, not left running on the thread
+        self.assertIsNone(sys.getprofile())
+
+    def test_overhead(self):
+        profiler = RequestProfiler(self.profile_dir)
+        for _ in range(10000):
+            profiler.should_profile(None)
+
+        overhead = profiler.get_overhead()
+        self.assertEqual((overhead["checks"], overhead["captures"]),
+                         (10000, 0))
+        self.assertLess(overhead["avg_check_us"], 50)
+
+
+class MetricsTest(TestCase):
+    """Test the Prometheus metrics."""
+
+    def setUp(self):
+        self.client = app.test_client()
+        app.config['TESTING'] = True
+        app.config['SECRET_KEY'] = 'ABC'
+        connect_to_db(app, "postgresql:///test_carbon_calc")
+
+        # Create tables and add sample data
+        db.create_all()
+        initialize_test_data()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = 1
+
+        metrics.reset()
+        request_stats.reset_route_stats()
+
+    def tearDown(self):
+        """Do at end of every test."""
+
+        db.session.close()
+        db.drop_all()
+
+    def get_samples(self):
+        resp = self.client.get("/metrics")
+        self.assertEqual(resp.headers["Content-Type"], metrics.CONTENT_TYPE)
+
+        samples = {}
+        for line in resp.data.splitlines():
+            if not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                samples[name] = float(value)
+
+        return samples
+
+    def test_metrics(self):
+        self.client.get("/dashboard.json?year=2017")
+        self.client.get("/dashboard.json?year=2016")
+        self.client.get("/nothing-here")
+        with self.assertRaises(ValueError):
+            self.client.get("/co2-other-car.json?tripYear=year")
+
+        samples = self.get_samples()
+        self.assertEqual(samples['carbon_calc_requests_total{route='
+                                 '"get_dashboard_data",method="GET",'
+                                 'status="200"}'], 2)
+        self.assertEqual(samples['carbon_calc_requests_total{route='
+                                 '"not_found",method="GET",status="404"}'], 1)
+        self.assertEqual(samples['carbon_calc_request_errors_total{route='
+                                 '"get_co2_other_car"}'], 1)
+        self.assertEqual(samples['carbon_calc_request_duration_seconds_bucket'
+                                 '{route="get_dashboard_data",le="+Inf"}'], 2)
+        self.assertEqual(samples['carbon_calc_request_duration_seconds_count'
+                                 '{route="get_dashboard_data"}'], 2)
+        self.assertGreater(samples['carbon_calc_request_duration_seconds_sum'
+                                   '{route="get_dashboard_data"}'], 0)
+        # the failed request is timed too
+        self.assertEqual(samples['carbon_calc_request_duration_seconds_count'
+                                 '{route="get_co2_other_car"}'], 1)
+
+        # the histogram is the route totals of the request log
+        route_stats = dict((route["route"], route) for route
+                           in request_stats.get_route_stats())
+        self.assertEqual(route_stats["get_dashboard_data"]["requests"], 2)
+
+        self.assertGreater(samples["carbon_calc_db_pool_checkouts_total"], 0)
+        self.assertIn("carbon_calc_db_pool_checked_out", samples)
+        self.assertGreaterEqual(samples["carbon_calc_db_pool_overflow"], 0)
+        self.assertGreater(samples['carbon_calc_cache_misses_total{cache='
+                                   '"co2_timelines"}'], 0)
+
+        # the scrape itself is counted by the next one
+        self.assertEqual(self.get_samples()['carbon_calc_requests_total{route='
+                                            '"get_metrics",method="GET",'
+                                            'status="200"}'], 1)
+
+    def test_thread_counts(self):
+        def handle_requests():
+            for status in [200, 200, 404]:
+                metrics.observe_request("index", "GET", status)
+
+        threads = [threading.Thread(target=handle_requests)
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        totals = metrics.collect()
+        self.assertEqual(totals.requests, {("index", "GET", 200): 8,
+                                           ("index", "GET", 404): 4})
+
+        # the finished threads were folded into one total
+        self.assertNotIn(threads[0], [thread_metrics.thread for thread_metrics
+                                      in metrics._threads])
+        self.assertEqual(metrics.collect().requests,
+                         {("index", "GET", 200): 8,
+                          ("index", "GET", 404): 4})
+
+    def test_scrape_time(self):
+        for route in range(50):
+            stats = request_stats.RequestStats()
+            stats.seconds = route / 100.0
+            for status in [200, 302, 404, 500]:
+                metrics.observe_request("route_%s" % route, "GET", status)
+                request_stats.add_route_request("route_%s" % route, stats)
+
+        start = time.time()
+        text = metrics.render(db.engine.pool, get_cache_stats(),
+                              request_stats.get_route_latencies())
+        self.assertLess(time.time() - start, 0.05)
+        self.assertIn('le="0.5"} 4', text)
+
+
+class SyntheticDataTest(TestCase):
+    """Test the synthetic data generator and the benchmark."""
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SECRET_KEY'] = 'ABC'
+        connect_to_db(app, "postgresql:///test_carbon_calc")
+
+        # Create tables and add sample data
+        db.create_all()
+        initialize_test_data()
+
+        # the test user was added with its id, so move the id sequence past it
+        db.session.execute("SELECT setval('users_user_id_seq', "
+                           "(SELECT MAX(user_id) FROM users))")
+
+    def tearDown(self):
+        """Do at end of every test."""
+
+        db.session.close()
+        db.drop_all()
+
+    def get_kwh(self, user_ids):
+        return sorted(kwh for kwh, in db.session.query(ElectricityLog.kwh)
+                      .join(Residence).filter(Residence.user_id.in_(user_ids))
+                      .order_by(ElectricityLog.start_date))
+
+    def test_generate(self):
+        counts = synthetic_data.generate(2, 0.25)
+
+        self.assertEqual(counts["users"], 2)
+        self.assertEqual(User.query.count(), 3)
+        self.assertEqual(counts["electricity_log"], counts["residences"] * 91)
+        self.assertEqual(counts["ng_log"], counts["residences"] * 91)
+        self.assertGreater(counts["trip_log"], 2 * 50)
+        self.assertEqual(DailyCO2Rollup.check_consistency(), [])
+
+        # every weekday trip is a commute in the user's default car
+        for user_id in [2, 3]:
+            default_car = UserCar.query.filter_by(user_id=user_id,
+                                                  is_default=True).one()
+            trips = TripLog.query.filter_by(user_id=user_id).all()
+            weekday_trips = [trip for trip in trips
+                             if trip.date.weekday() < 5]
+
+            self.assertGreater(len(weekday_trips), len(trips) / 2)
+            self.assertEqual(set(trip.usercar_id for trip in weekday_trips),
+                             set([default_car.usercar_id]))
+            self.assertEqual(max(trip.date for trip in trips),
+                             synthetic_data.END_DAY)
+
+        # the same seed makes the same data again
+        synthetic_data.generate(2, 0.25)
+        self.assertEqual(self.get_kwh([2, 3]), self.get_kwh([4, 5]))
+
+    def test_generated_cars(self):
+        cars = list(synthetic_data.generate_cars())
+
+        self.assertEqual(len(cars), sum(len(models) for make, models
+                                        in synthetic_data.CATALOG_MODELS) *
+                         len(synthetic_data.CATALOG_YEARS) *
+                         len(synthetic_data.CATALOG_VARIANTS))
+        self.assertEqual(len(set(car[0] for car in cars)), len(cars))
+
+        prius = [car for car in cars if car[2] == "Prius" and car[4] == 2004]
+        tesla = [car for car in cars if car[1] == "Tesla"]
+        self.assertAlmostEqual(prius[0][12], 8887 / 52.0, 1)
+        self.assertEqual(set(car[12] for car in tesla), set([0.0]))
+
+    def test_benchmark(self):
+        report = benchmark.run(app, [1], repeat=1, years=0.1)
+
+        results = report["scales"][0]
+        self.assertEqual(results["rows"]["users"],
+                         benchmark.USERS_PER_SCALE)
+        # every route but the admin pages and static files
+        self.assertEqual(
+            set(label.split()[1] for label in results["routes"]),
+            set(rule.rule for rule in app.url_map.iter_rules()
+                if rule.endpoint not in ["static", "list_profiles",
+                                         "download_profile", "get_metrics"]))
+        for label, result in results["routes"].items():
+            self.assertLess(result["status"], 400, label)
+            self.assertGreater(result["cold_ms"], 0)
+
+        region_factors = results["aggregates"]["Region.get_factors"]
+        self.assertEqual(region_factors["queries"], 1)
+        self.assertEqual(region_factors["status"], "ok")
+
+        # the report compares with itself without regressions
+        markdown = benchmark.write_markdown(report, report)
+        self.assertIn("| GET /dashboard.json |", markdown)
+        self.assertIn("1x change", markdown)
+        self.assertNotIn("**", markdown)
+
+        baseline = json.loads(json.dumps(report))
+        routes = baseline["scales"][0]["routes"]
+        routes["GET /dashboard.json"]["queries"] -= 1
+        routes["GET /trip-log"]["cold_ms"] = \
+            results["routes"]["GET /trip-log"]["cold_ms"] / 2 - 1
+
+        markdown = benchmark.write_markdown(report, baseline)
+        self.assertIn("| **+0%, +1 queries** |", markdown)
+        self.assertEqual(markdown.count("**"), 4)
+
 # /add-car
 # /add-kwh
 # TODO: /add-ng
@@ -0,0 +1,205 @@
+"""Bulk import of trips.
+
+Reads a CSV or JSON batch of a user's trips. Each trip has a date and either
+its miles or an origin and destination to look the driving distance up for.
+The distinct origin/destination pairs are resolved concurrently by a bounded
+pool of worker threads, and the trips are then inserted in chunks in the
+session's transaction. Rows that can't be imported are skipped and reported
+with their row number rather than failing the batch.
+
+    python trip_import.py USER_ID FILE [--workers 8]
+
+CSV columns (JSON batches are a list of objects with the same keys):
+
+    date,usercar_id,miles,origin,destination,roundtrip,number_of_passengers
+"""
+
+import argparse
+import csv
+import json
+from multiprocessing.pool import ThreadPool
+from bulk_load import BulkLoader, blank_to_none
+from distance import DistanceError
+from interval_data import parse_day
+from model import db, User, UserCar, TripLog, DailyCO2Rollup, \
+    expire_co2_timelines
+
+# distance lookups that run at the same time
+DISTANCE_WORKERS = 8
+
+# most row errors reported back for a batch
+MAX_ERRORS = 100
+
+TRUE_VALUES = set(["1", "true", "yes", "y", "on"])
+
+
+def read_trip_rows(trip_file, filename=""):
+    """Read the trips of a CSV or JSON batch as a list of dictionaries. A JSON
+    batch is a list of trips or an object with a "trips" list."""
+
+    if filename.lower().endswith(".json"):
+        return read_trip_json(trip_file.read())
+
+    return list(csv.DictReader(trip_file))
+
+
+def read_trip_json(data):
+    """Read the trips of a JSON batch, already decoded or not."""
+
+    if isinstance(data, basestring):
+        data = json.loads(data)
+
+    if isinstance(data, dict):
+        data = data.get("trips")
+
+    if not isinstance(data, list):
+        raise ValueError("expected a list of trips")
+
+    return data
+
+
+def get_field(row, name):
+    """Get a field of a trip as a stripped string, None if it is blank."""
+
+    value = row.get(name) if isinstance(row, dict) else None
+
+    if value is None:
+        return None
+
+    if isinstance(value, str):
+        value = value.decode("utf-8", "replace")
+
+    return blank_to_none(unicode(value), lambda value: value.strip())
+
+
+def is_true(value):
+    """Read a CSV or JSON flag like roundtrip."""
+
+    return value is not None and value.lower() in TRUE_VALUES
+
+
+def get_route(row):
+    """Get the (origin, destination) of a trip that has no miles, None if the
+    trip has its miles."""
+
+    if get_field(row, "miles") is not None:
+        return None
+
+    origin = get_field(row, "origin")
+    destination = get_field(row, "destination")
+
+    if origin is None or destination is None:
+        return None
+
+    return origin, destination
+
+
+def resolve_distances(routes, resolver, workers=DISTANCE_WORKERS):
+    """Look up the miles of distinct (origin, destination) routes with at most
+    workers lookups at a time. Returns {route: miles or DistanceError}."""
+
+    routes = list(set(routes))
+
+    if not routes:
+        return {}
+
+    def lookup(route):
+        try:
+            return resolver.get_miles(*route)
+        except DistanceError as e:
+            return e
+
+    pool = ThreadPool(min(workers, len(routes)))
+    try:
+        miles = pool.map(lookup, routes)
+    finally:
+        pool.close()
+        pool.join()
+
+    return dict(zip(routes, miles))
+
+
+def import_trips(user_id, rows, resolver, workers=DISTANCE_WORKERS,
+                 chunk_size=1000):
+    """Import a batch of trip dictionaries for a user. Trips without a car
+    are logged for the user's default car. The changes are left in the session
+    to be committed. Returns the BulkLoader, whose errors list the rows that
+    were skipped."""
+
+    usercars = UserCar.query.filter_by(user_id=user_id).all()
+    usercar_ids = set(usercar.usercar_id for usercar in usercars)
+    default_usercar_ids = [usercar.usercar_id for usercar in usercars
+                           if usercar.is_default]
+
+    distances = resolve_distances(
+        [route for route in (get_route(row) for row in rows) if route],
+        resolver, workers)
+
+    days = set()
+
+    def trip_values(row):
+        if not isinstance(row, dict):
+            raise ValueError("expected a trip, got %r" % (row,))
+
+        day = parse_day(get_field(row, "date") or "")
+
+        usercar_id = blank_to_none(get_field(row, "usercar_id"), int)
+        if usercar_id is None and default_usercar_ids:
+            usercar_id = default_usercar_ids[0]
+        if usercar_id not in usercar_ids:
+            raise ValueError("unknown car %s" % usercar_id)
+
+        route = get_route(row)
+        if route:
+            miles = distances[route]
+            if isinstance(miles, DistanceError):
+                raise ValueError(miles)
+        elif get_field(row, "miles") is not None:
+            miles = float(get_field(row, "miles"))
+        else:
+            raise ValueError("needs miles or an origin and destination")
+
+        if miles < 0:
+            raise ValueError("negative miles %s" % miles)
+
+        if is_true(get_field(row, "roundtrip")):
+            miles = miles * 2
+
+        number_of_passengers = blank_to_none(
+            get_field(row, "number_of_passengers"), int) or 1
+
+        days.add(day)
+        return user_id, usercar_id, 1, day, miles, number_of_passengers
+
+    loader = BulkLoader(TripLog.__table__,
+                        ["user_id", "usercar_id", "transportation_type", "date",
+                         "miles", "number_of_passengers"],
+                        chunk_size=chunk_size, max_errors=MAX_ERRORS)
+    loader.load(rows, trip_values)
+
+    # Recalculate the user's daily CO2 of the new trips' days in the same
+    # transaction
+    if loader.loaded:
+        DailyCO2Rollup.update_range(user_id, min(days), max(days), ["trip"])
+        expire_co2_timelines(user_id)
+        User.bump_data_version(user_id)
+
+    return loader
+
+
+if __name__ == "__main__":
+    from model import connect_to_db
+    from server import app, distance_resolver
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("user_id", type=int)
+    parser.add_argument("file")
+    parser.add_argument("--workers", type=int, default=DISTANCE_WORKERS)
+    args = parser.parse_args()
+
+    connect_to_db(app)
+
+    with open(args.file) as trip_file:
+        import_trips(args.user_id, read_trip_rows(trip_file, args.file),
+                     distance_resolver, args.workers)
+    db.session.commit()
@@ -0,0 +1,212 @@
+"""City and state to zipcode lookups for comparing locations.
+
+Zipcodes come from an index built from the bundled city list
+(seed-data/city-zipcodes.csv, from the MIT licensed zipcodes project data)
+and the bundled zipcode grid regions, so a lookup is a dictionary access
+instead of a call to zipcodeapi.com. Cities that aren't in the index can fall
+back to zipcodeapi, with the answers kept in an on-disk cache.
+
+    ZIP_CODE_API_KEY=... ZIPCODE_CACHE=zipcode-cache.sqlite
+"""
+
+import csv
+import os
+import requests
+from cache import DiskCache, LazyIndex, SingleFlight
+
+CITY_ZIPCODES_FILE = "seed-data/city-zipcodes.csv"
+ZIPCODE_REGIONS_FILE = "seed-data/zipcode-regions.csv"
+
+ZIPCODE_API_URL = "https://www.zipcodeapi.com/rest/{api_key}/city-zips.json/" \
+    "{city}/{state}"
+
+# seconds to connect and to wait for the response
+TIMEOUT = (3.05, 10)
+
+# abbreviations that people type for the first word of a city
+CITY_ABBREVIATIONS = {"st": "saint", "ste": "sainte", "ft": "fort",
+                      "mt": "mount"}
+
+
+class ZipcodeError(Exception):
+    """No zipcode could be found for a city."""
+
+
+def normalize_city(city):
+    """Lower case a city, drop its punctuation and spell out a leading St, Ft
+    or Mt, so "St. Louis" and "Saint Louis" are the same city."""
+
+    words = (city or "").lower().replace(".", " ").replace("'", "").split()
+
+    if words and words[0] in CITY_ABBREVIATIONS:
+        words[0] = CITY_ABBREVIATIONS[words[0]]
+
+    return " ".join(words)
+
+
+def get_city_key(city, state):
+    """Index and cache key of a city."""
+
+    return "%s|%s" % (normalize_city(city), (state or "").strip().upper())
+
+
+class CityZipcodeIndex(object):
+    """The zipcodes of every city, best first, and the grid region of every
+    zipcode. Zipcodes are stored once as shared strings and each city holds a
+    tuple of them, which keeps the ~40k zipcodes to a few MB."""
+
+    def __init__(self, city_zipcodes, zipcode_regions):
+        self.regions = {}
+        self.zipcodes = {}
+
+        for zipcode, region_id in zipcode_regions:
+            self.regions[intern(zipcode)] = intern(region_id)
+
+        city_lists = {}
+        for zipcode, city, state in city_zipcodes:
+            zipcodes = city_lists.setdefault(get_city_key(city, state), [])
+            if zipcode not in zipcodes:
+                zipcodes.append(intern(zipcode))
+
+        for key, zipcodes in city_lists.items():
+            self.zipcodes[key] = tuple(zipcodes)
+
+    def __repr__(self):
+        return "<CityZipcodeIndex Cities=%s, Zipcodes=%s>" % \
+            (len(self.zipcodes), len(self.regions))
+
+    def __len__(self):
+        return len(self.zipcodes)
+
+    @classmethod
+    def from_files(cls, city_zipcodes_path=CITY_ZIPCODES_FILE,
+                   zipcode_regions_path=ZIPCODE_REGIONS_FILE):
+        """Build the index from the bundled zipcode,city,state and
+        zipcode,state,region,... CSV files."""
+
+        with open(city_zipcodes_path) as city_file, \
+                open(zipcode_regions_path) as regions_file:
+            return cls(csv.reader(city_file),
+                       ((row[0], row[2]) for row in csv.reader(regions_file)
+                        if row[0] and row[2]))
+
+    def get(self, key, default=None):
+        """Get the zipcodes of a city key."""
+
+        return self.zipcodes.get(key, default)
+
+    def get_zipcodes(self, city, state):
+        """Get the zipcodes of a city, best first. Zipcodes that have a grid
+        region come before ones that don't."""
+
+        zipcodes = self.zipcodes.get(get_city_key(city, state), ())
+
+        return [zipcode for zipcode in zipcodes if zipcode in self.regions] + \
+            [zipcode for zipcode in zipcodes if zipcode not in self.regions]
+
+    def get_region_id(self, zipcode):
+        """Get the grid region of a zipcode, None if it has none."""
+
+        return self.regions.get(zipcode)
+
+
+class ZipcodeApiProvider(object):
+    """Looks the zipcodes of a city up with zipcodeapi.com, reusing pooled
+    connections between requests."""
+
+    def __init__(self, api_key=None, timeout=TIMEOUT):
+        self.api_key = api_key
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.requests = 0
+
+    def __repr__(self):
+        return "<ZipcodeApiProvider Requests=%s>" % self.requests
+
+    def get_zipcodes(self, city, state):
+        """Get the zipcodes of a city."""
+
+        url = ZIPCODE_API_URL.format(api_key=self.api_key, city=city,
+                                     state=state)
+
+        self.requests += 1
+
+        try:
+            r = self.session.get(url, timeout=self.timeout)
+            r.raise_for_status()
+            return r.json()["zip_codes"]
+        except (requests.RequestException, ValueError, KeyError) as e:
+            raise ZipcodeError("no zipcodes for %s, %s: %s" % (city, state, e))
+
+
+class ZipcodeResolver(object):
+    """Finds the zipcodes of a city in the local index, and only asks the
+    fallback provider, through an on-disk cache, about cities the index
+    doesn't know."""
+
+    def __init__(self, index, fallback=None, cache=None):
+        self.index = index
+        self.fallback = fallback
+        self.cache = cache
+        self.in_flight = SingleFlight()
+
+    def __repr__(self):
+        return "<ZipcodeResolver Index=%r, Fallback=%r>" % (self.index,
+                                                           self.fallback)
+
+    def get_zipcodes(self, city, state):
+        """Get the zipcodes of a city, best first. Raises ZipcodeError if it
+        has none."""
+
+        zipcodes = self.index.data.get_zipcodes(city, state)
+
+        if zipcodes:
+            self.index.hits += 1
+            return zipcodes
+
+        self.index.misses += 1
+
+        if not self.fallback:
+            raise ZipcodeError("no zipcodes for %s, %s" % (city, state))
+
+        key = get_city_key(city, state)
+
+        def lookup():
+            return self.fallback.get_zipcodes(city, state)
+
+        zipcodes = self.in_flight.do(key, lambda: self.cache.get(key, lookup))
+
+        if not zipcodes:
+            raise ZipcodeError("no zipcodes for %s, %s" % (city, state))
+
+        return zipcodes
+
+    def get_zipcode(self, city, state):
+        """Get the best zipcode of a city."""
+
+        return self.get_zipcodes(city, state)[0]
+
+    def get_candidates(self, city, state):
+        """Get the zipcodes of a city with their grid regions as
+        dictionaries."""
+
+        return [{"zipcode": zipcode,
+                 "region_id": self.index.data.get_region_id(zipcode)}
+                for zipcode in self.get_zipcodes(city, state)]
+
+
+def make_zipcode_resolver():
+    """Set up the resolver from the environment. zipcodeapi is only used as a
+    fallback when ZIP_CODE_API_KEY is set, and ZIPCODE_CACHE sets the file its
+    answers are cached in."""
+
+    index = LazyIndex("city_zipcode_index", CityZipcodeIndex.from_files)
+
+    api_key = os.environ.get("ZIP_CODE_API_KEY")
+    if not api_key:
+        return ZipcodeResolver(index)
+
+    cache = DiskCache("city_zipcode_disk",
+                      os.environ.get("ZIPCODE_CACHE", "zipcode-cache.sqlite"))
+
+    return ZipcodeResolver(index, ZipcodeApiProvider(api_key), cache)